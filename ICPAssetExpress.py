@@ -1,25 +1,80 @@
 import argparse
 import base64
+import concurrent.futures
+import contextlib
 import datetime
+import email.utils
+import ipaddress
 import json
 import logging
+import multiprocessing
 import os
 import os.path
+import queue
+import random
 import re
 import shutil
 import sqlite3
 import subprocess
+import threading
 import time
+import urllib.parse
+import uuid
+import zlib
 from collections import defaultdict
+from functools import partial
 
 import pandas as pd
 import requests
+import requests.adapters
 from rich.console import Console
 
+try:
+    import pyarrow  # 可选依赖: 安装后结果数据集使用 Parquet 列式存储，否则回退为 JSON Lines
+except ImportError:
+    pyarrow = None
+try:
+    import zstandard  # 可选依赖: 安装后原始JSON使用 zstd (+字典) 压缩，否则回退到 zlib
+except ImportError:
+    zstandard = None
+
 # --- Global Configuration (全局配置，部分可被命令行参数覆盖) ---
 OUTPUT_BASE_DIR = "results_default"
 DB_FILE = "icp_asset_cache.db"
 CACHE_EXPIRY_HOURS = 30 * 24
+# 缓存状态模型: hit (有数据) / empty (查询成功但无结果) / error (查询失败)，各自独立的有效期
+EMPTY_CACHE_EXPIRY_HOURS = 7 * 24
+ERROR_CACHE_EXPIRY_HOURS = 1
+CACHE_STATE_HIT, CACHE_STATE_EMPTY, CACHE_STATE_ERROR = "hit", "empty", "error"
+
+# --- SQLite 配置 (WAL + 调优 pragma，多线程通过连接池各自持有连接) ---
+DB_PRAGMAS = {
+    "auto_vacuum": "INCREMENTAL",  # 新建数据库即支持增量回收空间 (旧库在首次 --cache-gc 时转换)
+    "journal_mode": "WAL",  # 读写互不阻塞，多个工作线程可同时读缓存
+    "synchronous": "NORMAL",  # WAL 模式下仍保证一致性，显著减少 fsync
+    "cache_size": -64000,  # 每个连接约 64MB 页缓存 (负数单位为KB)
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "MEMORY",
+    "busy_timeout": 30000,
+}
+DB_POOL_SIZE = 8  # 连接池保留的空闲连接数上限 (超出时临时创建，归还后关闭)
+CACHE_KEEP_SNAPSHOTS = 3  # 每个目标保留的Quake历史快照 (已完成翻页) 数量
+CACHE_STALE_RUN_HOURS = 24  # 缓存清理时，超过该时长仍为 running/failed 的Fofa运行记录视为中断并删除
+CACHE_AUTO_GC = False  # 每次运行结束后自动执行缓存清理 (--auto-gc)
+ASSET_DIFF_FIELDS = ("网站标题", "产品指纹", "HTTP状态码")  # 历史快照对比时判定资产 "变更" 的字段
+ASSET_DIFF_DELTA_ONLY = False  # 只对新增/变更资产进行主动扫描与指纹识别 (--delta-only)
+ASSET_CHANGE_TYPE_COLUMN = "变化类型"  # 资产变化写入结果数据集时记录 added / removed / changed 的列
+ASSET_DEDUPE = True  # 跨目标/主体单位去重: 同一次运行中每个 IP:端口 与URL只扫描一次 (--no-dedupe 关闭)
+RESULT_STORE_FORMAT = "auto"  # 结果数据集格式: auto (有 pyarrow 用 parquet，否则 jsonl) / parquet / jsonl / none
+RESULT_STORE_DIR = None  # 结果数据集目录，默认为 <输出目录>/_dataset
+RESULT_STORE_RUN_ID = f"{time.time_ns():020d}"  # 本次运行的ID，--render 按分区只选取最近一次运行写入的数据
+DEFER_REPORTS = False  # 延迟渲染: 扫描时只写结果数据集，Excel报告之后通过 --render 按需生成 (--defer-reports)
+RAW_JSON_COMPRESSION = "auto"  # 原始JSON存储压缩: auto (有 zstandard 用 zstd，否则 zlib) / zstd / zlib / none
+ZSTD_DICT_SIZE = 112 * 1024  # 基于Quake服务记录训练的共享 zstd 字典大小
+ZSTD_DICT_MIN_SAMPLES = 200  # 训练字典所需的最少样本数
+CACHE_STATS_SAMPLE_ROWS = 2000  # --cache-stats 估算压缩率时每张表解压的抽样行数
+RAW_JSON_MIN_COMPRESS_BYTES = 128  # 过短的JSON (如空结果 "[]") 压缩后反而更大，直接存文本
+RAW_JSON_SCHEMA_VERSION = 1  # PRAGMA user_version 达到该值表示旧版原始JSON已完成压缩迁移，启动时不再扫描
 
 # --- Rich Console (用于美化终端输出) ---
 cs_console = Console(log_path=False)
@@ -45,14 +100,66 @@ DEFAULT_PORTS = {
 QUAKE_QUERY_TEMPLATE = 'icp_keywords:"{target}" and country:"China" AND not province:"Hongkong"'
 # QUAKE_QUERY_TEMPLATE = 'icp_keywords:"{target}" and not domain_is_wildcard:true and country:"China" AND not province:"Hongkong"'
 SHOW_SCAN_INFO = False
+QUAKE_RESUME = False  # 是否从上次中断的Quake翻页检查点继续 (--resume)
+STORE_QUAKE_RAW_JSON = True  # 是否在 QuakeAsset 规范化表之外额外保存原始JSON (--no-raw-json 关闭)
+# QuakeAsset 表列名与解析结果字段的对应关系 (顺序即Excel输出列顺序)
+QUAKE_ASSET_COLUMNS = [
+    ("ip", "IP"), ("port", "Port"), ("host", "Host"), ("url", "URL"), ("status_code", "HTTP状态码"),
+    ("scan_urls", "scan_urls"), ("domain", "Domain"), ("title", "网站标题"), ("fingerprints", "产品指纹"),
+    ("icp_licence", "备案号"), ("unit", "主体单位"), ("unit_nature", "备案单位类型"), ("record_time", "时间"),
+    ("province", "归属省份"),
+]
 
 # --- Fofa配置 ---
 FOFA_EMAIL = ""
 FOFA_KEY = ""
 FOFA_BASE_URL = "https://fofa.info"
 
+FOFA_CONCURRENCY = 3  # 同时进行的Fofa查询批次数 (实际请求速率仍受 fofa 令牌桶限制)
+FOFA_MAX_QUERY_LENGTH = 4000  # 单条Fofa查询语句的最大长度，按此长度尽量多地打包IP
+FOFA_CIDR_MIN_IPS = 16  # 同一 /24 网段内待查IP达到该数量时改用 CIDR 语法查询整个网段 (0 表示不使用，--fofa-cidr-min-ips)
+FOFA_CHUNK_RETRIES = 1  # 失败批次在本次运行内单独重试的次数
+
 # --- wer.plus API配置 ---
 WERPLUS_API_KEY = ""
+WERPLUS_APP_TYPES = ("app", "mapp")  # 支持查询的类型: APP / 小程序，每种类型独立缓存
+WERPLUS_CONCURRENCY = 4  # 同时预取的 (公司, 类型) 查询数
+WERPLUS_PAGE_CONCURRENCY = 3  # 单个查询内并发获取的分页数
+
+# --- 流水线并发配置 (阶段: quake -> scan -> fingerprint -> fofa) ---
+PIPELINE_QUEUE_SIZE = 8  # 阶段间有界队列长度，下游处理不过来时上游自动阻塞
+PIPELINE_WORKERS = {"quake": 1, "scan": 2, "fingerprint": 2, "fofa": 1}
+
+# --- gogo 并行扫描配置 (进程数与线程预算为全局共享，跨公司生效) ---
+GOGO_MAX_PROCESSES = 4  # 同时运行的 gogo 进程数上限
+GOGO_THREAD_BUDGET = 4000  # gogo 线程总预算，平均分配给每个进程 (-t)
+GOGO_CHUNK_SIZE = 256  # 每个扫描分片的IP数量
+GOGO_FOLLOW_POLL_INTERVAL = 0.5  # 扫描过程中轮询 gogo 输出文件新增内容的间隔 (秒)
+GOGO_INCREMENTAL = False  # 增量扫描: 只扫描新出现或超过复扫有效期的 IP:端口 (--incremental-scan)
+SCAN_HISTORY_TTL_HOURS = 7 * 24  # IP:端口 扫描记录的复扫有效期 (小时)
+GOGO_REPORT_COLUMNS = ['url', 'ip', 'port', 'protocol', 'status', 'host', 'title / banner', 'midware', 'finger_name',
+                       'finger_version', 'finger_vendor', 'finger_product', 'Vulnerabilities']
+FINGERPRINT_STREAM_BATCH_SIZE = 200  # 扫描中新发现的URL攒够该数量即提交一次 observer_ward
+FINGERPRINT_BATCH_MODE = False  # 每个目标只运行一次 observer_ward，再按URL归属拆分回各公司报告 (--batch-fingerprint)
+FINGERPRINT_CACHE_TTL_HOURS = 7 * 24  # URL指纹缓存有效期 (小时)，跨公司、跨运行复用；0 表示不使用缓存
+CSV_CONVERT_WORKERS = max(1, (os.cpu_count() or 2) // 2)  # 指纹结果 CSV→Excel 转换进程数
+FINGERPRINT_VALID_STATUS_CODES = (200, 301, 302)  # 指纹结果中归入 "有效表" 的HTTP状态码
+
+# --- API限速配置 (令牌桶: rate 为每秒请求数, burst 为可累积的突发请求数; rate<=0 表示不限速) ---
+RATE_LIMITS = {
+    "quake": {"rate": 1 / DELAY, "burst": 1},
+    "fofa": {"rate": 1 / DELAY, "burst": 1},
+    "werplus": {"rate": 2, "burst": 4},
+}
+RATE_LIMIT_MAX_RETRIES = 5  # 连续收到 429 时的最大重试次数
+RATE_LIMIT_DEFAULT_RETRY_AFTER = 10  # 429 未携带 Retry-After 时的默认冷却秒数
+
+# --- HTTP客户端配置 (连接池复用 + 瞬时错误指数退避重试) ---
+HTTP_POOL_SIZE = 10
+HTTP_MAX_RETRIES = 3
+HTTP_BACKOFF_BASE = 1.0  # 第 n 次重试等待约 base * 2^(n-1) 秒 (含随机抖动)
+HTTP_BACKOFF_MAX = 30
+PROVIDER_TIMEOUTS = {"quake": 30, "fofa": 30, "werplus": 20}
 
 
 # ======================= 日志与数据库初始化 =======================
@@ -71,7 +178,7 @@ def configure_logging(log_file_path):
 def initialize_database():
     conn = None
     try:
-        conn = sqlite3.connect(DB_FILE)
+        conn = open_db_connection()
         cursor = conn.cursor()
         cursor.execute(
             "CREATE TABLE IF NOT EXISTS Targets (target_id INTEGER PRIMARY KEY AUTOINCREMENT, target_name TEXT UNIQUE NOT NULL, last_queried_quake TIMESTAMP, last_queried_fofa TIMESTAMP, notes TEXT);")
@@ -81,10 +188,30 @@ def initialize_database():
             cursor.execute("ALTER TABLE Targets ADD COLUMN last_queried_fofa TIMESTAMP;")
         except sqlite3.OperationalError:
             pass
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS QuakeScrolls (scroll_id INTEGER PRIMARY KEY AUTOINCREMENT, target_id INTEGER NOT NULL, query_dsl TEXT NOT NULL, pagination_id TEXT, pages_fetched INTEGER DEFAULT 0, records_fetched INTEGER DEFAULT 0, status TEXT DEFAULT 'running', started_at TIMESTAMP NOT NULL, updated_at TIMESTAMP, FOREIGN KEY (target_id) REFERENCES Targets (target_id));")
+        try:
+            cursor.execute("ALTER TABLE QuakeRawData ADD COLUMN scroll_id INTEGER;")
+        except sqlite3.OperationalError:
+            pass
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS QuakeAsset (asset_id INTEGER PRIMARY KEY AUTOINCREMENT, target_id INTEGER NOT NULL, scroll_id INTEGER, query_timestamp TIMESTAMP NOT NULL, ip TEXT, port TEXT, host TEXT, url TEXT, status_code NUMERIC, scan_urls TEXT, domain TEXT, title TEXT, fingerprints TEXT, icp_licence TEXT, unit TEXT, unit_nature TEXT, record_time TEXT, province TEXT, FOREIGN KEY (target_id) REFERENCES Targets (target_id));")
         cursor.execute(
             "CREATE TABLE IF NOT EXISTS FofaRuns (fofa_run_id INTEGER PRIMARY KEY AUTOINCREMENT, target_id INTEGER NOT NULL, run_timestamp TIMESTAMP NOT NULL, status TEXT DEFAULT 'pending', input_ip_count INTEGER DEFAULT 0, found_results_count INTEGER DEFAULT 0, notes TEXT, FOREIGN KEY (target_id) REFERENCES Targets (target_id));")
         cursor.execute(
             "CREATE TABLE IF NOT EXISTS FofaRawData (fofa_data_id INTEGER PRIMARY KEY AUTOINCREMENT, fofa_run_id INTEGER NOT NULL, raw_json TEXT NOT NULL, FOREIGN KEY (fofa_run_id) REFERENCES FofaRuns (fofa_run_id));")
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS FofaRunChunks (chunk_id INTEGER PRIMARY KEY AUTOINCREMENT, fofa_run_id INTEGER NOT NULL, chunk_index INTEGER NOT NULL, query_str TEXT NOT NULL, ip_list TEXT NOT NULL, status TEXT DEFAULT 'pending', attempts INTEGER DEFAULT 0, result_count INTEGER DEFAULT 0, error TEXT, updated_at TIMESTAMP, FOREIGN KEY (fofa_run_id) REFERENCES FofaRuns (fofa_run_id));")
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS FofaIPCache (ip TEXT PRIMARY KEY, query_timestamp TIMESTAMP NOT NULL, fofa_run_id INTEGER, result_count INTEGER DEFAULT 0, raw_json TEXT NOT NULL);")
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS GogoFindings (finding_id INTEGER PRIMARY KEY AUTOINCREMENT, scan_id TEXT NOT NULL, company_name TEXT, ip TEXT NOT NULL, port TEXT NOT NULL, protocol TEXT, status TEXT, url TEXT, row_json TEXT NOT NULL, found_at TIMESTAMP NOT NULL);")
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS ScanHistory (ip TEXT NOT NULL, port TEXT NOT NULL, last_scanned TIMESTAMP NOT NULL, state TEXT NOT NULL, row_json TEXT, PRIMARY KEY (ip, port));")
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS FingerprintCache (url_key TEXT PRIMARY KEY, url TEXT NOT NULL, result_json TEXT NOT NULL, fingerprinted_at TIMESTAMP NOT NULL);")
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS CompressionDicts (dict_id INTEGER PRIMARY KEY AUTOINCREMENT, codec TEXT NOT NULL, sample_count INTEGER, created_at TIMESTAMP NOT NULL, dict_data BLOB NOT NULL);")
         cursor.execute(
             "CREATE TABLE IF NOT EXISTS CompanyAppCache (cache_id INTEGER PRIMARY KEY AUTOINCREMENT, company_name TEXT UNIQUE NOT NULL, last_queried TIMESTAMP NOT NULL, raw_json_apps TEXT, raw_json_miniprograms TEXT);")
         conn.commit()
@@ -93,8 +220,39 @@ def initialize_database():
             "CREATE INDEX IF NOT EXISTS idx_quakerawdata_target_id_timestamp ON QuakeRawData (target_id, query_timestamp);")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_fofaruns_target_id ON FofaRuns (target_id);")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_fofarawdata_run_id ON FofaRawData (fofa_run_id);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_fofarunchunks_run_id ON FofaRunChunks (fofa_run_id, status);")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_company_name_cache ON CompanyAppCache (company_name);")
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS CompanyAppTypeCache (company_name TEXT NOT NULL, app_type TEXT NOT NULL, last_queried TIMESTAMP NOT NULL, raw_json TEXT NOT NULL, PRIMARY KEY (company_name, app_type));")
+        # 迁移旧版合并缓存 (apps/miniprograms 同行存储) 为按类型独立缓存
+        cursor.execute(
+            "INSERT OR IGNORE INTO CompanyAppTypeCache (company_name, app_type, last_queried, raw_json) "
+            "SELECT company_name, 'app', last_queried, COALESCE(raw_json_apps, '[]') FROM CompanyAppCache")
+        cursor.execute(
+            "INSERT OR IGNORE INTO CompanyAppTypeCache (company_name, app_type, last_queried, raw_json) "
+            "SELECT company_name, 'mapp', last_queried, COALESCE(raw_json_miniprograms, '[]') FROM CompanyAppCache")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_quakescrolls_target_id ON QuakeScrolls (target_id, status);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_quakerawdata_scroll_id ON QuakeRawData (scroll_id);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_quakeasset_target_id ON QuakeAsset (target_id);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_quakeasset_scroll_id ON QuakeAsset (scroll_id);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_quakeasset_unit ON QuakeAsset (unit);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_quakeasset_ip ON QuakeAsset (ip);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_gogofindings_scan_id ON GogoFindings (scan_id);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_gogofindings_ip_port ON GogoFindings (ip, port);")
+        for table, column in (("Targets", "quake_cache_state TEXT"), ("Targets", "quake_last_error TEXT"),
+                              ("FofaIPCache", "cache_state TEXT"), ("CompanyAppTypeCache", "cache_state TEXT")):
+            try:
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column};")
+            except sqlite3.OperationalError:
+                pass
         conn.commit()
+        load_zstd_dicts(conn)
+        backfill_quake_assets(conn)
+        backfill_fofa_ip_cache(conn)
+        if conn.execute("PRAGMA user_version").fetchone()[0] < RAW_JSON_SCHEMA_VERSION \
+                and get_raw_json_codec() != "none":
+            migrate_raw_json_compression(conn)
+            conn.execute(f"PRAGMA user_version = {RAW_JSON_SCHEMA_VERSION}")
         logging.info(f"数据库 '{DB_FILE}' 初始化成功。")
         return conn
     except sqlite3.Error as e:
@@ -105,6 +263,586 @@ def initialize_database():
         return None
 
 
+def open_db_connection():
+    """创建一个应用了 DB_PRAGMAS 的数据库连接 (允许在线程间移交，但同一时刻只由一个线程使用)。"""
+    conn = sqlite3.connect(DB_FILE, timeout=30, check_same_thread=False)
+    for pragma, value in DB_PRAGMAS.items():
+        try:
+            conn.execute(f"PRAGMA {pragma} = {value}")
+        except sqlite3.Error as e:
+            logging.warning(f"设置 PRAGMA {pragma}={value} 失败: {e}")
+    return conn
+
+
+class SQLiteConnectionPool:
+    """
+    线程安全的 SQLite 连接池。
+    - acquire() 优先复用空闲连接，没有空闲连接时直接新建，不会阻塞调用方。
+    - release() 回滚未提交的事务后放回池中；空闲连接超过 max_idle 时直接关闭。
+    """
+
+    def __init__(self, max_idle=None):
+        self.max_idle = max_idle or DB_POOL_SIZE
+        self._idle = []
+        self._lock = threading.Lock()
+        self.created_count = 0
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+            self.created_count += 1
+        return open_db_connection()
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            return
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for index, conn in enumerate(idle):
+            try:
+                if index == 0:
+                    # 运行结束时合并 WAL 文件，避免 -wal 文件持续增长
+                    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                conn.close()
+            except sqlite3.Error as e:
+                logging.warning(f"关闭数据库连接失败: {e}")
+
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+_db_local = threading.local()
+
+
+def get_db_pool():
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is None:
+            _db_pool = SQLiteConnectionPool()
+        return _db_pool
+
+
+def get_thread_db_conn():
+    """
+    返回当前线程专属的数据库连接 (从连接池借出，线程结束时通过 close_thread_db_conn 归还)。
+    仅用于会在退出时归还连接的流水线工作线程；线程池任务请使用 get_db_pool().connection()。
+    """
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = get_db_pool().acquire()
+        _db_local.conn = conn
+    return conn
+
+
+def close_thread_db_conn():
+    conn = getattr(_db_local, "conn", None)
+    if conn is not None:
+        get_db_pool().release(conn)
+        _db_local.conn = None
+
+
+def close_db_pool():
+    close_thread_db_conn()
+    if _db_pool is not None:
+        _db_pool.close_all()
+
+
+@contextlib.contextmanager
+def db_transaction(db_conn):
+    """
+    批量事务：块内的多条写操作只提交一次，异常时整体回滚。
+    嵌套使用时只有最外层提交。
+    """
+    if db_conn.in_transaction:
+        yield db_conn
+        return
+    db_conn.execute("BEGIN")
+    try:
+        yield db_conn
+    except BaseException:
+        db_conn.rollback()
+        raise
+    else:
+        db_conn.commit()
+
+
+# ======================= 原始JSON压缩存储 =======================
+# 压缩后的 raw_json 以 BLOB 存储，首字节标识编码: Z=zlib, S=zstd (无字典), D=zstd+字典 (后跟4字节字典ID)；
+# 旧版未压缩的 TEXT 记录保持可读，并在数据库首次初始化时迁移 (完成后以 PRAGMA user_version 标记，只执行一次)。
+# zstd 字典只在 --cache-gc 时训练，避免每次启动都抽样解压大量记录。
+_zstd_dicts = {}
+_zstd_dicts_lock = threading.Lock()
+_zstd_local = threading.local()
+_current_zstd_dict_id = None
+
+
+def get_raw_json_codec():
+    if RAW_JSON_COMPRESSION == "auto":
+        return "zstd" if zstandard else "zlib"
+    if RAW_JSON_COMPRESSION == "zstd" and not zstandard:
+        logging.warning("未安装 zstandard，原始JSON改用 zlib 压缩。")
+        return "zlib"
+    return RAW_JSON_COMPRESSION
+
+
+def load_zstd_dicts(db_conn):
+    """加载数据库中已训练的 zstd 字典，最新的字典用于新写入的数据。"""
+    global _current_zstd_dict_id
+    if not zstandard: return
+    cursor = db_conn.cursor()
+    cursor.execute("SELECT dict_id, dict_data FROM CompressionDicts WHERE codec = 'zstd' ORDER BY dict_id")
+    with _zstd_dicts_lock:
+        for dict_id, dict_data in cursor.fetchall():
+            _zstd_dicts[dict_id] = zstandard.ZstdCompressionDict(dict_data)
+            _current_zstd_dict_id = dict_id
+
+
+def _zstd_codec(kind, dict_id):
+    """线程本地缓存的 zstd 压缩/解压器 (zstd 对象不能跨线程共享)。"""
+    codecs = getattr(_zstd_local, "codecs", None)
+    if codecs is None:
+        codecs = _zstd_local.codecs = {}
+    key = (kind, dict_id)
+    if key not in codecs:
+        zstd_dict = _zstd_dicts.get(dict_id) if dict_id is not None else None
+        if kind == "c":
+            codecs[key] = zstandard.ZstdCompressor(level=10, dict_data=zstd_dict) if zstd_dict else \
+                zstandard.ZstdCompressor(level=10)
+        else:
+            codecs[key] = zstandard.ZstdDecompressor(dict_data=zstd_dict) if zstd_dict else \
+                zstandard.ZstdDecompressor()
+    return codecs[key]
+
+
+def encode_raw_json(payload, use_dict=True):
+    """将原始JSON (对象或字符串) 按当前配置压缩为 BLOB；RAW_JSON_COMPRESSION=none 时返回文本。"""
+    text = payload if isinstance(payload, str) else json.dumps(payload, ensure_ascii=False)
+    codec = get_raw_json_codec()
+    data = text.encode("utf-8")
+    if codec == "none" or len(data) < RAW_JSON_MIN_COMPRESS_BYTES:
+        return text
+    if codec == "zstd":
+        dict_id = _current_zstd_dict_id if use_dict else None
+        if dict_id is not None:
+            return b"D" + dict_id.to_bytes(4, "big") + _zstd_codec("c", dict_id).compress(data)
+        return b"S" + _zstd_codec("c", None).compress(data)
+    return b"Z" + zlib.compress(data, 6)
+
+
+def decode_raw_json(value):
+    """
+    读取 raw_json 列 (兼容未压缩文本与各压缩格式)，返回JSON文本。
+    zstd 数据损坏或字典缺失时抛出 ValueError，由调用方按缓存未命中处理。
+    """
+    if value is None or isinstance(value, str):
+        return value
+    value = bytes(value)
+    marker = value[:1]
+    if marker == b"Z":
+        return zlib.decompress(value[1:]).decode("utf-8")
+    if not zstandard:
+        raise RuntimeError("该记录使用 zstd 压缩，请先安装 zstandard (pip install zstandard)。")
+    try:
+        if marker == b"D":
+            dict_id = int.from_bytes(value[1:5], "big")
+            if dict_id not in _zstd_dicts:
+                raise ValueError(f"raw_json 使用的 zstd 字典 (ID {dict_id}) 不存在")
+            return _zstd_codec("d", dict_id).decompress(value[5:]).decode("utf-8")
+        return _zstd_codec("d", None).decompress(value[1:]).decode("utf-8")
+    except zstandard.ZstdError as e:
+        raise ValueError(f"raw_json zstd 解压失败: {e}") from e
+
+
+def load_raw_json(value, default=None):
+    text = decode_raw_json(value)
+    return json.loads(text) if text else default
+
+
+def train_zstd_dict(db_conn):
+    """基于已有的 Quake 服务记录训练共享 zstd 字典 (单条记录较小，字典可显著提升压缩率)。"""
+    global _current_zstd_dict_id
+    if not zstandard or get_raw_json_codec() != "zstd": return None
+    cursor = db_conn.cursor()
+    cursor.execute("SELECT raw_json FROM QuakeRawData ORDER BY RANDOM() LIMIT 5000")
+    samples = [decode_raw_json(row[0]).encode("utf-8") for row in cursor.fetchall()]
+    if len(samples) < ZSTD_DICT_MIN_SAMPLES: return None
+    try:
+        trained = zstandard.train_dictionary(ZSTD_DICT_SIZE, samples)
+    except zstandard.ZstdError as e:
+        logging.warning(f"训练 zstd 字典失败: {e}")
+        return None
+    with db_transaction(db_conn):
+        cursor.execute("INSERT INTO CompressionDicts (codec, sample_count, created_at, dict_data) VALUES (?, ?, ?, ?)",
+                       ("zstd", len(samples), datetime.datetime.now(), trained.as_bytes()))
+        dict_id = cursor.lastrowid
+    with _zstd_dicts_lock:
+        _zstd_dicts[dict_id] = trained
+        _current_zstd_dict_id = dict_id
+    logging.info(f"已基于 {len(samples)} 条Quake记录训练 zstd 字典 (ID {dict_id})。")
+    return dict_id
+
+
+# 需要压缩存储的原始JSON列: (表名, 主键列, 是否使用Quake字典)
+RAW_JSON_TABLES = [("QuakeRawData", "data_id", True), ("FofaRawData", "fofa_data_id", False),
+                   ("FofaIPCache", "ip", False)]
+
+
+def migrate_raw_json_compression(db_conn, batch_size=1000):
+    """将旧版未压缩的 raw_json 文本按批压缩为 BLOB (每批一个事务，可随时中断，下次继续)。"""
+    if get_raw_json_codec() == "none": return
+    cursor = db_conn.cursor()
+    for table, key_column, use_dict in RAW_JSON_TABLES:
+        migrated = 0
+        while True:
+            cursor.execute(f"SELECT {key_column}, raw_json FROM {table} WHERE typeof(raw_json) = 'text' "
+                           f"AND length(CAST(raw_json AS BLOB)) >= ? LIMIT ?", (RAW_JSON_MIN_COMPRESS_BYTES, batch_size))
+            rows = cursor.fetchall()
+            if not rows: break
+            with db_transaction(db_conn):
+                db_conn.executemany(f"UPDATE {table} SET raw_json = ? WHERE {key_column} = ?",
+                                    [(encode_raw_json(raw_json, use_dict), key) for key, raw_json in rows])
+            migrated += len(rows)
+        if migrated:
+            logging.info(f"已将 {table} 中 {migrated} 条原始JSON迁移为压缩存储。")
+            cs_console.print(f"[green]INFO:[/green] 已将 {table} 中 {migrated} 条原始JSON迁移为压缩存储。")
+
+
+def report_cache_stats(db_conn):
+    """
+    输出缓存数据库各表的记录数、存储大小与原始JSON压缩率。
+    - 记录数与存储大小直接在SQL中汇总，不把原始数据读入内存。
+    - 原始大小只对抽样行解压后按比例估算 (行数不超过抽样数时为精确值)。
+    """
+    cursor = db_conn.cursor()
+    page_size = cursor.execute("PRAGMA page_size").fetchone()[0]
+    page_count = cursor.execute("PRAGMA page_count").fetchone()[0]
+    freelist_count = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+    cs_console.print(f"\n[bold]缓存数据库统计:[/bold] '{DB_FILE}' 共 {page_size * page_count / 1048576:.1f} MB "
+                     f"(可回收空闲页 {page_size * freelist_count / 1048576:.1f} MB)，压缩方式: {get_raw_json_codec()}"
+                     f"{' + 字典' if _current_zstd_dict_id is not None else ''}")
+    for table, _, _ in RAW_JSON_TABLES:
+        row_count, stored_bytes, compressed_rows = cursor.execute(
+            f"SELECT COUNT(*), COALESCE(SUM(length(CAST(raw_json AS BLOB))), 0), "
+            f"COALESCE(SUM(typeof(raw_json) = 'blob'), 0) FROM {table} WHERE raw_json IS NOT NULL").fetchone()
+        sample_stored, sample_original = 0, 0
+        sample_cursor = db_conn.execute(f"SELECT raw_json FROM {table} WHERE raw_json IS NOT NULL "
+                                        f"ORDER BY RANDOM() LIMIT ?", (CACHE_STATS_SAMPLE_ROWS,))
+        while True:
+            rows = sample_cursor.fetchmany(200)
+            if not rows:
+                break
+            for (raw_json,) in rows:
+                sample_stored += len(raw_json.encode("utf-8") if isinstance(raw_json, str) else raw_json)
+                sample_original += len(decode_raw_json(raw_json).encode("utf-8"))
+        sampled = row_count > CACHE_STATS_SAMPLE_ROWS
+        original_bytes = stored_bytes * sample_original / sample_stored if sample_stored else 0
+        ratio = f"{original_bytes / stored_bytes:.1f}x" if stored_bytes else "-"
+        cs_console.print(f"  - {table}: {row_count} 条 (已压缩 {compressed_rows} 条)，"
+                         f"原始 {'约 ' if sampled else ''}{original_bytes / 1048576:.2f} MB，"
+                         f"存储 {stored_bytes / 1048576:.2f} MB，压缩率 {ratio}"
+                         f"{f' (按 {CACHE_STATS_SAMPLE_ROWS} 条抽样估算)' if sampled else ''}")
+
+
+# ======================= 缓存清理 =======================
+def get_db_size_bytes(db_conn):
+    """返回 (数据库总大小, 空闲页大小)，单位字节。"""
+    cursor = db_conn.cursor()
+    page_size = cursor.execute("PRAGMA page_size").fetchone()[0]
+    return page_size * cursor.execute("PRAGMA page_count").fetchone()[0], \
+        page_size * cursor.execute("PRAGMA freelist_count").fetchone()[0]
+
+
+def _delete_expired_by_state(cursor, table, time_column, state_sql):
+    """按缓存状态对应的有效期删除过期记录，返回删除条数。"""
+    now = datetime.datetime.now()
+    deleted = 0
+    for cache_state, expiry_hours in ((CACHE_STATE_HIT, CACHE_EXPIRY_HOURS), (CACHE_STATE_EMPTY, EMPTY_CACHE_EXPIRY_HOURS),
+                                      (CACHE_STATE_ERROR, ERROR_CACHE_EXPIRY_HOURS)):
+        cursor.execute(f"DELETE FROM {table} WHERE ({state_sql}) = ? AND {time_column} < ?",
+                       (cache_state, now - datetime.timedelta(hours=expiry_hours)))
+        deleted += cursor.rowcount
+    return deleted
+
+
+def run_cache_gc(db_conn, keep_snapshots=None):
+    """
+    缓存清理与保留策略，返回 {清理项: 删除条数}。
+    - Quake: 每个目标只保留最近 keep_snapshots 个已完成快照；原始JSON仅为最新快照保留且过期即删；清理中断/放弃的翻页。
+    - Fofa: 清理失败或中断的运行记录 (及其批次/原始数据)，每个目标只保留最近 keep_snapshots 次运行；按状态有效期清理IP缓存。
+    - 指纹、APP/小程序、gogo 结果按各自有效期清理，最后增量回收空闲页。
+    """
+    keep_snapshots = max(1, keep_snapshots or CACHE_KEEP_SNAPSHOTS)
+    now = datetime.datetime.now()
+    expired_before = now - datetime.timedelta(hours=CACHE_EXPIRY_HOURS)
+    stale_before = now - datetime.timedelta(hours=CACHE_STALE_RUN_HOURS)
+    size_before, _ = get_db_size_bytes(db_conn)
+    stats = {}
+    cursor = db_conn.cursor()
+
+    with db_transaction(db_conn):
+        # --- Quake 快照 ---
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS gc_ids (id INTEGER PRIMARY KEY)")
+        cursor.execute("DELETE FROM gc_ids")
+        cursor.execute(
+            "INSERT INTO gc_ids SELECT scroll_id FROM (SELECT scroll_id, status, updated_at, ROW_NUMBER() OVER "
+            "(PARTITION BY target_id, status ORDER BY scroll_id DESC) AS rank FROM QuakeScrolls) "
+            "WHERE status = 'abandoned' OR (status = 'completed' AND rank > ?) "
+            "OR (status = 'running' AND updated_at < ?)", (keep_snapshots, expired_before))
+        for table in ("QuakeAsset", "QuakeRawData"):
+            cursor.execute(f"DELETE FROM {table} WHERE scroll_id IN (SELECT id FROM gc_ids)")
+            stats[f"{table} (淘汰快照)"] = cursor.rowcount
+        cursor.execute("DELETE FROM QuakeScrolls WHERE scroll_id IN (SELECT id FROM gc_ids)")
+        stats["QuakeScrolls"] = cursor.rowcount
+        # 原始JSON只为最新快照 (或进行中的翻页) 保留，且过期后删除；规范化的 QuakeAsset 保留用于历史对比
+        cursor.execute(
+            "DELETE FROM QuakeRawData WHERE query_timestamp < ? OR scroll_id NOT IN (SELECT scroll_id FROM QuakeScrolls "
+            "WHERE status = 'running' UNION SELECT MAX(scroll_id) FROM QuakeScrolls WHERE status = 'completed' "
+            "GROUP BY target_id) OR (scroll_id IS NULL AND target_id IN "
+            "(SELECT target_id FROM QuakeScrolls WHERE status = 'completed'))", (expired_before,))
+        stats["QuakeRawData (过期/历史原始JSON)"] = cursor.rowcount
+        cursor.execute("DELETE FROM QuakeAsset WHERE scroll_id IS NULL AND target_id IN "
+                       "(SELECT target_id FROM QuakeScrolls WHERE status = 'completed')")
+        stats["QuakeAsset (旧版无快照数据)"] = cursor.rowcount
+
+        # --- Fofa 运行记录 ---
+        cursor.execute("DELETE FROM gc_ids")
+        cursor.execute(
+            "INSERT INTO gc_ids SELECT fofa_run_id FROM (SELECT fofa_run_id, status, run_timestamp, ROW_NUMBER() "
+            "OVER (PARTITION BY target_id ORDER BY fofa_run_id DESC) AS rank FROM FofaRuns) "
+            "WHERE rank > ? OR (status IN ('running', 'failed') AND run_timestamp < ?)", (keep_snapshots, stale_before))
+        for table in ("FofaRunChunks", "FofaRawData"):
+            cursor.execute(f"DELETE FROM {table} WHERE fofa_run_id IN (SELECT id FROM gc_ids)")
+            stats[table] = cursor.rowcount
+        cursor.execute("DELETE FROM FofaRuns WHERE fofa_run_id IN (SELECT id FROM gc_ids)")
+        stats["FofaRuns"] = cursor.rowcount
+        stats["FofaIPCache (过期)"] = _delete_expired_by_state(
+            cursor, "FofaIPCache", "query_timestamp",
+            f"COALESCE(cache_state, CASE WHEN result_count > 0 THEN '{CACHE_STATE_HIT}' ELSE '{CACHE_STATE_EMPTY}' END)")
+
+        # --- 其他缓存 ---
+        stats["CompanyAppTypeCache (过期)"] = _delete_expired_by_state(
+            cursor, "CompanyAppTypeCache", "last_queried", f"COALESCE(cache_state, '{CACHE_STATE_HIT}')")
+        cursor.execute("DELETE FROM CompanyAppCache WHERE last_queried < ?", (expired_before,))
+        stats["CompanyAppCache (旧版)"] = cursor.rowcount
+        if FINGERPRINT_CACHE_TTL_HOURS > 0:
+            cursor.execute("DELETE FROM FingerprintCache WHERE fingerprinted_at < ?",
+                           (now - datetime.timedelta(hours=FINGERPRINT_CACHE_TTL_HOURS),))
+            stats["FingerprintCache (过期)"] = cursor.rowcount
+        cursor.execute("DELETE FROM GogoFindings WHERE found_at < ?", (expired_before,))
+        stats["GogoFindings (过期)"] = cursor.rowcount
+        cursor.execute("DELETE FROM ScanHistory WHERE last_scanned < ?",
+                       (now - datetime.timedelta(hours=SCAN_HISTORY_TTL_HOURS),))
+        stats["ScanHistory (过期)"] = cursor.rowcount
+        cursor.execute("DELETE FROM gc_ids")
+
+    reclaim_free_pages(db_conn)
+    size_after, free_after = get_db_size_bytes(db_conn)
+    stats["_reclaimed_bytes"] = size_before - size_after
+    stats["_size_after_bytes"] = size_after
+    stats["_free_after_bytes"] = free_after
+    return stats
+
+
+def reclaim_free_pages(db_conn):
+    """增量回收空闲页；旧库尚未启用 auto_vacuum=INCREMENTAL 时执行一次完整 VACUUM 完成转换。"""
+    if db_conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        cs_console.print("[green]INFO:[/green] 首次清理: 转换数据库为增量回收模式 (执行一次完整 VACUUM，可能耗时较长)...")
+        db_conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        db_conn.execute("VACUUM")
+    else:
+        db_conn.execute("PRAGMA incremental_vacuum")
+    db_conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+def report_cache_gc(stats):
+    cs_console.print("\n[bold]缓存清理完成:[/bold]")
+    for name, count in stats.items():
+        if not name.startswith("_") and count:
+            cs_console.print(f"  - {name}: 删除 {count} 条")
+    cs_console.print(f"  回收空间 {stats['_reclaimed_bytes'] / 1048576:.2f} MB，当前数据库 "
+                     f"{stats['_size_after_bytes'] / 1048576:.2f} MB (剩余空闲页 {stats['_free_after_bytes'] / 1048576:.2f} MB)。")
+    logging.info(f"缓存清理统计: {stats}")
+
+
+# ======================= API限速 =======================
+class TokenBucketRateLimiter:
+    """
+    令牌桶限速器 (线程安全)。
+    - 按 rate 每秒补充令牌，最多累积 burst 个，允许短时突发后回落到稳定速率。
+    - 收到 429 / Retry-After 时通过 penalize() 在指定时间内暂停发放令牌。
+    - 记录各调用线程的累计等待时间，便于评估配额利用情况。
+    """
+
+    def __init__(self, name, rate, burst=1):
+        self.name = name
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self._tokens = self.burst
+        self._updated_at = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+        self.request_count = 0
+        self.throttled_count = 0
+        self.total_wait = 0.0
+        self.wait_by_caller = defaultdict(float)
+
+    def acquire(self):
+        """阻塞直到拿到一个令牌，返回本次等待的秒数。"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if self.rate > 0:
+                    self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+                else:
+                    self._tokens = self.burst
+                self._updated_at = now
+                delay = max(0.0, self._blocked_until - now)
+                if delay == 0 and self._tokens >= 1:
+                    self._tokens -= 1
+                    self.request_count += 1
+                    self.total_wait += waited
+                    self.wait_by_caller[threading.current_thread().name] += waited
+                    return waited
+                if delay == 0:
+                    delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def penalize(self, seconds):
+        """服务端要求降速 (429/Retry-After) 时调用：清空令牌并在 seconds 秒内暂停发放。"""
+        with self._lock:
+            self._tokens = 0
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+            self.throttled_count += 1
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(provider):
+    with _rate_limiters_lock:
+        if provider not in _rate_limiters:
+            config = RATE_LIMITS.get(provider, {"rate": 0, "burst": 1})
+            _rate_limiters[provider] = TokenBucketRateLimiter(provider, config["rate"], config.get("burst", 1))
+        return _rate_limiters[provider]
+
+
+def parse_retry_after(response, default=RATE_LIMIT_DEFAULT_RETRY_AFTER):
+    """解析 Retry-After 响应头 (秒数或HTTP日期格式)。"""
+    value = (response.headers or {}).get("Retry-After")
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        return max(0.0, (retry_at - datetime.datetime.now(retry_at.tzinfo)).total_seconds())
+    except (TypeError, ValueError):
+        return default
+
+
+class ProviderClient:
+    """
+    API平台客户端。
+    - 每个线程持有独立的 requests.Session，复用 keep-alive 连接，避免每页都重新握手。
+    - 每次请求前经过该平台的令牌桶限速；429 按 Retry-After 冷却后重试。
+    - 连接错误、超时及 5xx 按指数退避 (带随机抖动) 重试，超过次数后才向上抛出/返回。
+    """
+    RETRY_STATUS_CODES = {500, 502, 503, 504}
+
+    def __init__(self, provider):
+        self.provider = provider
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            self._local.session = session
+        return session
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", PROVIDER_TIMEOUTS.get(self.provider, 30))
+        limiter = get_rate_limiter(self.provider)
+        attempt, throttled = 0, 0
+        while True:
+            limiter.acquire()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt >= HTTP_MAX_RETRIES:
+                    raise
+                reason = str(e)
+            else:
+                if response.status_code == 429 and throttled < RATE_LIMIT_MAX_RETRIES:
+                    throttled += 1
+                    retry_after = parse_retry_after(response)
+                    limiter.penalize(retry_after)
+                    logging.warning(f"{self.provider} API 返回 429，{retry_after:.1f} 秒后重试。")
+                    continue
+                if response.status_code not in self.RETRY_STATUS_CODES or attempt >= HTTP_MAX_RETRIES:
+                    return response
+                reason = f"HTTP {response.status_code}"
+            attempt += 1
+            delay = min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * 2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+            logging.warning(f"{self.provider} API 请求失败 ({reason})，{delay:.1f} 秒后进行第 {attempt} 次重试。")
+            time.sleep(delay)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+
+_provider_clients = {}
+
+
+def get_provider_client(provider):
+    with _rate_limiters_lock:
+        if provider not in _provider_clients:
+            _provider_clients[provider] = ProviderClient(provider)
+        return _provider_clients[provider]
+
+
+def report_rate_limiter_stats():
+    for provider, limiter in sorted(_rate_limiters.items()):
+        if not limiter.request_count:
+            continue
+        avg_wait = limiter.total_wait / limiter.request_count
+        cs_console.print(f"  [dim]{provider} 限速统计: 请求 {limiter.request_count} 次, 累计等待 "
+                         f"{limiter.total_wait:.1f} 秒 (平均 {avg_wait:.2f} 秒), 429 降速 {limiter.throttled_count} 次[/dim]")
+        for caller, waited in sorted(limiter.wait_by_caller.items()):
+            logging.info(f"{provider} 限速等待 - 线程 {caller}: {waited:.1f} 秒")
+
+
 # ======================= 通用辅助函数 =======================
 def load_queries(file_path):
     logging.info(f"开始从文件加载查询目标: {file_path}")
@@ -129,6 +867,30 @@ def generate_filename_suffix(company_name, stage=""):
     return f"_{sanitized_company_name}_{stage}_{timestamp_str}"
 
 
+def parse_db_timestamp(value):
+    """解析 sqlite3 以字符串形式存储的 datetime (兼容带/不带微秒及 ISO 格式)。"""
+    try:
+        if '.' in value:
+            return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f')
+        return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        return datetime.datetime.fromisoformat(value)
+
+
+def get_cache_expiry_hours(cache_state):
+    """返回缓存状态 (hit/empty/error) 对应的有效期 (小时)。"""
+    return {CACHE_STATE_EMPTY: EMPTY_CACHE_EXPIRY_HOURS,
+            CACHE_STATE_ERROR: ERROR_CACHE_EXPIRY_HOURS}.get(cache_state, CACHE_EXPIRY_HOURS)
+
+
+def is_cache_entry_fresh(cache_state, cached_at):
+    """按缓存状态 (hit/empty/error) 对应的有效期判断缓存记录是否仍然有效。"""
+    expiry_hours = get_cache_expiry_hours(cache_state)
+    if not cached_at or expiry_hours <= 0: return False
+    cached_dt = parse_db_timestamp(cached_at) if isinstance(cached_at, str) else cached_at
+    return (datetime.datetime.now() - cached_dt).total_seconds() / 3600 < expiry_hours
+
+
 def get_target_id_from_db(target_name, db_conn):
     try:
         cursor = db_conn.cursor()
@@ -137,8 +899,8 @@ def get_target_id_from_db(target_name, db_conn):
         if result:
             return result[0]
         else:
-            cursor.execute("INSERT INTO Targets (target_name) VALUES (?)", (target_name,))
-            db_conn.commit()
+            with db_transaction(db_conn):
+                cursor.execute("INSERT INTO Targets (target_name) VALUES (?)", (target_name,))
             logging.info(f"数据库中未找到目标'{target_name}'，已创建新条目。")
             return cursor.lastrowid
     except Exception as e:
@@ -147,111 +909,288 @@ def get_target_id_from_db(target_name, db_conn):
 
 
 # ======================= 数据查询与解析 (Quake, Fofa, APP) =======================
-def check_and_get_quake_cache(target_name, db_conn):
+class QuakeQueryError(Exception):
+    """Quake API 查询失败 (网络异常或API返回错误)。"""
+
+
+def quake_record_to_asset_row(record):
+    values = []
+    for column, field in QUAKE_ASSET_COLUMNS:
+        value = record.get(field, "")
+        values.append("\n".join(value) if column == "scan_urls" else value)
+    return values
+
+
+def quake_asset_row_to_record(row):
+    record = {}
+    for (column, field), value in zip(QUAKE_ASSET_COLUMNS, row):
+        if column == "scan_urls":
+            value = value.split("\n") if value else []
+        record[field] = "" if value is None else value
+    return record
+
+
+def insert_quake_assets(cursor, target_id, scroll_id, timestamp, records):
+    columns = ", ".join(column for column, _ in QUAKE_ASSET_COLUMNS)
+    placeholders = ", ".join("?" for _ in range(len(QUAKE_ASSET_COLUMNS) + 3))
+    cursor.executemany(
+        f"INSERT INTO QuakeAsset (target_id, scroll_id, query_timestamp, {columns}) VALUES ({placeholders})",
+        [[target_id, scroll_id, timestamp] + quake_record_to_asset_row(record) for record in records])
+
+
+def backfill_quake_assets(db_conn):
+    """迁移旧版数据库：为只有原始JSON、尚无 QuakeAsset 规范化记录的目标补建规范化数据。"""
+    cursor = db_conn.cursor()
+    cursor.execute("SELECT DISTINCT target_id FROM QuakeRawData r WHERE NOT EXISTS "
+                   "(SELECT 1 FROM QuakeAsset a WHERE a.target_id = r.target_id)")
+    target_ids = [row[0] for row in cursor.fetchall()]
+    with db_transaction(db_conn):
+        for target_id in target_ids:
+            read_cursor = db_conn.cursor()
+            read_cursor.execute("SELECT scroll_id, query_timestamp, raw_json FROM QuakeRawData WHERE target_id = ?",
+                                (target_id,))
+            for scroll_id, query_timestamp, raw_json in read_cursor:
+                insert_quake_assets(cursor, target_id, scroll_id, query_timestamp,
+                                    iter_parse_results([load_raw_json(raw_json)]))
+    if target_ids:
+        logging.info(f"已为 {len(target_ids)} 个目标从原始JSON补建 QuakeAsset 规范化数据。")
+
+
+def get_quake_cache_state(target_name, db_conn):
+    """
+    返回目标Quake缓存的 (状态, target_id)；无有效缓存时状态为None。
+    旧版数据库中未记录状态的目标：有规范化数据视为 hit，否则视为 empty。
+    """
+    cursor = db_conn.cursor()
+    cursor.execute("SELECT target_id, last_queried_quake, quake_cache_state FROM Targets WHERE target_name = ?",
+                   (target_name,))
+    target_row = cursor.fetchone()
+    if not target_row: return None, None
+    target_id, last_queried_str, cache_state = target_row
+    if not cache_state and last_queried_str:
+        cursor.execute("SELECT 1 FROM QuakeAsset WHERE target_id = ? LIMIT 1", (target_id,))
+        cache_state = CACHE_STATE_HIT if cursor.fetchone() else CACHE_STATE_EMPTY
+    if not cache_state or not is_cache_entry_fresh(cache_state, last_queried_str):
+        return None, target_id
+    if cache_state == CACHE_STATE_HIT:
+        cursor.execute("SELECT 1 FROM QuakeAsset WHERE target_id = ? LIMIT 1", (target_id,))
+        if not cursor.fetchone(): return None, target_id
+    return cache_state, target_id
+
+
+def record_quake_error(target_id, message, db_conn):
+    """记录Quake查询失败 (error 状态)，在错误缓存有效期内不再重复请求。"""
     try:
-        cursor = db_conn.cursor()
-        cursor.execute("SELECT target_id, last_queried_quake FROM Targets WHERE target_name = ?", (target_name,))
-        target_row = cursor.fetchone()
-        if not target_row or not target_row[1]: return None
+        with db_transaction(db_conn):
+            db_conn.execute("UPDATE Targets SET quake_cache_state = ?, quake_last_error = ?, last_queried_quake = ? "
+                            "WHERE target_id = ?", (CACHE_STATE_ERROR, str(message), datetime.datetime.now(), target_id))
+    except sqlite3.Error as e:
+        logging.error(f"记录Quake查询失败状态出错: {e}", exc_info=True)
 
-        target_id, last_queried_str = target_row
-        try:
-            if '.' in last_queried_str:
-                last_queried_dt = datetime.datetime.strptime(last_queried_str, '%Y-%m-%d %H:%M:%S.%f')
-            else:
-                last_queried_dt = datetime.datetime.strptime(last_queried_str, '%Y-%m-%d %H:%M:%S')
-        except ValueError:
-            last_queried_dt = datetime.datetime.fromisoformat(last_queried_str)
 
-        if (datetime.datetime.now() - last_queried_dt).total_seconds() / 3600 >= CACHE_EXPIRY_HOURS:
-            return None
+def get_latest_quake_snapshot(target_id, db_conn):
+    """返回目标最近一次完成的Quake翻页 (快照) ID；旧版数据库没有翻页记录时返回None。"""
+    cursor = db_conn.cursor()
+    cursor.execute("SELECT scroll_id FROM QuakeScrolls WHERE target_id = ? AND status = 'completed' "
+                   "ORDER BY scroll_id DESC LIMIT 1", (target_id,))
+    row = cursor.fetchone()
+    return row[0] if row else None
 
-        cursor.execute("SELECT raw_json FROM QuakeRawData WHERE target_id = ?", (target_id,))
-        cached_rows = cursor.fetchall()
-        if not cached_rows: return None
 
-        raw_json_list = [json.loads(row[0]) for row in cached_rows]
-        parsed_data = parse_results(raw_json_list)
-        cs_console.print(
-            f"    [green]缓存命中:[/green] '{target_name}' 从数据库加载并解析 {len(parsed_data)} 条Quake记录。")
-        return parsed_data
-    except (sqlite3.Error, json.JSONDecodeError, ValueError) as e:
-        logging.error(f"检查Quake缓存时出错 ({target_name}): {e}", exc_info=True)
-        return None
+def iter_quake_snapshot_records(target_id, db_conn):
+    """读取目标最新快照的缓存记录 (历史快照保留在库中，不参与缓存读取)。"""
+    scroll_id = get_latest_quake_snapshot(target_id, db_conn)
+    if scroll_id is None:
+        return iter_quake_cache_records(target_id, db_conn)
+    return iter_quake_cache_records(scroll_id, db_conn, where="scroll_id = ?")
 
 
-def query_all_pages(target_name, db_conn):
-    cs_console.print(f"    [blue]API查询:[/blue] 目标 '{target_name}'，开始通过Quake API获取数据...")
-    headers = {"X-QuakeToken": API_KEY, "Content-Type": "application/json"}
-    query_dsl = QUAKE_QUERY_TEMPLATE.format(target=target_name)
-    all_raw_data = []
-    pagination_id = None
+def iter_quake_cache_records(target_id, db_conn, where="target_id = ?"):
+    """从 QuakeAsset 规范化表逐行读取缓存记录，无需再解码原始JSON。"""
+    cursor = db_conn.cursor()
+    columns = ", ".join(column for column, _ in QUAKE_ASSET_COLUMNS)
+    cursor.execute(f"SELECT {columns} FROM QuakeAsset WHERE {where} ORDER BY asset_id", (target_id,))
+    for row in cursor:
+        yield quake_asset_row_to_record(row)
 
-    try:
-        while True:
-            params = {"query": query_dsl, "size": BATCH_SIZE, "ignore_cache": False, "latest": True}
-            if pagination_id:
-                params["pagination_id"] = pagination_id
 
-            response = requests.post(f"{BASE_URL}/scroll/quake_service", headers=headers, json=params, timeout=30)
-            response.raise_for_status()
-            result = response.json()
+def start_quake_scroll(target_id, query_dsl, db_conn):
+    """
+    开始一次全新的Quake翻页：清理该目标未完成翻页的数据，并创建翻页检查点记录。
+    已完成的翻页作为历史快照保留，由缓存清理 (--cache-gc) 按 CACHE_KEEP_SNAPSHOTS 淘汰。
+    """
+    cursor = db_conn.cursor()
+    now = datetime.datetime.now()
+    with db_transaction(db_conn):
+        cursor.execute("UPDATE QuakeScrolls SET status = 'abandoned', updated_at = ? WHERE target_id = ? AND status = 'running'",
+                       (now, target_id))
+        for table in ("QuakeRawData", "QuakeAsset"):
+            cursor.execute(f"DELETE FROM {table} WHERE scroll_id IN (SELECT scroll_id FROM QuakeScrolls "
+                           f"WHERE target_id = ? AND status = 'abandoned')", (target_id,))
+        # 翻页完成前缓存视为无效，避免中途读取到不完整的数据
+        cursor.execute("UPDATE Targets SET last_queried_quake = NULL, quake_cache_state = NULL WHERE target_id = ?",
+                       (target_id,))
+        cursor.execute("INSERT INTO QuakeScrolls (target_id, query_dsl, status, started_at, updated_at) "
+                       "VALUES (?, ?, 'running', ?, ?)", (target_id, query_dsl, now, now))
+    return cursor.lastrowid
+
+
+def find_resumable_quake_scroll(target_id, query_dsl, db_conn):
+    """查找同一查询语句下未完成且仍在缓存有效期内的翻页检查点。"""
+    cursor = db_conn.cursor()
+    cursor.execute(
+        "SELECT scroll_id, pagination_id, pages_fetched, records_fetched, started_at FROM QuakeScrolls "
+        "WHERE target_id = ? AND query_dsl = ? AND status = 'running' AND pagination_id IS NOT NULL "
+        "ORDER BY scroll_id DESC LIMIT 1", (target_id, query_dsl))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    if (datetime.datetime.now() - parse_db_timestamp(row[4])).total_seconds() / 3600 >= CACHE_EXPIRY_HOURS:
+        return None
+    return row[:4]
 
-            if result.get("code") != 0:
-                cs_console.print(f"[bold red]Error:[/bold red] Quake API 查询失败: {result.get('message')}")
-                return None  # API返回明确错误，直接返回None
 
-            current_batch = result.get("data", [])
+def save_quake_page(scroll_id, target_id, page_items, next_pagination_id, db_conn):
+    """
+    在同一事务中写入一页数据并推进翻页检查点，返回该页的解析结果。
+    - 入库时即解析并写入 QuakeAsset 规范化表，后续缓存读取无需再解码JSON。
+    - 原始JSON仅在 STORE_QUAKE_RAW_JSON 开启时保存。
+    """
+    timestamp = datetime.datetime.now()
+    parsed_page = parse_results(page_items)
+    with db_transaction(db_conn):
+        cursor = db_conn.cursor()
+        insert_quake_assets(cursor, target_id, scroll_id, timestamp, parsed_page)
+        if STORE_QUAKE_RAW_JSON:
+            cursor.executemany(
+                "INSERT INTO QuakeRawData (target_id, query_timestamp, raw_json, scroll_id) VALUES (?, ?, ?, ?)",
+                [(target_id, timestamp, encode_raw_json(item), scroll_id) for item in page_items])
+        cursor.execute(
+            "UPDATE QuakeScrolls SET pagination_id = ?, pages_fetched = pages_fetched + 1, "
+            "records_fetched = records_fetched + ?, updated_at = ? WHERE scroll_id = ?",
+            (next_pagination_id, len(page_items), timestamp, scroll_id))
+    return parsed_page
+
 
-            # --- 最终的、最可靠的终止条件 ---
-            # 如果API返回的数据批次为空，说明已经取完所有数据，这是唯一需要依赖的判断。
-            if not current_batch:
-                break  # 正常取完所有数据，退出循环
+def finish_quake_scroll(scroll_id, target_id, db_conn, record_count):
+    cursor = db_conn.cursor()
+    timestamp = datetime.datetime.now()
+    cache_state = CACHE_STATE_HIT if record_count else CACHE_STATE_EMPTY
+    with db_transaction(db_conn):
+        cursor.execute("UPDATE QuakeScrolls SET status = 'completed', updated_at = ? WHERE scroll_id = ?",
+                       (timestamp, scroll_id))
+        cursor.execute("UPDATE Targets SET last_queried_quake = ?, quake_cache_state = ?, quake_last_error = NULL "
+                       "WHERE target_id = ?", (timestamp, cache_state, target_id))
 
-            # 只有在有数据的情况下，才处理数据和更新翻页ID
-            all_raw_data.extend(current_batch)
-            pagination_id = result.get("meta", {}).get("pagination_id")
 
-            # 如果Quake在有数据的情况下不返回下一个翻页ID，也视为结束（保险措施）
-            if not pagination_id:
-                break
+def iter_quake_api_records(target_name, db_conn):
+    """
+    (流式 + 可断点续传版) 通过Quake scroll接口翻页获取数据，逐页解析并产出记录。
+    - 每页数据到达后立即入库，并在 QuakeScrolls 中记录 pagination_id 检查点。
+    - 开启 --resume 时，从上次中断的检查点继续翻页；检查点失效则自动重新开始。
+    - 查询失败时抛出 QuakeQueryError (已入库的页保留，可通过 --resume 续传)。
+    - 记录数统一按API返回的原始条目计数 (与 QuakeScrolls.records_fetched 一致)，续传时从检查点的计数继续累加。
+    """
+    cs_console.print(f"    [blue]API查询:[/blue] 目标 '{target_name}'，开始通过Quake API获取数据...")
+    headers = {"X-QuakeToken": API_KEY, "Content-Type": "application/json"}
+    query_dsl = QUAKE_QUERY_TEMPLATE.format(target=target_name)
 
-            time.sleep(DELAY)
+    target_id = get_target_id_from_db(target_name, db_conn)
+    if not target_id:
+        raise QuakeQueryError(f"无法获取目标 '{target_name}' 的 target_id")
 
-        # 循环结束后的处理逻辑
-        cs_console.print(f"    [green]API查询成功:[/green] 共获取 {len(all_raw_data)} 条原始记录。")
+    scroll = find_resumable_quake_scroll(target_id, query_dsl, db_conn) if QUAKE_RESUME else None
+    if scroll:
+        scroll_id, pagination_id, pages_fetched, records_fetched = scroll
+        cs_console.print(f"    [green]断点续传:[/green] 已有 {pages_fetched} 页 ({records_fetched} 条) 数据，从检查点继续翻页。")
+    else:
+        scroll_id, pagination_id, records_fetched = start_quake_scroll(target_id, query_dsl, db_conn), None, 0
+    resuming = scroll is not None
+    record_count = records_fetched
 
-        # --- 后续数据库操作 ---
-        cursor = db_conn.cursor()
-        timestamp = datetime.datetime.now()
-        target_id = get_target_id_from_db(target_name, db_conn)
-        if not target_id: return None
+    while True:
+        params = {"query": query_dsl, "size": BATCH_SIZE, "ignore_cache": False, "latest": True}
+        if pagination_id:
+            params["pagination_id"] = pagination_id
 
-        cursor.execute("DELETE FROM QuakeRawData WHERE target_id = ?", (target_id,))
-        if all_raw_data:
-            data_to_insert = [(target_id, timestamp, json.dumps(item, ensure_ascii=False)) for item in all_raw_data]
-            cursor.executemany("INSERT INTO QuakeRawData (target_id, query_timestamp, raw_json) VALUES (?, ?, ?)",
-                               data_to_insert)
+        try:
+            response = get_provider_client("quake").post(f"{BASE_URL}/scroll/quake_service", headers=headers,
+                                                         json=params)
+            response.raise_for_status()
+            result = response.json()
+        except requests.exceptions.RequestException as e:
+            cs_console.print(f"[bold red]Error:[/bold red] Quake API 请求异常: {e}")
+            record_quake_error(target_id, e, db_conn)
+            raise QuakeQueryError(str(e)) from e
+
+        if result.get("code") != 0:
+            if resuming:
+                # 检查点中的 pagination_id 可能已在服务端过期，放弃续传并重新开始
+                logging.warning(f"Quake 续传失败 ({target_name}): {result.get('message')}，将重新开始翻页。")
+                cs_console.print(f"    [yellow]Warning:[/yellow] 翻页检查点已失效，重新开始查询。")
+                scroll_id, pagination_id, resuming = start_quake_scroll(target_id, query_dsl, db_conn), None, False
+                record_count = 0
+                continue
+            cs_console.print(f"[bold red]Error:[/bold red] Quake API 查询失败: {result.get('message')}")
+            record_quake_error(target_id, result.get("message"), db_conn)
+            raise QuakeQueryError(result.get("message"))
+        if resuming:
+            # 续传确认有效后，先产出检查点之前已入库的记录
+            yield from iter_quake_cache_records(scroll_id, db_conn, where="scroll_id = ?")
+            resuming = False
+
+        current_batch = result.get("data", [])
+
+        # --- 最终的、最可靠的终止条件 ---
+        # 如果API返回的数据批次为空，说明已经取完所有数据，这是唯一需要依赖的判断。
+        if not current_batch:
+            break  # 正常取完所有数据，退出循环
+
+        # 只有在有数据的情况下，才处理数据和更新翻页ID；当前页立即入库并记录检查点
+        pagination_id = result.get("meta", {}).get("pagination_id")
+        parsed_page = save_quake_page(scroll_id, target_id, current_batch, pagination_id, db_conn)
+        record_count += len(current_batch)
+        del current_batch, result
+        yield from parsed_page
+
+        # 如果Quake在有数据的情况下不返回下一个翻页ID，也视为结束（保险措施）
+        if not pagination_id:
+            break
 
-        cursor.execute("UPDATE Targets SET last_queried_quake = ? WHERE target_id = ?", (timestamp, target_id))
-        db_conn.commit()
-        return parse_results(all_raw_data)
+    finish_quake_scroll(scroll_id, target_id, db_conn, record_count)
+    cs_console.print(f"    [green]API查询成功:[/green] 共获取 {record_count} 条原始记录。")
 
-    except requests.exceptions.RequestException as e:
-        cs_console.print(f"[bold red]Error:[/bold red] Quake API 请求异常: {e}")
-        return None
-    except Exception as e:
-        logging.error(f"Quake API处理中发生未知异常 ({target_name}): {e}", exc_info=True)
-        return None
+
+def open_quake_record_stream(target_name, db_conn):
+    """优先使用有效缓存，否则走实时API；返回逐条产出解析后记录的迭代器。"""
+    try:
+        cache_state, target_id = get_quake_cache_state(target_name, db_conn)
+    except (sqlite3.Error, ValueError) as e:
+        logging.error(f"检查Quake缓存时出错 ({target_name}): {e}", exc_info=True)
+        cache_state, target_id = None, None
+    if cache_state == CACHE_STATE_HIT:
+        cs_console.print(f"    [green]缓存命中:[/green] '{target_name}' 从数据库流式加载Quake记录。")
+        return iter_quake_snapshot_records(target_id, db_conn)
+    if cache_state == CACHE_STATE_EMPTY:
+        cs_console.print(f"    [green]缓存命中:[/green] '{target_name}' 近期查询无结果 (空结果缓存有效期内)，跳过API查询。")
+        return iter(())
+    if cache_state == CACHE_STATE_ERROR and not QUAKE_RESUME:
+        cs_console.print(f"    [yellow]INFO:[/yellow] '{target_name}' 近期查询失败 (错误缓存有效期内)，跳过API查询。")
+        raise QuakeQueryError("近期查询失败，错误缓存有效期内跳过")
+    cs_console.print(f"    [blue]INFO:[/blue] 无有效缓存，执行实时API查询...")
+    return iter_quake_api_records(target_name, db_conn)
 
 
 def parse_results(raw_data_list_objs):
+    return list(iter_parse_results(raw_data_list_objs))
+
+
+def iter_parse_results(raw_data_list_objs):
     """
-    (双协议URL优化版) 解析Quake数据。
+    (双协议URL优化 + 流式版) 逐条解析Quake数据。
     - 手动拼接URL时，会同时生成http和https两个版本。
     - 在内部用 scan_urls 键存储所有待扫描的URL，保持主URL字段整洁。
     """
-    parsed_results = []
     for raw_data_obj in raw_data_list_objs:
         service_info = raw_data_obj.get("service", {})
         http_info = service_info.get("http", {})
@@ -309,8 +1248,7 @@ def parse_results(raw_data_list_objs):
             "备案单位类型": main_icp.get("nature", ""), "时间": raw_data_obj.get("time", ""),
             "归属省份": location_info.get("province_cn", "")
         }
-        parsed_results.append(parsed)
-    return parsed_results
+        yield parsed
 
 
 def identify_shared_service_ips(raw_quake_data_list):
@@ -364,114 +1302,263 @@ def identify_shared_service_ips(raw_quake_data_list):
     return list(clean_ips), list(shared_service_ips)
 
 
-def check_and_get_fofa_cache(target_id, db_conn):
-    try:
-        cursor = db_conn.cursor()
-        cursor.execute("SELECT last_queried_fofa FROM Targets WHERE target_id = ?", (target_id,))
-        target_row = cursor.fetchone()
-        if not target_row or not target_row[0]: return None
-        last_queried_fofa_str = target_row[0]
+FOFA_FIELDS = ["host", "ip", "port", "protocol", "title", "server", "icp", "domain", "link"]
+
+
+def backfill_fofa_ip_cache(db_conn):
+    """迁移旧版数据库：从历史 FofaRawData 按IP补建 FofaIPCache (新记录覆盖旧记录)。"""
+    cursor = db_conn.cursor()
+    cursor.execute("SELECT 1 FROM FofaIPCache LIMIT 1")
+    if cursor.fetchone(): return
+    cursor.execute("SELECT fr.fofa_run_id, fr.run_timestamp, d.raw_json FROM FofaRuns fr JOIN FofaRawData d "
+                   "ON d.fofa_run_id = fr.fofa_run_id WHERE fr.status LIKE 'completed%' "
+                   "ORDER BY fr.run_timestamp, d.fofa_data_id")
+    results_by_ip = {}
+    for fofa_run_id, run_timestamp, raw_json in cursor.fetchall():
+        for item in load_raw_json(raw_json, []):
+            if isinstance(item, list) and len(item) == len(FOFA_FIELDS) and item[1]:
+                entry = results_by_ip.get(item[1])
+                if entry is None or entry[1] != fofa_run_id:
+                    entry = results_by_ip[item[1]] = (run_timestamp, fofa_run_id, [])
+                entry[2].append(item)
+    if results_by_ip:
+        with db_transaction(db_conn):
+            cursor.executemany("INSERT OR REPLACE INTO FofaIPCache (ip, query_timestamp, fofa_run_id, result_count, "
+                               "raw_json) VALUES (?, ?, ?, ?, ?)",
+                               [(ip, ts, run_id, len(items), encode_raw_json(items, use_dict=False))
+                                for ip, (ts, run_id, items) in results_by_ip.items()])
+        logging.info(f"已从历史Fofa运行记录补建 {len(results_by_ip)} 个IP的 FofaIPCache 缓存。")
+
+
+def load_fofa_ip_cache(ip_list, db_conn):
+    """
+    按IP查询有效期内的Fofa缓存，返回 ({ip: [原始结果, ...]}, 近期查询失败的IP集合)。
+    - hit/empty 记录按各自有效期返回 (查询过但无结果的IP对应空列表)。
+    - error 记录在错误有效期内跳过查询，过期后重新查询。
+    """
+    cached, recent_error_ips, cursor = {}, set(), db_conn.cursor()
+    for i in range(0, len(ip_list), 500):
+        chunk = ip_list[i:i + 500]
         try:
-            if '.' in last_queried_fofa_str:
-                last_queried_dt = datetime.datetime.strptime(last_queried_fofa_str, '%Y-%m-%d %H:%M:%S.%f')
-            else:
-                last_queried_dt = datetime.datetime.strptime(last_queried_fofa_str, '%Y-%m-%d %H:%M:%S')
-        except ValueError:
-            last_queried_dt = datetime.datetime.fromisoformat(last_queried_fofa_str)
-        if (datetime.datetime.now() - last_queried_dt).total_seconds() / 3600 >= CACHE_EXPIRY_HOURS: return None
-        cursor.execute(
-            "SELECT fr.fofa_run_id FROM FofaRuns fr WHERE fr.target_id = ? AND fr.status = 'completed' ORDER BY fr.run_timestamp DESC LIMIT 1",
-            (target_id,))
-        fofa_run_row = cursor.fetchone()
-        if not fofa_run_row: return None
-        fofa_run_id = fofa_run_row[0]
-        cursor.execute("SELECT raw_json FROM FofaRawData WHERE fofa_run_id = ?", (fofa_run_id,))
-        cached_rows = cursor.fetchall()
-        if not cached_rows: return None
-        raw_results_from_cache = [item for row in cached_rows for item in json.loads(row[0])]
-        parsed_data = parse_fofa_results(raw_results_from_cache)
-        cs_console.print(f"    [green]Fofa缓存命中:[/green] 从数据库加载并解析 {len(parsed_data)} 条Fofa记录。")
-        return parsed_data
-    except (sqlite3.Error, json.JSONDecodeError, ValueError) as e:
-        logging.error(f"检查Fofa缓存时出错 (ID: {target_id}): {e}", exc_info=True)
-        return None
+            cursor.execute(f"SELECT ip, query_timestamp, result_count, cache_state, raw_json FROM FofaIPCache WHERE ip IN "
+                           f"({','.join('?' * len(chunk))})", chunk)
+            rows = cursor.fetchall()
+        except sqlite3.Error as e:
+            logging.error(f"读取Fofa IP缓存时出错: {e}", exc_info=True)
+            continue
+        for ip, query_timestamp, result_count, cache_state, raw_json in rows:
+            cache_state = cache_state or (CACHE_STATE_HIT if result_count else CACHE_STATE_EMPTY)
+            if not is_cache_entry_fresh(cache_state, query_timestamp):
+                continue
+            if cache_state == CACHE_STATE_ERROR:
+                recent_error_ips.add(ip)
+                continue
+            # 单条缓存损坏只当作该IP未命中，不影响其他IP
+            try:
+                cached[ip] = load_raw_json(raw_json, [])
+            except (json.JSONDecodeError, ValueError, zlib.error, RuntimeError) as e:
+                logging.error(f"读取Fofa IP缓存时出错 ({ip}): {e}")
+    return cached, recent_error_ips
+
+
+def save_fofa_chunk_to_cache(cursor, fofa_run_id, chunk_ips, chunk_results):
+    """
+    将一个查询批次的结果按IP写入 FofaIPCache；批次内无结果的IP记录为 empty 状态，避免重复查询。
+    CIDR 查询带回的网段内其他IP (非待查IP) 的结果不写入缓存。
+    """
+    results_by_ip = {ip: [] for ip in chunk_ips}
+    for item in chunk_results:
+        if isinstance(item, list) and len(item) == len(FOFA_FIELDS) and item[1] in results_by_ip:
+            results_by_ip[item[1]].append(item)
+    now = datetime.datetime.now()
+    cursor.executemany(
+        "INSERT OR REPLACE INTO FofaIPCache (ip, query_timestamp, fofa_run_id, result_count, cache_state, raw_json) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        [(ip, now, fofa_run_id, len(items), CACHE_STATE_HIT if items else CACHE_STATE_EMPTY,
+          encode_raw_json(items, use_dict=False)) for ip, items in results_by_ip.items()])
+
+
+def save_fofa_chunk_error(cursor, fofa_run_id, chunk_ips):
+    """记录失败批次的IP为 error 状态；已有 hit/empty 记录 (即使过期) 的IP保留原数据，不被错误覆盖。"""
+    cursor.executemany(
+        "INSERT INTO FofaIPCache (ip, query_timestamp, fofa_run_id, result_count, cache_state, raw_json) "
+        "VALUES (?, ?, ?, 0, ?, '[]') ON CONFLICT(ip) DO UPDATE SET query_timestamp = excluded.query_timestamp, "
+        "fofa_run_id = excluded.fofa_run_id WHERE FofaIPCache.cache_state = ?",
+        [(ip, datetime.datetime.now(), fofa_run_id, CACHE_STATE_ERROR, CACHE_STATE_ERROR) for ip in chunk_ips])
 
 
 def query_fofa_by_ips(ip_list, target_id, db_conn):
+    """
+    (增量 + 并发版) 仅对缺失或已过期缓存的IP调用Fofa API，其余IP直接使用 FofaIPCache。
+    - 待查IP按查询长度自适应打包 (聚集的 /24 网段使用CIDR语法)，各批次并发执行，速率由 fofa 令牌桶控制。
+    - 每个批次的状态记录在 FofaRunChunks；单个批次失败不影响其他批次，失败批次在本次运行内单独重试。
+    - 每个批次完成后立即按IP写入缓存，返回 (本次目标全部IP的原始结果列表, fofa_run_id)。
+    - 只有全部IP都得到 hit/empty 结果时才更新目标的 last_queried_fofa (近期失败而跳过的IP不算查询成功)，
+      自查报告据此列出Fofa反查结果完整的目标。
+    """
     if not ip_list: return [], None
+    cached_results, recent_error_ips = load_fofa_ip_cache(ip_list, db_conn)
+    missing_ips = [ip for ip in ip_list if ip not in cached_results and ip not in recent_error_ips]
+    all_fofa_raw_results = [item for ip in ip_list for item in cached_results.get(ip, [])]
+    if cached_results or recent_error_ips:
+        cs_console.print(f"    [green]Fofa缓存命中:[/green] {len(cached_results)}/{len(ip_list)} 个IP使用缓存 "
+                         f"({len(all_fofa_raw_results)} 条记录)，{len(missing_ips)} 个IP需要查询。")
+    if recent_error_ips:
+        cs_console.print(f"      - [dim]{len(recent_error_ips)} 个IP近期查询失败 (错误缓存有效期内)，本次跳过。[/dim]")
+    if not missing_ips:
+        if recent_error_ips: return all_fofa_raw_results, None
+        try:
+            with db_transaction(db_conn):
+                db_conn.execute("UPDATE Targets SET last_queried_fofa = ? WHERE target_id = ?",
+                                (datetime.datetime.now(), target_id))
+        except sqlite3.Error as e:
+            logging.error(f"Fofa: 更新数据库失败: {e}", exc_info=True)
+        return all_fofa_raw_results, None
+
     fofa_run_id = None
     try:
-        cursor = db_conn.cursor()
-        cursor.execute("INSERT INTO FofaRuns (target_id, run_timestamp, status, input_ip_count) VALUES (?, ?, ?, ?)",
-                       (target_id, datetime.datetime.now(), 'running', len(ip_list)))
-        db_conn.commit()
-        fofa_run_id = cursor.lastrowid
+        with db_transaction(db_conn):
+            cursor = db_conn.cursor()
+            cursor.execute("INSERT INTO FofaRuns (target_id, run_timestamp, status, input_ip_count) VALUES (?, ?, ?, ?)",
+                           (target_id, datetime.datetime.now(), 'running', len(missing_ips)))
+            fofa_run_id = cursor.lastrowid
+            chunks = []
+            for chunk_index, (query_str, chunk_ips) in enumerate(pack_fofa_queries(missing_ips), 1):
+                cursor.execute("INSERT INTO FofaRunChunks (fofa_run_id, chunk_index, query_str, ip_list, updated_at) "
+                               "VALUES (?, ?, ?, ?, ?)", (fofa_run_id, chunk_index, query_str, json.dumps(chunk_ips),
+                                                          datetime.datetime.now()))
+                chunks.append({"chunk_id": cursor.lastrowid, "index": chunk_index, "query": query_str, "ips": chunk_ips})
     except sqlite3.Error as e:
         logging.error(f"Fofa: 创建FofaRuns记录失败: {e}", exc_info=True)
-        return [], None
-    all_fofa_raw_results = []
-    api_call_overall_successful = True
-    ip_chunks = [ip_list[i:i + 100] for i in range(0, len(ip_list), 100)]
-    cs_console.print(f"    [blue]执行:[/blue] 开始从Fofa API获取数据 (共 {len(ip_chunks)} 个查询批次)...")
-    for index, chunk in enumerate(ip_chunks, 1):
-        if not api_call_overall_successful: break
-        cs_console.print(f"      [dim]正在查询批次 ({index}/{len(ip_chunks)})...[/dim]")
-        query_str = " || ".join([f'ip="{ip}"' for ip in chunk])
-        qbase64 = base64.b64encode(query_str.encode('utf-8')).decode('utf-8')
-        next_id = None
-        while True:
-            try:
-                fields = "host,ip,port,protocol,title,server,icp,domain,link"
-                api_url = f"{FOFA_BASE_URL}/api/v1/search/next?email={FOFA_EMAIL}&key={FOFA_KEY}&qbase64={qbase64}&fields={fields}&size=2000"
-                if next_id: api_url += f"&next={next_id}"
-                response = requests.get(api_url, timeout=30)
-                response.raise_for_status()
-                result = response.json()
-                if result.get("error"):
-                    cs_console.print(f"    [bold red]Error (批次 {index}):[/bold red] Fofa API: {result.get('errmsg')}")
-                    api_call_overall_successful = False;
-                    break
-                batch_results = result.get("results", [])
-                if batch_results: all_fofa_raw_results.extend(batch_results)
-                next_id = result.get("next")
-                if not next_id: break
-                time.sleep(DELAY)
-            except requests.exceptions.RequestException as e:
-                cs_console.print(f"    [bold red]Error (批次 {index}):[/bold red] Fofa API请求异常: {e}")
-                api_call_overall_successful = False;
-                break
-    if api_call_overall_successful:
-        cs_console.print(f"      [green]Success:[/green] Fofa查询完成，共获取 {len(all_fofa_raw_results)} 条记录。")
-    final_status = 'failed'
-    if api_call_overall_successful:
-        if all_fofa_raw_results:
-            try:
-                cursor = db_conn.cursor()
-                data_chunks = [all_fofa_raw_results[i:i + 100] for i in range(0, len(all_fofa_raw_results), 100)]
-                data_to_insert = [(fofa_run_id, json.dumps(chunk, ensure_ascii=False)) for chunk in data_chunks]
-                cursor.executemany("INSERT INTO FofaRawData (fofa_run_id, raw_json) VALUES (?, ?)", data_to_insert)
-                final_status = 'completed'
-            except sqlite3.Error:
-                final_status = 'completed_with_errors'
-        else:
-            final_status = 'completed'
+        return all_fofa_raw_results, None
+
+    found_count, failed_chunks = 0, chunks
+    cs_console.print(f"    [blue]执行:[/blue] 开始从Fofa API获取数据 ({len(missing_ips)} 个IP打包为 {len(chunks)} 个查询批次，"
+                     f"并发 {FOFA_CONCURRENCY})...")
+    for attempt in range(1 + max(0, FOFA_CHUNK_RETRIES)):
+        if not failed_chunks: break
+        if attempt:
+            cs_console.print(f"      [yellow]重试:[/yellow] 单独重试 {len(failed_chunks)} 个失败批次 (第 {attempt} 次)...")
+        pending_chunks, failed_chunks = failed_chunks, []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, FOFA_CONCURRENCY),
+                                                   thread_name_prefix="fofa-chunk") as pool:
+            futures = {pool.submit(fetch_fofa_chunk, chunk["query"]): chunk for chunk in pending_chunks}
+            # 结果在主线程中逐批写库，避免多线程共用同一个sqlite连接
+            for future in concurrent.futures.as_completed(futures):
+                chunk = futures[future]
+                chunk_results, error = future.result()
+                status = 'failed' if error else 'completed'
+                # CIDR 查询会带回网段内其他IP的结果，只保留本批次待查的IP
+                chunk_ips = set(chunk["ips"])
+                target_results = [item for item in chunk_results if
+                                  isinstance(item, list) and len(item) > 1 and item[1] in chunk_ips]
+                try:
+                    with db_transaction(db_conn):
+                        cursor = db_conn.cursor()
+                        if not error:
+                            save_fofa_chunk_to_cache(cursor, fofa_run_id, chunk["ips"], chunk_results)
+                        elif attempt == max(0, FOFA_CHUNK_RETRIES):
+                            save_fofa_chunk_error(cursor, fofa_run_id, chunk["ips"])
+                        cursor.execute("UPDATE FofaRunChunks SET status = ?, attempts = attempts + 1, result_count = ?, "
+                                       "error = ?, updated_at = ? WHERE chunk_id = ?",
+                                       (status, len(target_results), error, datetime.datetime.now(), chunk["chunk_id"]))
+                except sqlite3.Error as e:
+                    logging.error(f"Fofa: 写入批次结果失败 (批次 {chunk['index']}): {e}", exc_info=True)
+                if error:
+                    cs_console.print(f"    [bold red]Error (批次 {chunk['index']}):[/bold red] {error}")
+                    failed_chunks.append(chunk)
+                    continue
+                all_fofa_raw_results.extend(target_results)
+                found_count += len(target_results)
+                cs_console.print(f"      [dim]批次 ({chunk['index']}/{len(chunks)}) 完成，获取 {len(target_results)} 条记录。[/dim]")
+
+    if not failed_chunks:
+        final_status = 'completed'
+        cs_console.print(f"      [green]Success:[/green] Fofa查询完成，新获取 {found_count} 条记录。")
+    else:
+        final_status = 'partial' if len(failed_chunks) < len(chunks) else 'failed'
+        cs_console.print(f"      [yellow]Warning:[/yellow] {len(failed_chunks)}/{len(chunks)} 个Fofa批次失败，"
+                         f"其IP已记为查询失败 (已有过期缓存的IP除外)，"
+                         f"在错误缓存有效期 ({ERROR_CACHE_EXPIRY_HOURS} 小时) 内不再重复查询。")
     try:
-        cursor = db_conn.cursor()
-        cursor.execute("UPDATE FofaRuns SET status = ?, found_results_count = ? WHERE fofa_run_id = ?",
-                       (final_status, len(all_fofa_raw_results), fofa_run_id))
-        if final_status.startswith('completed'):
-            cursor.execute("UPDATE Targets SET last_queried_fofa = ? WHERE target_id = ?",
-                           (datetime.datetime.now(), target_id))
-        db_conn.commit()
+        with db_transaction(db_conn):
+            cursor = db_conn.cursor()
+            cursor.execute("UPDATE FofaRuns SET status = ?, found_results_count = ? WHERE fofa_run_id = ?",
+                           (final_status, found_count, fofa_run_id))
+            if final_status == 'completed' and not recent_error_ips:
+                cursor.execute("UPDATE Targets SET last_queried_fofa = ? WHERE target_id = ?",
+                               (datetime.datetime.now(), target_id))
     except sqlite3.Error as e:
         logging.error(f"Fofa: 更新数据库失败: {e}", exc_info=True)
-        db_conn.rollback()
     return all_fofa_raw_results, fofa_run_id
 
 
+def pack_fofa_queries(ip_list, max_query_length=None, cidr_min_ips=None):
+    """
+    将IP列表打包为尽量少的Fofa查询语句，返回 [(查询语句, 该语句覆盖的IP列表), ...]。
+    - 同一 /24 网段内IP数达到 cidr_min_ips 时使用 ip="a.b.c.0/24" 一次覆盖整个网段 (cidr_min_ips 为 0 时不使用)。
+      网段查询会返回并计入网段内非待查IP的结果，调用方需按待查IP过滤。
+    - 其余IP逐个以 ip="x" 拼接，单条语句长度不超过 max_query_length。
+    """
+    max_query_length = max_query_length or FOFA_MAX_QUERY_LENGTH
+    cidr_min_ips = FOFA_CIDR_MIN_IPS if cidr_min_ips is None else cidr_min_ips
+    ips_by_network = defaultdict(list)
+    for ip in ip_list:
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            ips_by_network[ip].append(ip)
+            continue
+        network = ipaddress.ip_network(f"{address}/24", strict=False) if address.version == 4 else ip
+        ips_by_network[str(network)].append(ip)
+
+    clauses = []
+    for network, ips in ips_by_network.items():
+        if 0 < cidr_min_ips <= len(ips) and network not in ips:
+            clauses.append((f'ip="{network}"', ips))
+        else:
+            clauses.extend((f'ip="{ip}"', [ip]) for ip in ips)
+
+    packed, current_clauses, current_ips, current_length = [], [], [], 0
+    for clause, ips in clauses:
+        added_length = len(clause) + (4 if current_clauses else 0)
+        if current_clauses and current_length + added_length > max_query_length:
+            packed.append((" || ".join(current_clauses), current_ips))
+            current_clauses, current_ips, current_length, added_length = [], [], 0, len(clause)
+        current_clauses.append(clause)
+        current_ips.extend(ips)
+        current_length += added_length
+    if current_clauses:
+        packed.append((" || ".join(current_clauses), current_ips))
+    return packed
+
+
+def fetch_fofa_chunk(query_str):
+    """执行一个Fofa查询批次 (含翻页)，返回 (结果列表, 错误信息)；成功时错误信息为None。"""
+    qbase64 = base64.b64encode(query_str.encode('utf-8')).decode('utf-8')
+    fields = ",".join(FOFA_FIELDS)
+    chunk_results, next_id = [], None
+    while True:
+        api_url = f"{FOFA_BASE_URL}/api/v1/search/next?email={FOFA_EMAIL}&key={FOFA_KEY}&qbase64={qbase64}&fields={fields}&size=2000"
+        if next_id: api_url += f"&next={next_id}"
+        try:
+            response = get_provider_client("fofa").get(api_url)
+            response.raise_for_status()
+            result = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logging.error(f"Fofa API请求异常: {e}", exc_info=True)
+            return chunk_results, f"Fofa API请求异常: {e}"
+        if result.get("error"):
+            return chunk_results, f"Fofa API: {result.get('errmsg')}"
+        chunk_results.extend(result.get("results", []) or [])
+        next_id = result.get("next")
+        if not next_id:
+            return chunk_results, None
+
+
 def parse_fofa_results(fofa_raw_data_list):
     parsed_results = []
-    fields_order = ["host", "ip", "port", "protocol", "title", "server", "icp", "domain", "link"]
+    fields_order = FOFA_FIELDS
     for item_list in fofa_raw_data_list:
         if not isinstance(item_list, list) or len(item_list) != len(fields_order): continue
         fofa_item = dict(zip(fields_order, item_list))
@@ -496,63 +1583,164 @@ def parse_fofa_results(fofa_raw_data_list):
     return parsed_results
 
 
+class WerplusQueryError(Exception):
+    """wer.plus 返回非成功状态码 (如Key无效、额度用尽)。"""
+
+
+def _fetch_icpb_page(company_name, app_type, page):
+    """获取一页 wer.plus 备案查询结果，返回 (本页列表, 总数)；请求失败或接口报错时抛出异常。"""
+    params = {'key': WERPLUS_API_KEY, 't': company_name, 'page': page, 'pagesize': 40, 'apptype': app_type}
+    response = get_provider_client("werplus").get("https://api2.wer.plus/api/icpb", params=params)
+    response.raise_for_status()
+    data = response.json()
+    if data.get("code") != 200:
+        raise WerplusQueryError(f"code={data.get('code')}, msg={data.get('msg') or data.get('message')}")
+    if data.get("data"):
+        return data["data"].get("list", []) or [], data["data"].get("total", 0) or 0
+    return [], 0
+
+
 def _fetch_icpb_data(company_name, app_type):
-    api_url = "https://api2.wer.plus/api/icpb"
-    all_results, page = [], 1
-    while True:
-        params = {'key': WERPLUS_API_KEY, 't': company_name, 'page': page, 'pagesize': 40, 'apptype': app_type}
+    """
+    (分页并发版) 先取第一页得到总数，其余分页并发获取。
+    返回 (结果列表, 是否完整)；任一分页请求失败时结果不完整，不应写入缓存。
+    """
+    try:
+        all_results, total = _fetch_icpb_page(company_name, app_type, 1)
+    except (requests.exceptions.RequestException, ValueError, WerplusQueryError) as e:
+        logging.error(f"wer.plus 查询失败 ({company_name}, {app_type}): {e}")
+        return [], False
+    if not all_results or len(all_results) >= total:
+        return all_results, True
+
+    page_size = len(all_results)
+    remaining_pages = range(2, -(-total // page_size) + 1)
+    complete = True
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, WERPLUS_PAGE_CONCURRENCY),
+                                               thread_name_prefix="werplus-page") as pool:
+        pages = pool.map(lambda page: _fetch_icpb_page(company_name, app_type, page), remaining_pages)
         try:
-            response = requests.get(api_url, params=params, timeout=20)
-            response.raise_for_status()
-            data = response.json()
-            if data.get("code") == 200 and data.get("data"):
-                current_page_results = data["data"].get("list", [])
-                if not current_page_results: break
-                all_results.extend(current_page_results)
-                if len(all_results) >= data['data'].get('total', 0): break
-                page += 1
-            else:
-                break
-        except requests.exceptions.RequestException:
-            break
-    return all_results
+            for page_results, _ in pages:
+                if not page_results: break
+                all_results.extend(page_results)
+        except (requests.exceptions.RequestException, ValueError, WerplusQueryError) as e:
+            logging.error(f"wer.plus 分页查询失败 ({company_name}, {app_type}): {e}")
+            complete = False
+    return all_results, complete
 
 
-def check_and_get_app_cache(company_name, db_conn):
+def check_and_get_app_cache(company_name, app_type, db_conn, include_stale=False):
+    """
+    按 (公司, 类型) 查询APP/小程序缓存，返回 (状态, 结果列表)；无可用缓存时返回 (None, None)。
+    - include_stale=True 时忽略有效期返回 hit/empty 记录，用于接口失败时回退到旧数据。
+    """
     try:
         cursor = db_conn.cursor()
-        cursor.execute(
-            "SELECT last_queried, raw_json_apps, raw_json_miniprograms FROM CompanyAppCache WHERE company_name = ?",
-            (company_name,))
+        cursor.execute("SELECT last_queried, cache_state, raw_json FROM CompanyAppTypeCache "
+                       "WHERE company_name = ? AND app_type = ?", (company_name, app_type))
         row = cursor.fetchone()
-        if not row: return None
-        last_queried_dt = datetime.datetime.fromisoformat(row[0])
-        if (datetime.datetime.now() - last_queried_dt).total_seconds() / 3600 >= CACHE_EXPIRY_HOURS: return None
-        return {"apps": json.loads(row[1] or '[]'), "miniprograms": json.loads(row[2] or '[]')}
+        if not row: return None, None
+        last_queried, cache_state, raw_json = row
+        results = json.loads(raw_json or '[]')
+        cache_state = cache_state or (CACHE_STATE_HIT if results else CACHE_STATE_EMPTY)
+        if include_stale:
+            return (cache_state, results) if cache_state != CACHE_STATE_ERROR else (None, None)
+        if not is_cache_entry_fresh(cache_state, last_queried): return None, None
+        return cache_state, results
     except Exception:
-        return None
+        return None, None
 
 
-def query_apps_and_miniprograms(company_name, db_conn, types_to_check):
-    cached_data = check_and_get_app_cache(company_name, db_conn)
-    if cached_data:
-        app_results = cached_data.get("apps", []) if 'app' in types_to_check else []
-        miniprogram_results = cached_data.get("miniprograms", []) if 'mapp' in types_to_check else []
-    else:
-        live_apps = _fetch_icpb_data(company_name, 'app')
-        live_miniprograms = _fetch_icpb_data(company_name, 'mapp')
+def fetch_company_app_type(company_name, app_type):
+    """
+    获取单个 (公司, 类型) 的APP/小程序数据：优先缓存，否则查询API并写入该类型的缓存。
+    - 查询成功按是否有结果记为 hit/empty；失败记为 error (短有效期)，不会被当作"无APP"长期缓存。
+    - 失败时若存在过期的旧数据则回退使用旧数据。
+    """
+    # 在预取线程池中执行，使用作用域连接，任务结束即归还连接池
+    with get_db_pool().connection() as db_conn:
+        cache_state, cached_results = check_and_get_app_cache(company_name, app_type, db_conn)
+        if cache_state == CACHE_STATE_ERROR:
+            logging.info(f"wer.plus ({company_name}, {app_type}) 近期查询失败，错误缓存有效期内跳过。")
+            return []
+        if cache_state is not None:
+            return cached_results
+        live_results, complete = _fetch_icpb_data(company_name, app_type)
+        if complete:
+            cache_state = CACHE_STATE_HIT if live_results else CACHE_STATE_EMPTY
+        else:
+            stale_state, stale_results = check_and_get_app_cache(company_name, app_type, db_conn, include_stale=True)
+            if stale_state is not None:
+                logging.warning(f"wer.plus ({company_name}, {app_type}) 查询失败，使用过期缓存数据。")
+                return stale_results
+            cache_state, live_results = CACHE_STATE_ERROR, []
         try:
-            cursor = db_conn.cursor()
-            cursor.execute(
-                "INSERT OR REPLACE INTO CompanyAppCache (company_name, last_queried, raw_json_apps, raw_json_miniprograms) VALUES (?, ?, ?, ?)",
-                (company_name, datetime.datetime.now(), json.dumps(live_apps), json.dumps(live_miniprograms)))
-            db_conn.commit()
+            with db_transaction(db_conn):
+                db_conn.execute(
+                    "INSERT OR REPLACE INTO CompanyAppTypeCache (company_name, app_type, last_queried, cache_state, "
+                    "raw_json) VALUES (?, ?, ?, ?, ?)",
+                    (company_name, app_type, datetime.datetime.now(), cache_state, json.dumps(live_results)))
         except sqlite3.Error as e:
             logging.error(f"写入APP缓存失败: {e}")
-        app_results = live_apps if 'app' in types_to_check else []
-        miniprogram_results = live_miniprograms if 'mapp' in types_to_check else []
-    combined = [{'detected_type': 'app', **item} for item in app_results] + [{'detected_type': 'mapp', **item} for item
-                                                                             in miniprogram_results]
+        return live_results
+
+
+_app_prefetch_executor = None
+_app_prefetch_futures = {}
+_app_prefetch_lock = threading.Lock()
+
+
+def prefetch_company_apps(company_names, types_to_check):
+    """
+    后台预取APP/小程序数据：Quake分组完成即为每个 (主体单位, 类型) 提交查询，与扫描阶段并行。
+    已提交过的 (公司, 类型) 不会重复提交，返回对应的 Future 字典。
+    """
+    global _app_prefetch_executor
+    futures = {}
+    with _app_prefetch_lock:
+        if _app_prefetch_executor is None:
+            _app_prefetch_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, WERPLUS_CONCURRENCY), thread_name_prefix="werplus")
+        for company_name in company_names:
+            for app_type in types_to_check:
+                if app_type not in WERPLUS_APP_TYPES: continue
+                key = (company_name, app_type)
+                if key not in _app_prefetch_futures:
+                    _app_prefetch_futures[key] = _app_prefetch_executor.submit(fetch_company_app_type, *key)
+                futures[key] = _app_prefetch_futures[key]
+    return futures
+
+
+def cancel_company_app_prefetch(company_name):
+    """公司任务失败时取消并移除其尚未消费的预取任务 (已在执行的查询会自然结束，结果被丢弃)。"""
+    with _app_prefetch_lock:
+        for key in [key for key in _app_prefetch_futures if key[0] == company_name]:
+            _app_prefetch_futures.pop(key).cancel()
+
+
+def shutdown_app_prefetch():
+    """流水线运行结束时关闭预取线程池，取消未开始的查询并清空未消费的任务。"""
+    global _app_prefetch_executor
+    with _app_prefetch_lock:
+        if _app_prefetch_executor is not None:
+            _app_prefetch_executor.shutdown(wait=False, cancel_futures=True)
+            _app_prefetch_executor = None
+        _app_prefetch_futures.clear()
+
+
+def query_apps_and_miniprograms(company_name, types_to_check):
+    """汇总某公司所需类型的APP/小程序数据；优先使用预取结果，未预取的类型在此时并发提交。"""
+    combined = []
+    for (_, app_type), future in prefetch_company_apps([company_name], types_to_check).items():
+        try:
+            results = future.result()
+        except Exception as e:
+            logging.error(f"APP/小程序查询异常 ({company_name}, {app_type}): {e}", exc_info=True)
+            continue
+        finally:
+            with _app_prefetch_lock:
+                _app_prefetch_futures.pop((company_name, app_type), None)
+        combined.extend({'detected_type': app_type, **item} for item in results)
     return combined
 
 
@@ -570,73 +1758,176 @@ def parse_app_results(raw_data_list):
     return parsed_list
 
 
-# ======================= 文件输出与处理 =======================
-def write_quake_results_to_excel(output_dir, company_name, data, stage=""):
-    """(最终格式化版) 保存Quake结果，移除指定列，并防止URL自动超链接。"""
-    filename_suffix = generate_filename_suffix(company_name, stage)
-    excel_path = os.path.join(output_dir, f"quake_result{filename_suffix}.xlsx")
-
-    if not data:
-        return
-
-    # --- 核心修改 1: 在创建DataFrame之前，先从每条数据中移除不需要的列 ---
-    columns_to_remove = ['scan_urls', 'Host']
-    cleaned_data = []
-    for row in data:
-        # 创建一个新字典，只包含我们需要的键
-        cleaned_row = {k: v for k, v in row.items() if k not in columns_to_remove}
-        cleaned_data.append(cleaned_row)
-
-    if not cleaned_data:
-        return
+# ======================= 历史快照对比 =======================
+def asset_diff_key(record):
+    """资产对比键: (IP, 端口, Host)。"""
+    return record.get("IP", ""), str(record.get("Port", "")), record.get("Host", "")
 
-    df = pd.DataFrame(cleaned_data)
 
-    try:
-        with pd.ExcelWriter(excel_path, engine='xlsxwriter') as writer:
-            df.to_excel(writer, sheet_name="Quake_Data", index=False)
+def _diff_value(value):
+    if value is None: return ""
+    if isinstance(value, float) and value.is_integer(): value = int(value)
+    return str(value).strip()
 
-            workbook = writer.book
-            worksheet = writer.sheets["Quake_Data"]
 
-            # 创建格式对象
-            wrap_format = workbook.add_format({'text_wrap': True, 'valign': 'top'})
-            top_align_format = workbook.add_format({'valign': 'top'})
-            # --- 核心修改 2: 创建一个纯文本格式，防止Excel自动生成超链接 ---
-            text_format = workbook.add_format({'num_format': '@', 'valign': 'top'})
+def get_quake_snapshot_pair(target_id, db_conn):
+    """返回目标最近两个已完成快照 (新, 旧) 的 scroll_id；不足两个快照时返回None。"""
+    cursor = db_conn.cursor()
+    cursor.execute("SELECT scroll_id FROM QuakeScrolls WHERE target_id = ? AND status = 'completed' "
+                   "ORDER BY scroll_id DESC LIMIT 2", (target_id,))
+    rows = cursor.fetchall()
+    return (rows[0][0], rows[1][0]) if len(rows) == 2 else None
 
-            wrap_columns = ['产品指纹', '网站标题']
 
-            for col_num, col_name in enumerate(df.columns):
-                # 计算合适的列宽
-                try:
-                    max_len = max(df[col_name].astype(str).map(len).max(), len(col_name))
-                except (ValueError, TypeError):
-                    max_len = len(col_name)
-                width = min(max_len + 5, 60)
-
-                # --- 核心修改 3: 对URL列应用纯文本格式 ---
-                if col_name == 'URL':
-                    worksheet.set_column(col_num, col_num, width, text_format)
-                elif col_name in wrap_columns:
-                    worksheet.set_column(col_num, col_num, width, wrap_format)
-                else:
-                    # 对于其他列，只设置宽度和顶部对齐
-                    worksheet.set_column(col_num, col_num, width, top_align_format)
-
-            # 设置行高，确保多行文本能完全显示
-            for row_num in range(len(df)):
-                max_lines = 1
-                for col_name in wrap_columns:
-                    if col_name in df.columns:
-                        cell_value = str(df.iloc[row_num][col_name])
-                        num_lines = cell_value.count('\n') + 1
-                        max_lines = max(max_lines, num_lines)
-
-                if max_lines > 1:
-                    worksheet.set_row(row_num + 1, max_lines * 15, wrap_format)
-                else:
-                    worksheet.set_row(row_num + 1, None, top_align_format)
+def diff_quake_snapshots(new_scroll_id, old_scroll_id, db_conn):
+    """
+    对比两个Quake快照，返回 {"added": [...], "removed": [...], "changed": [...]}。
+    变更资产为新快照中的记录，附加 "变更内容" 列 (字段: 旧值 -> 新值)。
+    """
+    old_assets = {asset_diff_key(record): record
+                  for record in iter_quake_cache_records(old_scroll_id, db_conn, where="scroll_id = ?")}
+    diff = {"added": [], "removed": [], "changed": []}
+    seen_keys = set()
+    for record in iter_quake_cache_records(new_scroll_id, db_conn, where="scroll_id = ?"):
+        key = asset_diff_key(record)
+        if key in seen_keys: continue
+        seen_keys.add(key)
+        old_record = old_assets.get(key)
+        if old_record is None:
+            diff["added"].append(record)
+            continue
+        changes = [f"{field}: {_diff_value(old_record.get(field)) or '(空)'} -> {_diff_value(record.get(field)) or '(空)'}"
+                   for field in ASSET_DIFF_FIELDS
+                   if _diff_value(old_record.get(field)) != _diff_value(record.get(field))]
+        if changes:
+            diff["changed"].append({**record, "变更内容": "\n".join(changes)})
+    diff["removed"] = [record for key, record in old_assets.items() if key not in seen_keys]
+    return diff
+
+
+def compute_target_asset_diff(target_id, db_conn):
+    """对比目标最近两个快照；不足两个快照时返回None。"""
+    snapshot_pair = get_quake_snapshot_pair(target_id, db_conn)
+    if not snapshot_pair:
+        return None
+    return diff_quake_snapshots(*snapshot_pair, db_conn)
+
+
+def filter_delta_records(records, diff):
+    """仅保留新增与变更的资产记录，用于 --delta-only 增量扫描与指纹识别。"""
+    delta_keys = {asset_diff_key(record) for record in diff["added"] + diff["changed"]}
+    return [record for record in records if asset_diff_key(record) in delta_keys]
+
+
+# ======================= 结果数据集 (Parquet) =======================
+def get_result_store_format():
+    if RESULT_STORE_FORMAT == "auto":
+        return "parquet" if pyarrow else "jsonl"
+    if RESULT_STORE_FORMAT == "parquet" and not pyarrow:
+        logging.warning("未安装 pyarrow，结果数据集回退为 JSON Lines 格式。")
+        return "jsonl"
+    return RESULT_STORE_FORMAT
+
+
+def get_result_store_dir():
+    return RESULT_STORE_DIR or os.path.join(OUTPUT_BASE_DIR, "_dataset")
+
+
+def write_result_store(source, output_dir, company_name, data, stage=""):
+    """
+    将一份结果追加写入按 source/target/company 分区的结果数据集 (Hive 分区目录，可直接用 pyarrow.dataset 读取)。
+    - target 取输出目录相对 OUTPUT_BASE_DIR 的第一级目录 (即目标文件夹)；目标级数据的 company 记为 "_target"。
+    - 每次写入一个独立的分片文件，多线程并发写入互不冲突；所有列统一按字符串存储，避免混合类型。
+    - 安装 pyarrow 时写 Parquet，否则回退为 JSON Lines；写入失败只记录日志，不影响Excel输出。
+    - 额外记录 stage / written_at / report_dir (报告所在目录，相对输出根目录)，供 --render 按原目录结构重新生成报告；
+      run_id 标识写入所属的运行，write_id (纳秒时间戳 + 分片UUID) 唯一标识一次写入，
+      --render 据此只选取每个分区最近一次运行、每份报告最近一次写入的数据。
+    """
+    store_format = get_result_store_format()
+    if store_format == "none" or data is None or len(data) == 0:
+        return None
+    relative_dir = os.path.relpath(os.path.abspath(output_dir), os.path.abspath(OUTPUT_BASE_DIR))
+    target_part = relative_dir.split(os.sep)[0] if relative_dir not in (".", "") and not relative_dir.startswith("..") \
+        else "_all"
+    partition_dir = os.path.join(get_result_store_dir(), f"source={source}", f"target={target_part}",
+                                 f"company={sanitize_sheet_name(company_name) if company_name else '_target'}")
+    now, part_uuid = datetime.datetime.now(), uuid.uuid4().hex[:8]
+    store_path = os.path.join(partition_dir, f"part-{now:%Y%m%d%H%M%S}-{part_uuid}."
+                                             f"{'parquet' if store_format == 'parquet' else 'jsonl'}")
+    try:
+        df = data if isinstance(data, pd.DataFrame) else pd.DataFrame(data)
+        df = df.drop(columns=['scan_urls'], errors='ignore').fillna('').astype(str)
+        df["stage"], df["written_at"] = stage, now.isoformat(sep=" ", timespec="seconds")
+        df["report_dir"] = "" if relative_dir == "." else relative_dir.replace(os.sep, "/")
+        df["run_id"], df["write_id"] = RESULT_STORE_RUN_ID, f"{time.time_ns():020d}-{part_uuid}"
+        os.makedirs(partition_dir, exist_ok=True)
+        if store_format == "parquet":
+            df.to_parquet(store_path, index=False)
+        else:
+            df.to_json(store_path, orient="records", lines=True, force_ascii=False)
+        return store_path
+    except Exception as e:
+        logging.error(f"写入结果数据集失败 ({store_path}): {e}", exc_info=True)
+        return None
+
+
+# ======================= 文件输出与处理 =======================
+def create_sheet_formats(workbook):
+    return {
+        "wrap": workbook.add_format({'text_wrap': True, 'valign': 'top'}),
+        "top": workbook.add_format({'valign': 'top'}),
+        # 纯文本格式，防止Excel把URL自动转换成超链接
+        "text": workbook.add_format({'num_format': '@', 'valign': 'top'}),
+    }
+
+
+def format_excel_sheet(worksheet, df, formats, wrap_columns, text_columns=('URL', 'url'), max_width=60):
+    """
+    (向量化版) 统一设置工作表列宽、列格式及多行单元格的行高。
+    - 列宽：每列一次 str.len() 计算最大长度，不逐单元格访问。
+    - 行高：对所有换行列一次性统计换行符数量，仅对多行内容的行调用 set_row。
+    """
+    text_df = df.astype(str)
+    for col_num, col_name in enumerate(df.columns):
+        max_len = text_df[col_name].str.len().max() if not df.empty else 0
+        width = min(max(int(max_len), len(str(col_name))) + 5, max_width)
+        if col_name in text_columns:
+            cell_format = formats["text"]
+        elif col_name in wrap_columns:
+            cell_format = formats["wrap"]
+        else:
+            cell_format = formats["top"]
+        worksheet.set_column(col_num, col_num, width, cell_format)
+
+    present_wrap_columns = [col for col in wrap_columns if col in df.columns]
+    if df.empty or not present_wrap_columns:
+        return
+    line_counts = pd.concat([text_df[col].str.count('\n') for col in present_wrap_columns], axis=1).max(axis=1) + 1
+    line_counts = line_counts.reset_index(drop=True)
+    for row_num, num_lines in line_counts[line_counts > 1].items():
+        # 15是经验值，大致为一行的磅值高度
+        worksheet.set_row(row_num + 1, int(num_lines) * 15)
+
+
+def write_quake_results_to_excel(output_dir, company_name, data, stage=""):
+    """(最终格式化版) 保存Quake结果，移除指定列，并防止URL自动超链接。"""
+    filename_suffix = generate_filename_suffix(company_name, stage)
+    excel_path = os.path.join(output_dir, f"quake_result{filename_suffix}.xlsx")
+
+    if not data:
+        return
+
+    write_result_store("quake", output_dir, company_name, data, stage)
+    if DEFER_REPORTS: return
+    # 移除内部使用的列
+    df = pd.DataFrame(data).drop(columns=['scan_urls', 'Host'], errors='ignore')
+
+    try:
+        with pd.ExcelWriter(excel_path, engine='xlsxwriter') as writer:
+            df.to_excel(writer, sheet_name="Quake_Data", index=False)
+
+            format_excel_sheet(writer.sheets["Quake_Data"], df, create_sheet_formats(writer.book),
+                               wrap_columns=['产品指纹', '网站标题'])
 
         cs_console.print(
             f"    [green]Success:[/green] Quake Excel 已保存: '{os.path.basename(excel_path)}' ({len(df)} 条)")
@@ -647,6 +1938,8 @@ def write_quake_results_to_excel(output_dir, company_name, data, stage=""):
 
 def write_fofa_results_to_excel(output_dir, target_name, data, stage="fofa_reverse_lookup"):
     if not data: return
+    write_result_store("fofa", output_dir, None, data, stage)
+    if DEFER_REPORTS: return
     filename_suffix = generate_filename_suffix(target_name, stage)
     excel_path = os.path.join(output_dir, f"fofa_results{filename_suffix}.xlsx")
     try:
@@ -659,6 +1952,8 @@ def write_fofa_results_to_excel(output_dir, target_name, data, stage="fofa_rever
 
 def write_app_results_to_excel(output_dir, company_name, data):
     if not data: return
+    write_result_store("apps", output_dir, company_name, data, "apps")
+    if DEFER_REPORTS: return
     filename_suffix = generate_filename_suffix(company_name, "apps")
     excel_path = os.path.join(output_dir, f"app_results{filename_suffix}.xlsx")
     try:
@@ -671,6 +1966,8 @@ def write_app_results_to_excel(output_dir, company_name, data):
 
 def write_summary_app_report_to_excel(output_dir, target_name, all_data):
     if not all_data: return
+    write_result_store("app_summary", output_dir, None, all_data, "app_summary")
+    if DEFER_REPORTS: return
     filename_suffix = generate_filename_suffix(target_name, "app_summary")
     excel_path = os.path.join(output_dir, f"app_summary{filename_suffix}.xlsx")
     try:
@@ -681,8 +1978,34 @@ def write_summary_app_report_to_excel(output_dir, target_name, all_data):
         logging.error(f"保存小程序/APP汇总报告失败: {e}")
 
 
+def write_asset_diff_report(output_dir, target_name, diff):
+    """输出资产变化报告: 新增 / 消失 / 变更 三个工作表。"""
+    write_result_store("changes", output_dir, None,
+                       [{**record, ASSET_CHANGE_TYPE_COLUMN: change_type}
+                        for change_type, records in diff.items() for record in records], "quake")
+    if DEFER_REPORTS: return
+    excel_path = os.path.join(output_dir, f"asset_changes{generate_filename_suffix(target_name, 'quake')}.xlsx")
+    sheets = [("新增资产", diff["added"]), ("消失资产", diff["removed"]), ("变更资产", diff["changed"])]
+    try:
+        with pd.ExcelWriter(excel_path, engine='xlsxwriter') as writer:
+            formats = create_sheet_formats(writer.book)
+            for sheet_name, records in sheets:
+                df = pd.DataFrame(records).drop(columns=['scan_urls'], errors='ignore')
+                df.to_excel(writer, sheet_name=sheet_name, index=False)
+                if not df.empty:
+                    format_excel_sheet(writer.sheets[sheet_name], df, formats,
+                                       wrap_columns=['产品指纹', '网站标题', '变更内容'])
+        cs_console.print(f"    [green]Success:[/green] 资产变化报告已保存: '{os.path.basename(excel_path)}' "
+                         f"(新增 {len(diff['added'])}，消失 {len(diff['removed'])}，变更 {len(diff['changed'])})")
+    except Exception as e:
+        logging.error(f"保存资产变化报告失败 ({excel_path}): {e}", exc_info=True)
+        cs_console.print(f"    [bold red]Error:[/bold red] 保存资产变化报告失败: {os.path.basename(excel_path)}")
+
+
 def write_final_summary_report(output_base_dir, all_data):
     if not all_data: return
+    write_result_store("app_summary", output_base_dir, None, all_data, "final_app_summary")
+    if DEFER_REPORTS: return
     timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
     excel_path = os.path.join(output_base_dir, f"FINAL_APP_SUMMARY_{timestamp}.xlsx")
     try:
@@ -698,27 +2021,43 @@ def create_self_check_report(failed_targets_list, db_conn, mode_name):
     report_path = os.path.join(OUTPUT_BASE_DIR, "自查报告.xlsx")
     cs_console.print(f"\n[bold blue]生成自查报告...[/bold blue] -> '{report_path}'")
     try:
-        valid_cached_targets_for_excel = []
+        valid_cached_targets_for_excel, other_cached_targets_for_excel = [], []
         cursor = db_conn.cursor()
-        cursor.execute(
-            "SELECT target_id, target_name, last_queried_quake FROM Targets WHERE last_queried_quake IS NOT NULL")
-        for target_id, target_name, timestamp_str in cursor.fetchall():
+        cursor.execute("SELECT target_id, target_name, last_queried_quake, quake_last_error, last_queried_fofa "
+                       "FROM Targets WHERE last_queried_quake IS NOT NULL")
+        for target_id, target_name, timestamp_str, last_error, fofa_timestamp in cursor.fetchall():
             try:
-                last_queried_dt = datetime.datetime.fromisoformat(timestamp_str)
-                cache_age_hours = (datetime.datetime.now() - last_queried_dt).total_seconds() / 3600
-                if cache_age_hours < CACHE_EXPIRY_HOURS:
-                    remaining_hours = round(CACHE_EXPIRY_HOURS - cache_age_hours, 2)
-                    found_companies = set()
-                    cursor.execute("SELECT raw_json FROM QuakeRawData WHERE target_id = ?", (target_id,))
-                    for (raw_json_str,) in cursor.fetchall():
-                        unit_name = json.loads(raw_json_str).get("service", {}).get("http", {}).get("icp", {}).get(
-                            "main_licence", {}).get("unit", "")
-                        if unit_name: found_companies.add(unit_name)
+                # 按缓存状态 (hit/empty/error) 各自的有效期计算剩余时间，过期的不列出
+                cache_state, _ = get_quake_cache_state(target_name, db_conn)
+                if cache_state is None:
+                    continue
+                cache_age_hours = (datetime.datetime.now() - parse_db_timestamp(timestamp_str)).total_seconds() / 3600
+                remaining_hours = round(get_cache_expiry_hours(cache_state) - cache_age_hours, 2)
+                if cache_state != CACHE_STATE_HIT:
+                    other_cached_targets_for_excel.append(
+                        {'查询目标': target_name,
+                         '缓存状态': '查询无结果' if cache_state == CACHE_STATE_EMPTY else '查询失败',
+                         '缓存时间': str(timestamp_str).split('.')[0], '剩余有效期(小时)': remaining_hours,
+                         '错误信息': last_error if cache_state == CACHE_STATE_ERROR else ''})
+                else:
+                    # 只统计最新快照中的主体单位 (历史快照保留在库中)；旧版无快照数据按目标读取
+                    snapshot_id = get_latest_quake_snapshot(target_id, db_conn)
+                    if snapshot_id is None:
+                        cursor.execute("SELECT DISTINCT unit FROM QuakeAsset WHERE target_id = ? "
+                                       "AND scroll_id IS NULL AND unit != ''", (target_id,))
+                    else:
+                        cursor.execute("SELECT DISTINCT unit FROM QuakeAsset WHERE scroll_id = ? AND unit != ''",
+                                       (snapshot_id,))
+                    found_companies = {row[0] for row in cursor.fetchall()}
                     companies_str = "\n".join(sorted(list(found_companies))) or "未发现主体单位"
+                    # last_queried_fofa 只在目标全部IP都得到Fofa结果时更新
+                    fofa_complete = str(fofa_timestamp).split('.')[0] \
+                        if is_cache_entry_fresh(CACHE_STATE_HIT, fofa_timestamp) else '无完整的有效Fofa缓存'
                     valid_cached_targets_for_excel.append({'查询目标': target_name, '包含的备案主体': companies_str,
-                                                           '缓存时间': timestamp_str.split('.')[0],
-                                                           '剩余有效期(小时)': remaining_hours})
-            except (ValueError, TypeError, json.JSONDecodeError):
+                                                           '缓存时间': str(timestamp_str).split('.')[0],
+                                                           '剩余有效期(小时)': remaining_hours,
+                                                           'Fofa反查完成时间': fofa_complete})
+            except (ValueError, TypeError, json.JSONDecodeError, sqlite3.Error):
                 continue
         with pd.ExcelWriter(report_path, engine='openpyxl') as writer:
             if failed_targets_list:
@@ -734,6 +2073,10 @@ def create_self_check_report(failed_targets_list, db_conn, mode_name):
             else:
                 pd.DataFrame([{'状态': '当前数据库中无有效缓存'}]).to_excel(writer, sheet_name="有效期内的缓存目标",
                                                                             index=False)
+            if other_cached_targets_for_excel:
+                # 无结果/失败的目标在各自较短的有效期内不会重新查询，单独列出便于排查
+                pd.DataFrame(other_cached_targets_for_excel).to_excel(writer, sheet_name="无结果或失败的缓存目标",
+                                                                      index=False)
         cs_console.print(f"  [green]Success:[/green] 自查报告已生成。")
     except Exception as e:
         logging.error(f"生成自查报告失败: {e}", exc_info=True)
@@ -773,31 +2116,186 @@ def write_urls_to_txt_file(output_dir, name_for_file, url_list, stage=""):
         return None
 
 
+def convert_csv_to_excel(csv_file_path):
+    """
+    将一个 observer_ward 结果CSV转换为多Sheet的Excel (可在子进程中执行)，成功后删除CSV。
+    - CSV只读取一次，有效/无效表通过状态码布尔掩码切片写出。
+    - 使用 xlsxwriter 引擎写入，并关闭URL自动超链接。
+    返回 (CSV路径, 是否成功, 错误信息)。
+    """
+    excel_file_path = os.path.splitext(csv_file_path)[0] + ".xlsx"
+    try:
+        try:
+            df_csv = pd.read_csv(csv_file_path, encoding='utf-8-sig')
+        except UnicodeDecodeError:
+            df_csv = pd.read_csv(csv_file_path, encoding='gbk')
+        if not df_csv.empty:
+            with pd.ExcelWriter(excel_file_path, engine='xlsxwriter',
+                                engine_kwargs={'options': {'strings_to_urls': False}}) as writer:
+                df_csv.to_excel(writer, sheet_name="原始数据", index=False)
+                if 'status_code' in df_csv.columns:
+                    df_csv['status_code'] = pd.to_numeric(df_csv['status_code'], errors='coerce').fillna(0).astype(int)
+                    valid_mask = df_csv['status_code'].isin(FINGERPRINT_VALID_STATUS_CODES)
+                    if valid_mask.any(): df_csv[valid_mask].to_excel(writer, sheet_name="有效表", index=False)
+                    if not valid_mask.all(): df_csv[~valid_mask].to_excel(writer, sheet_name="无效表", index=False)
+        os.remove(csv_file_path)
+        return csv_file_path, True, ""
+    except Exception as e:
+        return csv_file_path, False, str(e)
+
+
+_csv_convert_executor = None
+_csv_convert_futures = []
+_csv_convert_lock = threading.Lock()
+
+
+def get_csv_convert_executor():
+    """CSV→Excel 转换进程池 (spawn 方式启动，避免在多线程进程中 fork)。"""
+    global _csv_convert_executor
+    with _csv_convert_lock:
+        if _csv_convert_executor is None:
+            _csv_convert_executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=max(1, CSV_CONVERT_WORKERS), mp_context=multiprocessing.get_context("spawn"))
+        return _csv_convert_executor
+
+
+def submit_csv_conversion(csv_file_path):
+    """observer_ward 结果写出后立即提交后台转换，不必等到运行结束再统一处理。"""
+    future = get_csv_convert_executor().submit(convert_csv_to_excel, csv_file_path)
+    with _csv_convert_lock:
+        _csv_convert_futures.append(future)
+
+
+def _log_csv_conversion_result(future):
+    try:
+        csv_file_path, ok, error = future.result()
+    except Exception as e:
+        logging.error(f"CSV转换任务异常: {e}", exc_info=True)
+        return False
+    if not ok:
+        logging.error(f"处理CSV文件 {csv_file_path} 失败: {error}")
+    return ok
+
+
 def process_all_generated_csvs(output_base_dir_param):
-    cs_console.print(f"\n[green]INFO:[/green] 开始最终的CSV到Excel批量转换...")
-    for dirpath, _, filenames in os.walk(output_base_dir_param):
-        for filename in [f for f in filenames if f.endswith(".csv")]:
-            csv_file_path = os.path.join(dirpath, filename)
-            excel_file_path = os.path.splitext(csv_file_path)[0] + ".xlsx"
-            try:
-                try:
-                    df_csv = pd.read_csv(csv_file_path, encoding='utf-8-sig')
-                except UnicodeDecodeError:
-                    df_csv = pd.read_csv(csv_file_path, encoding='gbk')
-                if not df_csv.empty:
-                    with pd.ExcelWriter(excel_file_path, engine='openpyxl') as writer:
-                        df_csv.to_excel(writer, sheet_name="原始数据", index=False)
-                        if 'status_code' in df_csv.columns:
-                            df_copy = df_csv.copy()
-                            df_copy['status_code'] = pd.to_numeric(df_copy['status_code'], errors='coerce').fillna(
-                                0).astype(int)
-                            df_valid = df_copy[df_copy['status_code'].isin([200, 301, 302])]
-                            df_invalid = df_copy[~df_copy['status_code'].isin([200, 301, 302])]
-                            if not df_valid.empty: df_valid.to_excel(writer, sheet_name="有效表", index=False)
-                            if not df_invalid.empty: df_invalid.to_excel(writer, sheet_name="无效表", index=False)
-                os.remove(csv_file_path)
-            except Exception as e:
-                logging.error(f"处理CSV文件 {csv_file_path} 失败: {e}", exc_info=True)
+    """等待运行中提交的转换全部完成，再并行转换目录树中剩余的CSV (例如中断后遗留的文件)。"""
+    global _csv_convert_executor
+    cs_console.print(f"\n[green]INFO:[/green] 等待CSV到Excel转换完成...")
+    with _csv_convert_lock:
+        pending, _csv_convert_futures[:] = list(_csv_convert_futures), []
+    converted = sum(_log_csv_conversion_result(future) for future in pending)
+    remaining = [os.path.join(dirpath, filename) for dirpath, _, filenames in os.walk(output_base_dir_param)
+                 for filename in filenames if filename.endswith(".csv")]
+    if remaining:
+        executor = get_csv_convert_executor()
+        converted += sum(_log_csv_conversion_result(future)
+                         for future in [executor.submit(convert_csv_to_excel, path) for path in remaining])
+    with _csv_convert_lock:
+        executor, _csv_convert_executor = _csv_convert_executor, None
+    if executor:
+        executor.shutdown()
+    cs_console.print(f"[green]INFO:[/green] CSV到Excel转换完成，共 {converted} 个文件 (运行中转换 {len(pending)} 个)。")
+
+
+# ======================= 运行期资产去重 =======================
+class RunAssetRegistry:
+    """
+    运行期资产登记表 (跨目标、跨主体单位共享，线程安全)。
+    - 每个 IP:端口 与规范化URL在一次运行中只由第一个认领者扫描/识别，其他归属方等待其完成后复用结果。
+    - 认领按时间先后进行，等待方只会等待更早的认领者，不会形成循环等待。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ip_claims = defaultdict(list)  # ip -> [(scan_id, 端口集合), ...]
+        self._scan_done = {}  # scan_id -> threading.Event
+        self._url_done = {}  # url_key -> threading.Event
+        self._url_rows = {}  # url_key -> [observer_ward输出行, ...]
+        self.stats = defaultdict(int)
+
+    def claim_gogo_pairs(self, scan_id, ips, ports):
+        """认领 IP:端口，返回 ({ip: 需本次扫描的端口列表}, {其他扫描ID: {ip: 端口集合}})。"""
+        port_set = frozenset(ports)
+        ports_by_ip, foreign_scans = {}, defaultdict(dict)
+        with self._lock:
+            self._scan_done.setdefault(scan_id, threading.Event())
+            for ip in ips:
+                remaining = set(port_set)
+                for owner_scan_id, claimed_ports in self._ip_claims[ip]:
+                    shared = remaining & claimed_ports
+                    if shared:
+                        foreign_scans[owner_scan_id][ip] = shared
+                        remaining -= shared
+                if remaining:
+                    own_ports = port_set if len(remaining) == len(port_set) else frozenset(remaining)
+                    self._ip_claims[ip].append((scan_id, own_ports))
+                    ports_by_ip[ip] = [port for port in ports if port in remaining]
+                self.stats["gogo_pairs"] += len(port_set)
+                self.stats["gogo_pairs_shared"] += len(port_set) - len(remaining)
+        return ports_by_ip, dict(foreign_scans)
+
+    def finish_gogo_scan(self, scan_id):
+        with self._lock:
+            self._scan_done.setdefault(scan_id, threading.Event()).set()
+
+    def wait_gogo_scan(self, scan_id):
+        with self._lock:
+            event = self._scan_done.setdefault(scan_id, threading.Event())
+        event.wait()
+
+    def claim_urls(self, url_keys):
+        """认领待识别的URL，返回 (由调用方识别的键列表, 已被其他归属方认领的键列表)。"""
+        own_keys, foreign_keys = [], []
+        with self._lock:
+            for key in url_keys:
+                if key in self._url_done:
+                    foreign_keys.append(key)
+                else:
+                    self._url_done[key] = threading.Event()
+                    own_keys.append(key)
+            self.stats["urls"] += len(own_keys) + len(foreign_keys)
+            self.stats["urls_shared"] += len(foreign_keys)
+        return own_keys, foreign_keys
+
+    def publish_urls(self, url_keys, rows_by_key):
+        """发布认领URL的识别结果 (识别失败时结果为空)，唤醒等待方。"""
+        with self._lock:
+            for key in url_keys:
+                self._url_rows[key] = rows_by_key.get(key, [])
+                self._url_done[key].set()
+
+    def wait_urls(self, url_keys):
+        with self._lock:
+            events = [(key, self._url_done[key]) for key in url_keys]
+        rows_by_key = {}
+        for key, event in events:
+            event.wait()
+            if self._url_rows.get(key):
+                rows_by_key[key] = self._url_rows[key]
+        return rows_by_key
+
+
+_run_asset_registry = None
+_run_asset_registry_lock = threading.Lock()
+
+
+def get_run_asset_registry():
+    """本次运行共享的资产登记表；关闭去重 (--no-dedupe) 时返回None。"""
+    global _run_asset_registry
+    if not ASSET_DEDUPE:
+        return None
+    with _run_asset_registry_lock:
+        if _run_asset_registry is None:
+            _run_asset_registry = RunAssetRegistry()
+        return _run_asset_registry
+
+
+def report_asset_dedupe_stats():
+    if _run_asset_registry is None: return
+    stats = _run_asset_registry.stats
+    if not stats["gogo_pairs"] and not stats["urls"]: return
+    cs_console.print(f"[green]INFO:[/green] 跨目标去重: gogo IP:端口 {stats['gogo_pairs_shared']}/{stats['gogo_pairs']} 个复用，"
+                     f"指纹识别URL {stats['urls_shared']}/{stats['urls']} 个复用。")
 
 
 # ======================= 外部工具调用与处理 =======================
@@ -819,31 +2317,389 @@ def archive_intermediate_files(company_dir_path, company_name_for_log):
         cs_console.print(f"    [green]整理:[/green] 已将 {moved_files_count} 个临时文件归档到 'related_materials'。")
 
 
-def run_observer_ward(company_name, company_dir_path, urls_to_fingerprint, stage=""):
+def normalize_fingerprint_url(url):
+    """URL指纹缓存键：协议与主机名小写、去掉默认端口和末尾斜杠。"""
+    url = str(url).strip()
+    try:
+        parts = urllib.parse.urlsplit(url if "://" in url else f"http://{url}")
+        scheme, host, port = parts.scheme.lower(), (parts.hostname or "").lower(), parts.port
+    except ValueError:
+        return url.lower()
+    if ":" in host:
+        host = f"[{host}]"
+    netloc = host if port is None or (scheme, port) in (("http", 80), ("https", 443)) else f"{host}:{port}"
+    path = parts.path.rstrip("/")
+    return urllib.parse.urlunsplit((scheme, netloc, path, parts.query, ""))
+
+
+def load_cached_fingerprints(db_conn, url_keys):
+    """按缓存键批量查询未过期的指纹结果，返回 {url_key: [observer_ward输出行, ...]}。"""
+    if FINGERPRINT_CACHE_TTL_HOURS <= 0 or not url_keys:
+        return {}
+    cutoff = datetime.datetime.now() - datetime.timedelta(hours=FINGERPRINT_CACHE_TTL_HOURS)
+    cached, keys = {}, list(url_keys)
+    cursor = db_conn.cursor()
+    for i in range(0, len(keys), 500):
+        chunk = keys[i:i + 500]
+        cursor.execute(f"SELECT url_key, result_json, fingerprinted_at FROM FingerprintCache WHERE url_key IN "
+                       f"({','.join('?' * len(chunk))})", chunk)
+        for url_key, result_json, fingerprinted_at in cursor.fetchall():
+            fingerprinted_dt = parse_db_timestamp(fingerprinted_at)
+            if fingerprinted_dt and fingerprinted_dt >= cutoff:
+                cached[url_key] = json.loads(result_json)
+    return cached
+
+
+def save_fingerprints_to_cache(db_conn, rows_by_key, urls_by_key):
+    if FINGERPRINT_CACHE_TTL_HOURS <= 0 or not rows_by_key:
+        return
+    now = datetime.datetime.now()
+    with db_transaction(db_conn):
+        db_conn.executemany(
+            "INSERT OR REPLACE INTO FingerprintCache (url_key, url, result_json, fingerprinted_at) VALUES (?, ?, ?, ?)",
+            [(key, urls_by_key.get(key, key), json.dumps(rows, ensure_ascii=False), now)
+             for key, rows in rows_by_key.items()])
+
+
+def read_observer_ward_rows(csv_file_path):
+    """读取 observer_ward 输出的CSV为行字典列表 (全部按字符串读取，便于原样缓存)。"""
+    if not os.path.exists(csv_file_path) or os.path.getsize(csv_file_path) == 0:
+        return []
+    try:
+        try:
+            df_csv = pd.read_csv(csv_file_path, encoding='utf-8-sig', dtype=str, keep_default_na=False)
+        except UnicodeDecodeError:
+            df_csv = pd.read_csv(csv_file_path, encoding='gbk', dtype=str, keep_default_na=False)
+    except pd.errors.EmptyDataError:
+        return []
+    return df_csv.to_dict('records')
+
+
+def _fingerprint_host(url):
+    """URL主机名 (小写，去掉 www. 前缀)，用于把跳转后的输出URL对应回输入URL。"""
+    try:
+        host = (urllib.parse.urlsplit(url if "://" in url else f"http://{url}").hostname or "").lower()
+    except ValueError:
+        return ""
+    return host[4:] if host.startswith("www.") else host
+
+
+def map_observer_ward_rows(new_rows, urls_by_key, requested_keys):
+    """
+    把 observer_ward 输出行映射回请求的URL键 (输出URL可能因跳转、协议/主机改写而与输入不同)。
+    - 优先按规范化URL精确匹配；其次按主机名匹配到唯一一个尚未匹配的请求URL。
+    - 仍无法确定 (如跳转到其他主机) 的行记录日志后丢弃，不猜测归属，避免错误指纹写入跨公司缓存。
+    行中的 url 列改为请求的URL，observer_ward 报告的URL保留在 reported_url 列。返回 {url_key: [行, ...]}。
+    """
+    requested_keys = set(requested_keys)
+    rows_by_key, unmatched_rows = defaultdict(list), []
+    for row in new_rows:
+        key = normalize_fingerprint_url(row.get('url', ''))
+        if key in urls_by_key and key in requested_keys:
+            rows_by_key[key].append(row)
+        else:
+            unmatched_rows.append(row)
+
+    keys_by_host = defaultdict(list)
+    for key in requested_keys:
+        keys_by_host[_fingerprint_host(key)].append(key)
+    dropped = 0
+    for row in unmatched_rows:
+        host_keys = keys_by_host.get(_fingerprint_host(str(row.get('url', ''))), [])
+        candidates = [key for key in host_keys if key not in rows_by_key] or host_keys
+        if len(candidates) == 1:
+            rows_by_key[candidates[0]].append(row)
+        else:
+            dropped += 1
+    if dropped:
+        logging.warning(f"observer_ward 有 {dropped} 条结果无法对应到输入URL，已忽略。")
+
+    return {key: [{**row, 'url': urls_by_key[key], 'reported_url': row.get('url', '')} for row in rows]
+            for key, rows in rows_by_key.items()}
+
+
+def index_urls_by_fingerprint_key(urls):
+    """按规范化URL去重，返回 {url_key: 原始URL}。"""
+    urls_by_key = {}
+    for url in urls:
+        if url and str(url).strip():
+            urls_by_key.setdefault(normalize_fingerprint_url(url), str(url).strip())
+    return urls_by_key
+
+
+def fingerprint_urls(name, work_dir, urls_by_key, stage):
+    """
+    对一批URL进行指纹识别，返回 {url_key: [observer_ward输出行, ...]}；observer_ward 不可用或失败时返回None。
+    - 先查询 FingerprintCache，仅把缓存中没有 (或已过期) 的URL交给一次 observer_ward。
+    - 新识别的结果写回缓存；observer_ward 的原始CSV读取后即删除，由调用方按需写出报告。
+    - 本次运行中已被其他主体认领的URL不再重复识别，等待其完成后复用结果。
+    """
+    # 可能在后台指纹识别线程池中执行，使用作用域连接，任务结束即归还连接池
+    with get_db_pool().connection() as db_conn:
+        rows_by_key = load_cached_fingerprints(db_conn, urls_by_key.keys())
+        if rows_by_key:
+            cs_console.print(f"    [green]缓存:[/green] {len(rows_by_key)}/{len(urls_by_key)} 个URL命中指纹缓存 ({stage})。")
+        missing_keys = [key for key in urls_by_key if key not in rows_by_key]
+        registry = get_run_asset_registry()
+        if not registry:
+            return _fingerprint_missing_urls(name, work_dir, urls_by_key, missing_keys, rows_by_key, stage, db_conn)
+        own_keys, foreign_keys = registry.claim_urls(missing_keys)
+        new_rows_by_key = {}
+        try:
+            new_rows_by_key = _fingerprint_missing_urls(name, work_dir, urls_by_key, own_keys, {}, stage, db_conn) or {}
+        finally:
+            registry.publish_urls(own_keys, new_rows_by_key)
+        if foreign_keys:
+            cs_console.print(f"    [green]去重:[/green] {len(foreign_keys)} 个URL已由本次运行中的其他主体识别，复用其结果 ({stage})。")
+            new_rows_by_key.update(registry.wait_urls(foreign_keys))
+        rows_by_key.update(new_rows_by_key)
+        return (rows_by_key or None) if own_keys else rows_by_key
+
+
+def _fingerprint_missing_urls(name, work_dir, urls_by_key, missing_keys, rows_by_key, stage, db_conn):
+    """对缓存中没有的URL运行一次 observer_ward，结果写回缓存并合并进 rows_by_key 返回；失败时返回 rows_by_key 或None。"""
+    urls_to_scan = [urls_by_key[key] for key in missing_keys]
+    if not urls_to_scan:
+        return rows_by_key
+
     script_dir = os.path.dirname(os.path.abspath(__file__))
     tools_dir = os.path.join(script_dir, 'tools')
     observer_ward_path = os.path.join(tools_dir, 'observer_ward.exe')
     if not os.path.exists(observer_ward_path):
         cs_console.print(f"  [bold red]Error:[/bold red] observer_ward.exe 未找到，跳过指纹识别。")
-        return
-    input_file = write_urls_to_txt_file(company_dir_path, company_name, urls_to_fingerprint, f"observer_input_{stage}")
-    if not input_file: return
-    output_file = os.path.join(company_dir_path, f"url_fingerprint{generate_filename_suffix(company_name, stage)}.csv")
-    command = [observer_ward_path, '-l', input_file, '-o', output_file]
+        return rows_by_key or None
+    input_file = write_urls_to_txt_file(work_dir, name, urls_to_scan, f"observer_input_{stage}")
+    if not input_file: return rows_by_key or None
+    raw_output_file = os.path.join(work_dir, f"observer_output{generate_filename_suffix(name, stage)}.csv")
+    command = [observer_ward_path, '-l', input_file, '-o', raw_output_file]
     if not SHOW_SCAN_INFO: command.append('--silent')
-    cs_console.print(f"    [blue]执行:[/blue] observer_ward URL指纹识别 ({stage})...")
+    cs_console.print(f"    [blue]执行:[/blue] observer_ward URL指纹识别 ({stage}, {len(urls_to_scan)} 个URL)...")
     try:
         subprocess.run(command, check=True, cwd=tools_dir, capture_output=not SHOW_SCAN_INFO, text=True,
                        encoding='utf-8', errors='ignore')
-        cs_console.print(f"      [green]Success:[/green] 指纹识别结果已保存: '{os.path.basename(output_file)}'")
+        new_rows = read_observer_ward_rows(raw_output_file)
     except (subprocess.CalledProcessError, FileNotFoundError) as e:
         logging.error(f"observer_ward 执行失败: {e}", exc_info=True)
         cs_console.print(f"      [bold red]Error:[/bold red] observer_ward 执行失败 (详情见日志)。")
+        return rows_by_key or None
+    finally:
+        if os.path.exists(raw_output_file):
+            os.remove(raw_output_file)
+
+    new_rows_by_key = map_observer_ward_rows(new_rows, urls_by_key, missing_keys)
+    save_fingerprints_to_cache(db_conn, new_rows_by_key, urls_by_key)
+    rows_by_key.update(new_rows_by_key)
+    return rows_by_key
+
+
+def write_fingerprint_csv(company_name, company_dir_path, stage, report_rows):
+    output_file = os.path.join(company_dir_path, f"url_fingerprint{generate_filename_suffix(company_name, stage)}.csv")
+    try:
+        pd.DataFrame(report_rows).to_csv(output_file, index=False, encoding='utf-8-sig')
+    except Exception as e:
+        logging.error(f"写入指纹识别结果失败 ({output_file}): {e}", exc_info=True)
+        return None
+    cs_console.print(f"      [green]Success:[/green] 指纹识别结果已保存: '{os.path.basename(output_file)}'")
+    return output_file
+
+
+def write_fingerprint_report(company_name, company_dir_path, stage, urls_by_key, rows_by_key):
+    """按该公司本阶段的URL挑出指纹结果，写出 url_fingerprint CSV (最终统一转换为Excel)。"""
+    report_rows = [row for key in urls_by_key for row in rows_by_key.get(key, [])]
+    if not report_rows: return None
+    write_result_store("fingerprint", company_dir_path, company_name, report_rows, stage)
+    if DEFER_REPORTS: return None
+    output_file = write_fingerprint_csv(company_name, company_dir_path, stage, report_rows)
+    if output_file:
+        submit_csv_conversion(output_file)
+    return output_file
+
+
+def run_observer_ward(company_name, company_dir_path, urls_to_fingerprint, stage=""):
+    """(带缓存版) 对单个公司某一阶段的URL进行指纹识别并输出报告。"""
+    urls_by_key = index_urls_by_fingerprint_key(urls_to_fingerprint)
+    if not urls_by_key: return
+    rows_by_key = fingerprint_urls(company_name, company_dir_path, urls_by_key, stage)
+    if rows_by_key:
+        write_fingerprint_report(company_name, company_dir_path, stage, urls_by_key, rows_by_key)
+
+
+def run_batched_observer_ward(batch_name, batch_dir, assignments):
+    """
+    (批量模式) 合并多个公司/阶段的URL只运行一次 observer_ward，再按URL归属拆分回各公司报告。
+    - assignments: [(公司名, 公司目录, 阶段, URL列表), ...]
+    - 指纹识别耗时只与URL总数相关，不再随公司数量增加进程启动与指纹库加载次数。
+    """
+    indexed = [(company_name, company_dir, stage, index_urls_by_fingerprint_key(urls))
+               for company_name, company_dir, stage, urls in assignments]
+    all_urls_by_key = {}
+    for *_, urls_by_key in indexed:
+        for key, url in urls_by_key.items():
+            all_urls_by_key.setdefault(key, url)
+    if not all_urls_by_key: return
+    cs_console.print(f"\n  [blue]批量指纹识别:[/blue] '{batch_name}' 共 {len(indexed)} 组任务，"
+                     f"去重后 {len(all_urls_by_key)} 个URL。")
+    rows_by_key = fingerprint_urls(batch_name, batch_dir, all_urls_by_key, "fingerprint_batch")
+    if not rows_by_key: return
+    for company_name, company_dir, stage, urls_by_key in indexed:
+        write_fingerprint_report(company_name, company_dir, stage, urls_by_key, rows_by_key)
 
 
 # ======================= 高级模式专属函数 =======================
-def run_gogo_scan(company_name, iplist_file_path, port_list, company_dir_path):
-    global SHOW_SCAN_INFO
+_gogo_slots = None
+_gogo_slots_lock = threading.Lock()
+
+
+def get_gogo_slots():
+    """全局 gogo 进程槽位，限制所有公司同时运行的 gogo 进程总数。"""
+    global _gogo_slots
+    with _gogo_slots_lock:
+        if _gogo_slots is None:
+            _gogo_slots = threading.BoundedSemaphore(max(1, GOGO_MAX_PROCESSES))
+        return _gogo_slots
+
+
+def follow_jsonl_file(file_path, is_writer_running, poll_interval=None):
+    """
+    以 tail -f 的方式逐行读取 JSON Lines 文件，直到写入进程结束且读到文件末尾。
+    - 未以换行结尾的半行会暂存，等下一次读取补全后再产出。
+    """
+    poll_interval = poll_interval or GOGO_FOLLOW_POLL_INTERVAL
+    handle, pending = None, ""
+    try:
+        while True:
+            writer_running = is_writer_running()
+            if handle is None and os.path.exists(file_path):
+                handle = open(file_path, 'r', encoding='utf-8', errors='ignore')
+            chunk = handle.read() if handle else ""
+            if chunk:
+                pending += chunk
+                *lines, pending = pending.split('\n')
+                for line in lines:
+                    if line.strip():
+                        yield line.strip()
+                continue
+            if not writer_running:
+                break
+            time.sleep(poll_interval)
+        if pending.strip():
+            yield pending.strip()
+    finally:
+        if handle:
+            handle.close()
+
+
+def _run_gogo_shard(gogo_exe_path, tools_dir, shard_ip_file, ports_str, shard_output_file, on_result=None):
+    """运行一个 gogo 分片进程，并在扫描过程中实时读取其 jl 输出交给 on_result 处理。"""
+    threads_per_process = max(1, GOGO_THREAD_BUDGET // max(1, GOGO_MAX_PROCESSES))
+    command = [gogo_exe_path, '-l', shard_ip_file, '-p', ports_str, '-v', '-C', '-t', str(threads_per_process),
+               '-O', 'jl', '-f', shard_output_file]
+    if not SHOW_SCAN_INFO: command.append('-q')
+    logging.info(f"执行 gogo 命令: {' '.join(command)}")
+    popen_kwargs = {"cwd": tools_dir}
+    if not SHOW_SCAN_INFO:
+        popen_kwargs.update({"stdout": subprocess.DEVNULL, "stderr": subprocess.DEVNULL})
+    with get_gogo_slots():
+        start_time = time.time()
+        process = subprocess.Popen(command, **popen_kwargs)
+        try:
+            for line in follow_jsonl_file(shard_output_file, lambda: process.poll() is None):
+                if on_result is None:
+                    continue
+                try:
+                    on_result(json.loads(line))
+                except json.JSONDecodeError:
+                    logging.warning(f"跳过无法解析的gogo输出行: {line[:200]}")
+        finally:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, command)
+        return time.time() - start_time
+
+
+def group_ips_by_ports(ports_by_ip):
+    """将待扫端口相同的IP合并为一组，返回 [(端口列表, IP列表), ...]。"""
+    scan_groups = defaultdict(list)
+    for ip, ports in ports_by_ip.items():
+        if ports:
+            scan_groups[tuple(ports)].append(ip)
+    return [(list(group_ports), group_ips) for group_ports, group_ips in scan_groups.items()]
+
+
+def plan_incremental_gogo_scan(ports_by_ip, db_conn):
+    """
+    根据 ScanHistory 规划增量扫描，返回 (扫描分组 [(端口列表, IP列表), ...], 历史开放服务行, 跳过的 IP:端口 数)。
+    - 复扫有效期内扫描过的 IP:端口 不再交给 gogo；其中开放的服务直接从历史记录并入报告。
+    - 待扫端口相同的IP合并为一组；某IP待扫端口超过一半时直接扫描全部端口，避免分组过碎。
+    """
+    fresh_after = datetime.datetime.now() - datetime.timedelta(hours=SCAN_HISTORY_TTL_HOURS)
+    ips = list(ports_by_ip)
+    fresh_ports, open_history = defaultdict(set), defaultdict(dict)
+    cursor = db_conn.cursor()
+    for i in range(0, len(ips), 500):
+        ip_chunk = ips[i:i + 500]
+        cursor.execute(f"SELECT ip, port, state, row_json FROM ScanHistory WHERE last_scanned >= ? AND ip IN "
+                       f"({', '.join('?' for _ in ip_chunk)})", [fresh_after] + ip_chunk)
+        for ip, port, state, row_json in cursor.fetchall():
+            fresh_ports[ip].add(port)
+            if state == "open" and row_json:
+                open_history[ip][port] = row_json
+
+    needed_by_ip, history_rows = {}, []
+    skipped_pairs = 0
+    for ip, ports in ports_by_ip.items():
+        needed = [port for port in ports if port not in fresh_ports[ip]]
+        if needed and len(needed) * 2 >= len(ports):
+            needed = ports
+        needed_by_ip[ip] = needed
+        skipped_pairs += len(ports) - len(needed)
+        needed_set = set(needed)
+        history_rows.extend(json.loads(row_json) for port, row_json in open_history[ip].items()
+                            if port in ports and port not in needed_set)
+    return group_ips_by_ports(needed_by_ip), history_rows, skipped_pairs
+
+
+def record_scan_history(db_conn, scan_id, scanned_groups):
+    """
+    扫描完成后更新 ScanHistory: 已扫描的 IP:端口 先记为关闭，再按本次 gogo 发现的结果标记为开放。
+    本次扫描的组合写入临时表后与 GogoFindings 关联，不依赖 last_scanned 时间戳匹配。
+    """
+    now = datetime.datetime.now()
+    scanned_pairs = list({(ip, port) for group_ports, group_ips in scanned_groups
+                          for ip in group_ips for port in group_ports})
+    with db_transaction(db_conn):
+        db_conn.execute("CREATE TEMP TABLE IF NOT EXISTS scan_pairs (ip TEXT NOT NULL, port TEXT NOT NULL, "
+                        "PRIMARY KEY (ip, port))")
+        db_conn.execute("DELETE FROM scan_pairs")
+        db_conn.executemany("INSERT INTO scan_pairs (ip, port) VALUES (?, ?)", scanned_pairs)
+        db_conn.executemany(
+            "INSERT INTO ScanHistory (ip, port, last_scanned, state, row_json) VALUES (?, ?, ?, 'closed', NULL) "
+            "ON CONFLICT(ip, port) DO UPDATE SET last_scanned = excluded.last_scanned, state = 'closed', row_json = NULL",
+            ((ip, port, now) for ip, port in scanned_pairs))
+        db_conn.execute(
+            "UPDATE ScanHistory SET state = 'open', row_json = (SELECT g.row_json FROM GogoFindings g "
+            "WHERE g.scan_id = ? AND g.ip = ScanHistory.ip AND g.port = ScanHistory.port ORDER BY g.finding_id DESC LIMIT 1) "
+            "WHERE EXISTS (SELECT 1 FROM scan_pairs p JOIN GogoFindings g ON g.ip = p.ip AND g.port = p.port "
+            "WHERE g.scan_id = ? AND p.ip = ScanHistory.ip AND p.port = ScanHistory.port)", (scan_id, scan_id))
+        db_conn.execute("DELETE FROM scan_pairs")
+
+
+def gogo_scan_id(gogo_output_path):
+    """GogoFindings 中的扫描ID: 输出文件的绝对路径 (不同目标下的同名公司互不覆盖)。"""
+    return os.path.normpath(os.path.abspath(gogo_output_path))
+
+
+def run_gogo_scan(company_name, iplist_file_path, port_list, company_dir_path, url_consumer=None):
+    """
+    (分片并行 + 流式入库版) 将IP列表按 GOGO_CHUNK_SIZE 切分为多个分片，多个 gogo 进程并行扫描后合并 jl 结果。
+    - 同时运行的进程数受全局槽位限制 (跨公司共享)，每个进程分得 GOGO_THREAD_BUDGET / GOGO_MAX_PROCESSES 个线程。
+    - 扫描过程中实时读取输出，逐条写入 GogoFindings；新发现的 http/https URL 立即交给 url_consumer。
+    - 单个分片失败不影响其他分片，全部失败时返回None。
+    - 扫描过的 IP:端口 记录到 ScanHistory；开启 GOGO_INCREMENTAL 时只扫描新出现或过期的组合，历史开放服务直接并入报告。
+    - 本次运行中已由其他主体认领的 IP:端口 不再重复扫描，等待其扫描完成后将结果归属到本公司报告。
+    """
     cs_console.print(f"    [blue]执行:[/blue] Gogo 主动扫描...")
     script_dir = os.path.dirname(os.path.abspath(__file__))
     tools_dir = os.path.join(script_dir, 'tools')
@@ -853,166 +2709,836 @@ def run_gogo_scan(company_name, iplist_file_path, port_list, company_dir_path):
         return None
     filename_suffix = generate_filename_suffix(company_name, "gogo_scan")
     absolute_output_file = os.path.join(company_dir_path, f"gogo_results{filename_suffix}.json")
-    ports_str = ",".join(map(str, sorted(list(set(port_list)), key=int)))
-    if not ports_str:
+    ports = sorted({str(port) for port in port_list}, key=int)
+    if not ports:
         cs_console.print(f"    [yellow]Warning:[/yellow] 没有提供有效端口给gogo，跳过扫描。")
         return None
-    command = [gogo_exe_path, '-l', iplist_file_path, '-p', ports_str, '-v', '-C', '-t', '1000', '-O', 'jl', '-f',
-               absolute_output_file]
-    if not SHOW_SCAN_INFO: command.append('-q')
-    logging.info(f"执行 gogo 命令: {' '.join(command)}")
+
+    with open(iplist_file_path, 'r', encoding='utf-8') as f:
+        ips = list(dict.fromkeys(line.strip() for line in f if line.strip()))
+    scan_id = gogo_scan_id(absolute_output_file)
+    registry = get_run_asset_registry()
+    if registry:
+        ports_by_ip, foreign_scans = registry.claim_gogo_pairs(scan_id, ips, ports)
+        shared_pairs = sum(len(claimed) for by_ip in foreign_scans.values() for claimed in by_ip.values())
+        if shared_pairs:
+            cs_console.print(f"      - [dim]跨目标去重: {shared_pairs} 个 IP:端口 已由本次运行中的其他主体扫描，"
+                             f"直接复用其结果。[/dim]")
+    else:
+        ports_by_ip, foreign_scans = {ip: ports for ip in ips}, {}
     try:
-        subprocess_kwargs = {"check": True, "cwd": tools_dir}
-        if not SHOW_SCAN_INFO:
-            subprocess_kwargs.update({"capture_output": True, "text": True, "encoding": 'utf-8', "errors": 'ignore'})
-        subprocess.run(command, **subprocess_kwargs)
-        cs_console.print(
-            f"      [green]Success:[/green] gogo扫描完成, 结果保存在: '{os.path.basename(absolute_output_file)}'")
-        return absolute_output_file
-    except (subprocess.CalledProcessError, Exception) as e:
-        logging.error(f"gogo 执行出错: {e}", exc_info=True)
+        return _scan_gogo_pairs(company_name, company_dir_path, iplist_file_path, ips, ports_by_ip, foreign_scans,
+                                scan_id, absolute_output_file, filename_suffix, gogo_exe_path, tools_dir,
+                                url_consumer)
+    finally:
+        if registry:
+            registry.finish_gogo_scan(scan_id)
+
+
+def _scan_gogo_pairs(company_name, company_dir_path, iplist_file_path, ips, ports_by_ip, foreign_scans, scan_id,
+                     absolute_output_file, filename_suffix, gogo_exe_path, tools_dir, url_consumer):
+    db_conn = get_thread_db_conn()
+    if GOGO_INCREMENTAL:
+        scan_groups, history_rows, skipped_pairs = plan_incremental_gogo_scan(ports_by_ip, db_conn)
+        cs_console.print(f"      - [dim]增量扫描: 跳过复扫有效期内的 {skipped_pairs}/"
+                         f"{sum(len(ports) for ports in ports_by_ip.values())} 个 IP:端口，"
+                         f"从历史记录并入 {len(history_rows)} 个开放服务。[/dim]")
+    else:
+        scan_groups, history_rows = group_ips_by_ports(ports_by_ip), []
+
+    chunk_size = max(1, GOGO_CHUNK_SIZE)
+    shards = [(group_ports, group_ips[i:i + chunk_size]) for group_ports, group_ips in scan_groups
+              for i in range(0, len(group_ips), chunk_size)]
+    if len(shards) == 1 and len(shards[0][1]) == len(ips):
+        shard_jobs = [(iplist_file_path, ",".join(shards[0][0]), absolute_output_file)]
+    else:
+        shard_jobs = []
+        for shard_index, (shard_ports, shard_ips) in enumerate(shards, 1):
+            shard_ip_file = os.path.join(company_dir_path, f"ips{filename_suffix}_shard{shard_index}.txt")
+            with open(shard_ip_file, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(shard_ips))
+            shard_jobs.append((shard_ip_file, ",".join(shard_ports),
+                               os.path.join(company_dir_path, f"gogo_results{filename_suffix}_shard{shard_index}.json")))
+        if shard_jobs:
+            cs_console.print(f"      - [dim]IP已切分为 {len(shard_jobs)} 个分片 (每片最多 {chunk_size} 个IP)，"
+                             f"最多 {GOGO_MAX_PROCESSES} 个gogo进程并行。[/dim]")
+
+    scan_start_time = time.time()
+    succeeded_outputs = []
+    result_sink = GogoResultSink(scan_id, company_name, url_consumer)
+    for row_data in history_rows:
+        result_sink.add_row(row_data)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(len(shard_jobs), GOGO_MAX_PROCESSES))) as pool:
+        futures = {pool.submit(_run_gogo_shard, gogo_exe_path, tools_dir, shard_ip_file, ports_str, shard_output,
+                               result_sink.add): (shard_index, shard_output)
+                   for shard_index, (shard_ip_file, ports_str, shard_output) in enumerate(shard_jobs, 1)}
+        for future in concurrent.futures.as_completed(futures):
+            shard_index, shard_output = futures[future]
+            try:
+                elapsed = future.result()
+            except (subprocess.CalledProcessError, Exception) as e:
+                logging.error(f"gogo 分片 {shard_index} 执行出错 ({company_name}): {e}", exc_info=True)
+                cs_console.print(f"      [bold red]Error:[/bold red] gogo 分片 ({shard_index}/{len(shard_jobs)}) 执行出错 (详情见日志)。")
+                continue
+            succeeded_outputs.append((shard_index, shard_output))
+            if len(shard_jobs) > 1:
+                cs_console.print(f"      [dim]{company_name}: gogo 分片 ({shard_index}/{len(shard_jobs)}) 完成，"
+                                 f"耗时 {elapsed:.1f} 秒 (已完成 {len(succeeded_outputs)}/{len(shard_jobs)})。[/dim]")
+
+    # 其他主体负责扫描的 IP:端口: 等待其完成后把结果归属到本公司
+    shared_rows = 0
+    for foreign_scan_id, claimed_by_ip in foreign_scans.items():
+        get_run_asset_registry().wait_gogo_scan(foreign_scan_id)
+        for row_data in iter_gogo_findings(db_conn, foreign_scan_id, claimed_by_ip):
+            result_sink.add_row(row_data)
+            shared_rows += 1
+    result_sink.close()
+    if shard_jobs and not succeeded_outputs:
         cs_console.print(f"      [bold red]Error:[/bold red] gogo 执行出错 (详情见日志)。")
         return None
-
-
-def process_gogo_output_and_generate_excel(gogo_output_path, company_name, company_dir_path):
+    try:
+        # 只记录成功分片的 IP:端口，失败分片下次运行仍会重新扫描
+        record_scan_history(db_conn, scan_id, [(shards[shard_index - 1][0], shards[shard_index - 1][1])
+                                               for shard_index, _ in succeeded_outputs])
+    except sqlite3.Error as e:
+        logging.error(f"更新扫描历史失败 ({company_name}): {e}", exc_info=True)
+    if shard_jobs and shard_jobs[0][2] != absolute_output_file:
+        # 按分片顺序合并各分片的 jl 输出
+        with open(absolute_output_file, 'w', encoding='utf-8') as merged:
+            for _, shard_output in sorted(succeeded_outputs):
+                if os.path.exists(shard_output):
+                    with open(shard_output, 'r', encoding='utf-8', errors='ignore') as f:
+                        shutil.copyfileobj(f, merged)
+                    os.remove(shard_output)
+    if not shard_jobs:
+        cs_console.print(f"      [green]Success:[/green] 无需启动gogo (均在复扫有效期内或已由其他主体扫描)，"
+                         f"已并入 {result_sink.row_count} 条已知结果。")
+        return absolute_output_file
+    cs_console.print(f"      [green]Success:[/green] gogo扫描完成 ({len(succeeded_outputs)}/{len(shard_jobs)} 个分片成功，"
+                     f"实时入库 {result_sink.row_count - shared_rows} 条，复用 {shared_rows} 条，"
+                     f"耗时 {time.time() - scan_start_time:.1f} 秒), 结果保存在: '{os.path.basename(absolute_output_file)}'")
+    return absolute_output_file
+
+
+def iter_gogo_findings(db_conn, scan_id, ports_by_ip):
+    """读取某次扫描中属于指定 IP:端口 的报告行。"""
+    cursor = db_conn.cursor()
+    cursor.execute("SELECT ip, port, row_json FROM GogoFindings WHERE scan_id = ? ORDER BY finding_id", (scan_id,))
+    for ip, port, row_json in cursor:
+        if port in ports_by_ip.get(ip, ()):
+            yield json.loads(row_json)
+
+
+def gogo_result_to_row(result):
+    """将一条 gogo jl 结果转换为报告行，返回 (行数据, URL)；非标准资产格式返回 (None, '')。"""
+    # 健壮性检查：跳过非标准资产格式的行
+    if not isinstance(result, dict) or not result.get("ip") or not result.get("port"):
+        logging.warning(f"跳过非标准资产格式的Gogo结果: {result}")
+        return None, ''
+
+    protocol, ip, port = result.get('protocol', '').lower(), result.get('ip', ''), str(result.get('port', ''))
+    url = ''
+    if protocol in ['http', 'https']:
+        url = f"{protocol}://{ip}" + (f":{port}" if not (
+                (protocol == 'http' and port == '80') or (protocol == 'https' and port == '443')) else "")
+
+    vulns_string = '\n'.join(result.get('vulns', {}).keys())
+    frameworks_data = result.get('frameworks', {})
+    names = '\n'.join(frameworks_data.keys())
+    versions = '\n'.join([d.get('attributes', {}).get('version', '') for d in frameworks_data.values()])
+    vendors = '\n'.join([d.get('attributes', {}).get('vendor', '') for d in frameworks_data.values()])
+    products = '\n'.join([d.get('attributes', {}).get('product', '') for d in frameworks_data.values()])
+
+    row_data = {'url': url, 'ip': ip, 'port': port, 'protocol': result.get('protocol', ''),
+                'status': result.get('status', ''), 'host': result.get('host', ''),
+                'title / banner': result.get('title', ''), 'midware': result.get('midware', ''),
+                'finger_name': names, 'finger_version': versions, 'finger_vendor': vendors,
+                'finger_product': products, 'Vulnerabilities': vulns_string}
+    return row_data, url
+
+
+class GogoResultSink:
     """
-    (xlsxwriter多Sheet+格式化最终版) 解析Gogo报告，生成多Sheet的Excel，并自动设置换行和列宽。
+    gogo 结果的增量入库器 (线程安全，供多个分片线程共同写入)。
+    - 每条结果转换为报告行后按批写入 GogoFindings 表，报告阶段直接从库中读取。
+    - 新发现的 http/https URL 立即推送给 url_consumer (例如边扫描边指纹识别)。
     """
-    if not gogo_output_path or not os.path.exists(gogo_output_path) or os.path.getsize(gogo_output_path) == 0:
-        return []
-
-    # 1. 解析原始数据
-    host_results = []
+    FLUSH_SIZE = 200
+
+    def __init__(self, scan_id, company_name, url_consumer=None):
+        self.scan_id = scan_id
+        self.company_name = company_name
+        self.url_consumer = url_consumer
+        self.row_count = 0
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._conn = get_db_pool().acquire()
+        with db_transaction(self._conn):
+            self._conn.execute("DELETE FROM GogoFindings WHERE scan_id = ?", (scan_id,))
+
+    def add(self, result):
+        row_data, _ = gogo_result_to_row(result)
+        if row_data is not None:
+            self.add_row(row_data)
+
+    def add_row(self, row_data):
+        """写入一条报告行 (gogo 实时结果或扫描历史中的已知开放服务)。"""
+        url = row_data.get('url', '')
+        with self._lock:
+            self._buffer.append((self.scan_id, self.company_name, row_data['ip'], row_data['port'],
+                                 row_data['protocol'], str(row_data['status']), url,
+                                 json.dumps(row_data, ensure_ascii=False), datetime.datetime.now()))
+            self.row_count += 1
+            if len(self._buffer) >= self.FLUSH_SIZE:
+                self._flush_locked()
+        if url and self.url_consumer:
+            self.url_consumer(url)
+
+    def _flush_locked(self):
+        if not self._buffer:
+            return
+        with db_transaction(self._conn):
+            self._conn.executemany(
+                "INSERT INTO GogoFindings (scan_id, company_name, ip, port, protocol, status, url, row_json, found_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", self._buffer)
+        self._buffer = []
+
+    def close(self):
+        with self._lock:
+            self._flush_locked()
+            get_db_pool().release(self._conn)
+
+
+def ingest_gogo_output_file(gogo_output_path, company_name):
+    """将已完成的 gogo jl 文件整体导入 GogoFindings (用于未经过流式扫描的历史结果文件)。"""
+    sink = GogoResultSink(gogo_scan_id(gogo_output_path), company_name)
     try:
-        with open(gogo_output_path, 'r', encoding='utf-8') as f:
+        with open(gogo_output_path, 'r', encoding='utf-8', errors='ignore') as f:
             for line in f:
-                if line.strip():
-                    host_results.append(json.loads(line.strip()))
-    except Exception as e:
-        logging.error(f"解析gogo结果文件 '{gogo_output_path}' 失败: {e}", exc_info=True)
-        return []
+                if not line.strip():
+                    continue
+                try:
+                    sink.add(json.loads(line.strip()))
+                except json.JSONDecodeError:
+                    logging.warning(f"跳过无法解析的gogo输出行: {line.strip()[:200]}")
+    finally:
+        sink.close()
+    return sink.row_count
+
 
-    if not host_results:
-        cs_console.print(f"    [yellow]INFO:[/yellow] gogo扫描未发现有效资产记录。")
+def process_gogo_output_and_generate_excel(gogo_output_path, company_name, company_dir_path):
+    """
+    (xlsxwriter多Sheet+格式化+增量存储版) 从 GogoFindings 读取本次扫描结果，生成多Sheet的Excel。
+    - 扫描期间结果已逐条入库，这里不再重新解析 jl 文件；库中没有记录时才回退为导入文件。
+    - 延迟渲染模式 (--defer-reports) 下只写入结果数据集，不生成Excel。
+    """
+    if not gogo_output_path:
         return []
+    scan_id = gogo_scan_id(gogo_output_path)
+    db_conn = get_thread_db_conn()
+    cursor = db_conn.cursor()
+    cursor.execute("SELECT 1 FROM GogoFindings WHERE scan_id = ? LIMIT 1", (scan_id,))
+    if not cursor.fetchone():
+        if not os.path.exists(gogo_output_path) or os.path.getsize(gogo_output_path) == 0:
+            cs_console.print(f"    [yellow]INFO:[/yellow] gogo扫描未发现有效资产记录。")
+            return []
+        try:
+            ingest_gogo_output_file(gogo_output_path, company_name)
+        except Exception as e:
+            logging.error(f"解析gogo结果文件 '{gogo_output_path}' 失败: {e}", exc_info=True)
+            return []
 
-    # 2. 格式化数据
-    final_table_rows, discovered_urls = [], set()
-    cs_console.print(f"    [blue]处理:[/blue] 正在将 {len(host_results)} 条Gogo扫描结果格式化为Excel报告...")
+    cursor.execute("SELECT url, row_json FROM GogoFindings WHERE scan_id = ? ORDER BY finding_id", (scan_id,))
+    discovered_urls = set()
 
-    for result in host_results:
-        # 健壮性检查：跳过非标准资产格式的行
-        if not isinstance(result, dict) or not result.get("ip") or not result.get("port"):
-            logging.warning(f"跳过非标准资产格式的Gogo结果: {result}")
-            continue
+    def iter_rows():
+        for url, row_json in cursor:
+            if url:
+                discovered_urls.add(url)
+            yield json.loads(row_json)
 
-        protocol, ip, port = result.get('protocol', '').lower(), result.get('ip', ''), str(result.get('port', ''))
-        url = ''
-        if protocol in ['http', 'https']:
-            url = f"{protocol}://{ip}" + (f":{port}" if not (
-                    (protocol == 'http' and port == '80') or (protocol == 'https' and port == '443')) else "")
-            discovered_urls.add(url)
-
-        vulns_string = '\n'.join(result.get('vulns', {}).keys())
-        frameworks_data = result.get('frameworks', {})
-        names = '\n'.join(frameworks_data.keys())
-        versions = '\n'.join([d.get('attributes', {}).get('version', '') for d in frameworks_data.values()])
-        vendors = '\n'.join([d.get('attributes', {}).get('vendor', '') for d in frameworks_data.values()])
-        products = '\n'.join([d.get('attributes', {}).get('product', '') for d in frameworks_data.values()])
-
-        row_data = {'url': url, 'ip': ip, 'port': port, 'protocol': result.get('protocol', ''),
-                    'status': result.get('status', ''), 'host': result.get('host', ''),
-                    'title / banner': result.get('title', ''), 'midware': result.get('midware', ''),
-                    'finger_name': names, 'finger_version': versions, 'finger_vendor': vendors,
-                    'finger_product': products, 'Vulnerabilities': vulns_string}
-        final_table_rows.append(row_data)
-
-    if not final_table_rows:
+    df_all = pd.DataFrame.from_records(iter_rows(), columns=GOGO_REPORT_COLUMNS)
+    if df_all.empty:
         cs_console.print(f"    [yellow]INFO:[/yellow] gogo扫描结果中未找到可供报告的有效资产。")
         return list(discovered_urls)
+    df_all = df_all.fillna('')
+    write_result_store("gogo", company_dir_path, company_name, df_all, "gogo_report")
+    if not DEFER_REPORTS:
+        write_gogo_report_to_excel(company_dir_path, company_name, df_all)
+    return list(discovered_urls)
 
-    # 3. 创建并分类DataFrame
-    df_all = pd.DataFrame(final_table_rows)
-    final_columns = ['url', 'ip', 'port', 'protocol', 'status', 'host', 'title / banner', 'midware', 'finger_name',
-                     'finger_version', 'finger_vendor', 'finger_product', 'Vulnerabilities']
-    df_all = df_all.reindex(columns=final_columns, fill_value='')
-
-    df_all['status_str'] = df_all['status'].astype(str)
-    valid_statuses = ['open', '200', '301', '302']
-    df_valid = df_all[df_all['status_str'].isin(valid_statuses)].copy()
-    df_invalid = df_all[~df_all['status_str'].isin(valid_statuses)].copy()
 
-    df_all.drop(columns=['status_str'], inplace=True)
-    if not df_valid.empty: df_valid.drop(columns=['status_str'], inplace=True)
-    if not df_invalid.empty: df_invalid.drop(columns=['status_str'], inplace=True)
+def write_gogo_report_to_excel(company_dir_path, company_name, df_all):
+    """Gogo多Sheet报告: 原始表 / 有效表 / 无效表，有效/无效表通过布尔掩码按需切片写出，不额外保留两份完整副本。"""
+    cs_console.print(f"    [blue]处理:[/blue] 正在将 {len(df_all)} 条Gogo扫描结果格式化为Excel报告...")
+    valid_mask = df_all['status'].astype(str).isin(['open', '200', '301', '302'])
 
-    # 4. 使用xlsxwriter引擎写入并格式化Excel
+    # 使用xlsxwriter引擎写入并格式化Excel
     excel_path = os.path.join(company_dir_path,
                               f"Gogo_Full_Report{generate_filename_suffix(company_name, 'gogo_report')}.xlsx")
+    # 定义需要自动换行的列
+    wrap_columns = ['title / banner', 'finger_name', 'finger_version', 'finger_vendor', 'finger_product',
+                    'Vulnerabilities']
     try:
         with pd.ExcelWriter(excel_path, engine='xlsxwriter') as writer:
-            # 写入数据到各个Sheet
-            df_all.to_excel(writer, sheet_name="原始表", index=False)
-            if not df_valid.empty: df_valid.to_excel(writer, sheet_name="有效表", index=False)
-            if not df_invalid.empty: df_invalid.to_excel(writer, sheet_name="无效表", index=False)
-
-            workbook = writer.book
-            wrap_format = workbook.add_format({'text_wrap': True, 'valign': 'top'})
-            top_align_format = workbook.add_format({'valign': 'top'})
-            text_format = workbook.add_format({'num_format': '@', 'valign': 'top'})
-
-            # 定义需要自动换行的列
-            wrap_columns = ['title / banner', 'finger_name', 'finger_version', 'finger_vendor', 'finger_product',
-                            'Vulnerabilities']
-
-            # 遍历所有生成的Sheet，并应用格式
-            for sheet_name in writer.sheets:
-                worksheet = writer.sheets[sheet_name]
-
-                # 根据Sheet名获取对应的DataFrame以确定列
-                current_df = {"原始表": df_all, "有效表": df_valid, "无效表": df_invalid}.get(sheet_name)
-
-                if current_df is not None and not current_df.empty:
-                    # 1. 先设置列宽
-                    for col_num, col_name in enumerate(current_df.columns):
-                        # 计算合适的列宽
-                        try:
-                            max_len_content = current_df[col_name].astype(str).map(len).max()
-                            max_len = max(max_len_content, len(col_name))
-                        except (ValueError, TypeError):
-                            max_len = len(col_name)
-
-                        width = min(max_len + 5, 70)
-
-                        # 应用格式
-                        if col_name == 'url':
-                            worksheet.set_column(col_num, col_num, width, text_format)
-                        elif col_name in wrap_columns:
-                            worksheet.set_column(col_num, col_num, width, wrap_format)
-                        else:
-                            worksheet.set_column(col_num, col_num, width)
-
-                    # 2. 再设置行高
-                    for row_num in range(len(current_df)):
-                        max_lines = 1
-                        for col_name in wrap_columns:
-                            if col_name in current_df.columns:
-                                cell_value = str(current_df.iloc[row_num][col_name])
-                                num_lines = cell_value.count('\n') + 1
-                                max_lines = max(max_lines, num_lines)
-
-                        if max_lines > 1:
-                            worksheet.set_row(row_num + 1, max_lines * 15, wrap_format)
-                        else:
-                            worksheet.set_row(row_num + 1, None, top_align_format)
+            formats = create_sheet_formats(writer.book)
+            for sheet_name, mask in (("原始表", None), ("有效表", valid_mask), ("无效表", ~valid_mask)):
+                sheet_df = df_all if mask is None else df_all[mask]
+                if sheet_df.empty:
+                    continue
+                sheet_df.to_excel(writer, sheet_name=sheet_name, index=False)
+                format_excel_sheet(writer.sheets[sheet_name], sheet_df, formats, wrap_columns, max_width=70)
 
         cs_console.print(
             f"      [green]Success:[/green] Gogo详细报告 (含格式化) 已生成: '{os.path.basename(excel_path)}'")
     except Exception as e:
         logging.error(f"保存Gogo多Sheet Excel报告失败: {e}", exc_info=True)
 
-    return list(discovered_urls)
+
+class StreamingFingerprinter:
+    """
+    边扫描边指纹识别：新URL攒够 FINGERPRINT_STREAM_BATCH_SIZE 条即提交后台 observer_ward，
+    close() 时提交剩余URL并等待全部批次完成，使指纹识别与端口扫描重叠进行。
+    各批次只返回识别结果，close() 合并后每个公司、阶段只输出一份报告。
+    """
+
+    def __init__(self, company_name, company_dir, stage, batch_size=None):
+        self.company_name = company_name
+        self.company_dir = company_dir
+        self.stage = stage
+        self.batch_size = batch_size or FINGERPRINT_STREAM_BATCH_SIZE
+        self.seen_urls = set()
+        self._pending = []
+        self._futures = []
+        self._lock = threading.Lock()
+
+    def add(self, url):
+        with self._lock:
+            if url in self.seen_urls:
+                return
+            self.seen_urls.add(url)
+            self._pending.append(url)
+            if len(self._pending) >= self.batch_size:
+                self._submit_locked()
+
+    def _submit_locked(self):
+        urls, self._pending = self._pending, []
+        part = len(self._futures) + 1
+        # 批次编号只用于区分并发批次的 observer_ward 中间文件
+        stage = self.stage if part == 1 else f"{self.stage}_part{part}"
+        self._futures.append(get_fingerprint_executor().submit(self._fingerprint_batch, urls, stage))
+
+    def _fingerprint_batch(self, urls, stage):
+        urls_by_key = index_urls_by_fingerprint_key(urls)
+        return urls_by_key, (fingerprint_urls(self.company_name, self.company_dir, urls_by_key, stage)
+                             if urls_by_key else None) or {}
+
+    def close(self):
+        with self._lock:
+            if self._pending:
+                self._submit_locked()
+            futures = list(self._futures)
+        urls_by_key, rows_by_key = {}, {}
+        for future in futures:
+            try:
+                batch_urls_by_key, batch_rows_by_key = future.result()
+            except Exception as e:
+                logging.error(f"后台指纹识别批次失败 ({self.company_name}): {e}", exc_info=True)
+                continue
+            urls_by_key.update(batch_urls_by_key)
+            rows_by_key.update(batch_rows_by_key)
+        if rows_by_key:
+            write_fingerprint_report(self.company_name, self.company_dir, self.stage, urls_by_key, rows_by_key)
+        return sorted(self.seen_urls)
+
+
+_fingerprint_executor = None
+_fingerprint_executor_lock = threading.Lock()
+
+
+def get_fingerprint_executor():
+    global _fingerprint_executor
+    with _fingerprint_executor_lock:
+        if _fingerprint_executor is None:
+            _fingerprint_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, PIPELINE_WORKERS.get("fingerprint", 1)), thread_name_prefix="fingerprint-stream")
+        return _fingerprint_executor
+
+
+# ======================= 延迟报告渲染 =======================
+RESULT_STORE_META_COLUMNS = ["stage", "written_at", "report_dir", "run_id", "write_id"]
+
+
+def render_fingerprint_report(output_dir, company_name, records, stage):
+    """由结果数据集重新生成 url_fingerprint 报告: 写出CSV后在当前进程内直接转换为Excel。"""
+    output_file = write_fingerprint_csv(company_name, output_dir, stage, records)
+    if output_file:
+        _, ok, error = convert_csv_to_excel(output_file)
+        if not ok:
+            raise RuntimeError(f"转换 {os.path.basename(output_file)} 失败: {error}")
+
+
+def render_asset_diff_report(output_dir, target_name, records):
+    """按变化类型把数据集中的资产变化记录拆回 新增/消失/变更 后输出报告。"""
+    diff = {change_type: [] for change_type in ("added", "removed", "changed")}
+    for record in records:
+        change_type = record.pop(ASSET_CHANGE_TYPE_COLUMN, "")
+        if change_type in diff:
+            if change_type != "changed":
+                record.pop("变更内容", None)
+            diff[change_type].append(record)
+    write_asset_diff_report(output_dir, target_name, diff)
+
+
+def render_app_summary_report(output_dir, name, records, stage):
+    """APP/小程序汇总: 目标级汇总与输出根目录下的最终汇总共用一个 source，按阶段区分。"""
+    if stage == "final_app_summary":
+        write_final_summary_report(output_dir, records)
+    else:
+        write_summary_app_report_to_excel(output_dir, name, records)
+
+
+# source -> 渲染函数 (输出目录, 公司/目标名, 记录列表, 阶段)
+REPORT_RENDERERS = {
+    "quake": write_quake_results_to_excel,
+    "fofa": write_fofa_results_to_excel,
+    "apps": lambda output_dir, name, records, stage: write_app_results_to_excel(output_dir, name, records),
+    "fingerprint": render_fingerprint_report,
+    "gogo": lambda output_dir, name, records, stage: write_gogo_report_to_excel(output_dir, name,
+                                                                               pd.DataFrame(records)),
+    "changes": lambda output_dir, name, records, stage: render_asset_diff_report(output_dir, name, records),
+    "app_summary": render_app_summary_report,
+}
+
+
+def read_result_store_partition(partition_dir):
+    """读取一个分区目录下的全部分片 (parquet / jsonl 均可)，所有列按字符串返回。"""
+    frames = []
+    for file_name in sorted(os.listdir(partition_dir)):
+        file_path = os.path.join(partition_dir, file_name)
+        if file_name.endswith(".parquet"):
+            frames.append(pd.read_parquet(file_path))
+        elif file_name.endswith(".jsonl"):
+            frames.append(pd.read_json(file_path, orient="records", lines=True, dtype=False,
+                                       convert_dates=False, keep_default_dates=False))
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True).fillna('').astype(str)
+
+
+def select_latest_results(df):
+    """
+    每次运行都会向分区追加新分片，只保留分区内最近一次运行 (run_id 最大) 的数据，
+    避免上次运行有而本次没有的报告 (如本次未执行的阶段) 与本次结果混在一起；
+    同一运行内同一份报告 (报告目录 + 阶段) 只保留最近一次写入 (write_id 最大) 的数据。
+    没有 run_id / write_id 的旧分片回退为按秒级 written_at 排序，且总是早于新版分片。
+    """
+    if df.empty:
+        return df
+    if "run_id" in df.columns and (df["run_id"] != "").any():
+        df = df[df["run_id"] == df["run_id"].max()]
+    legacy_ids = "0-" + df["written_at"]
+    write_ids = df["write_id"].where(df["write_id"] != "", legacy_ids) if "write_id" in df.columns else legacy_ids
+    latest = write_ids.groupby([df["report_dir"], df["stage"]]).transform("max")
+    return df[write_ids == latest]
+
+
+def find_result_partitions(store_dir, targets=None, companies=None):
+    """列出需要渲染的 (source, target, company, 分区目录)；targets / companies 为空时不过滤。"""
+    partitions = []
+    for source in REPORT_RENDERERS:
+        source_dir = os.path.join(store_dir, f"source={source}")
+        if not os.path.isdir(source_dir):
+            continue
+        for target_entry in sorted(os.listdir(source_dir)):
+            target = target_entry.partition("=")[2]
+            # quake 的 _all 为 --onlyquake 的总表数据，该模式始终直接输出Excel；
+            # app_summary 的 _all 为输出根目录下的最终汇总，不属于任何目标，只在不按目标过滤时渲染
+            if (target == "_all" and (source == "quake" or targets)) or (targets and target not in targets):
+                continue
+            target_dir = os.path.join(source_dir, target_entry)
+            for company_entry in sorted(os.listdir(target_dir)):
+                company = company_entry.partition("=")[2]
+                if companies and company not in companies:
+                    continue
+                partitions.append((source, target, company, os.path.join(target_dir, company_entry)))
+    return partitions
+
+
+def _init_render_worker(output_base_dir):
+    """渲染子进程只生成Excel，不再回写结果数据集。"""
+    global OUTPUT_BASE_DIR, RESULT_STORE_FORMAT, DEFER_REPORTS
+    OUTPUT_BASE_DIR, RESULT_STORE_FORMAT, DEFER_REPORTS = output_base_dir, "none", False
+
+
+def render_result_partition(source, target, company, partition_dir):
+    """渲染一个分区内各报告的最新数据 (在子进程中执行)；返回 (分区目录, 生成的报告数, 错误信息)。"""
+    try:
+        df = read_result_store_partition(partition_dir)
+        if df.empty:
+            return partition_dir, 0, ""
+        if "report_dir" not in df.columns:
+            df["report_dir"] = target if company == "_target" else f"{target}/{company}"
+        name = target if company == "_target" else company
+        rendered = 0
+        for (report_dir, stage), group in select_latest_results(df).groupby(["report_dir", "stage"], sort=False):
+            output_dir = os.path.join(OUTPUT_BASE_DIR, *[part for part in report_dir.split("/") if part])
+            os.makedirs(output_dir, exist_ok=True)
+            records = group.drop(columns=RESULT_STORE_META_COLUMNS, errors='ignore').to_dict("records")
+            REPORT_RENDERERS[source](output_dir, name, records, stage)
+            rendered += 1
+        return partition_dir, rendered, ""
+    except Exception as e:
+        return partition_dir, 0, str(e)
+
+
+def render_result_store(targets=None, companies=None):
+    """
+    (--render) 从结果数据集按需生成Excel报告，不访问任何API与缓存数据库。
+    - 可按目标 / 公司过滤 (与分区目录名一致，即清理非法字符后的名称)。
+    - 每个分区一个任务，由 spawn 进程池并行渲染，报告写回扫描时的原目录结构。
+    """
+    store_dir = get_result_store_dir()
+    if not os.path.isdir(store_dir):
+        cs_console.print(f"[bold red]Error:[/bold red] 结果数据集目录不存在: '{store_dir}'")
+        return 0
+    partitions = find_result_partitions(store_dir, targets, companies)
+    if not partitions:
+        cs_console.print("[yellow]INFO:[/yellow] 结果数据集中没有符合条件的数据，无需渲染。")
+        return 0
+
+    workers = max(1, min(CSV_CONVERT_WORKERS, len(partitions)))
+    cs_console.print(f"[bold blue]开始渲染报告:[/bold blue] 共 {len(partitions)} 个分区，{workers} 个进程并行。")
+    rendered_total, failed = 0, 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                                initializer=_init_render_worker,
+                                                initargs=(OUTPUT_BASE_DIR,)) as executor:
+        futures = [executor.submit(render_result_partition, *partition) for partition in partitions]
+        for future in concurrent.futures.as_completed(futures):
+            partition_dir, rendered, error = future.result()
+            rendered_total += rendered
+            if error:
+                failed += 1
+                logging.error(f"渲染分区 {partition_dir} 失败: {error}")
+                cs_console.print(f"    [bold red]Error:[/bold red] 渲染分区失败: "
+                                 f"{os.path.relpath(partition_dir, store_dir)} ({error})")
+    cs_console.print(f"[green]INFO:[/green] 报告渲染完成，共生成 {rendered_total} 份报告"
+                     f"{f'，{failed} 个分区失败' if failed else ''}。")
+    return rendered_total
+
+
+# ======================= 流水线调度 =======================
+class StagedPipeline:
+    """
+    多阶段流水线调度器。
+    - 每个阶段拥有独立的工作线程数，阶段之间通过有界队列衔接，下游处理不过来时上游自动阻塞。
+    - 阶段处理函数接收一个任务，返回需要交给下一阶段的任务列表 (可为空)。
+    - 处理函数抛出异常时调用 on_error(阶段名, 任务, 异常)，其返回的任务列表同样交给下一阶段，
+      使失败的任务也能走完后续的收尾逻辑 (例如目标级计数)。
+    """
+    _STOP = object()
+
+    def __init__(self, stages, queue_size=None, on_error=None):
+        self.stages = stages  # [(阶段名, 处理函数, 线程数), ...]
+        self.on_error = on_error
+        queue_size = queue_size or PIPELINE_QUEUE_SIZE
+        self.queues = [queue.Queue(maxsize=max(1, queue_size)) for _ in stages]
+
+    def _worker(self, stage_index):
+        stage_name, handler, _ = self.stages[stage_index]
+        in_queue = self.queues[stage_index]
+        next_queue = self.queues[stage_index + 1] if stage_index + 1 < len(self.stages) else None
+        try:
+            while True:
+                item = in_queue.get()
+                if item is self._STOP:
+                    break
+                try:
+                    outputs = handler(item) or []
+                except Exception as e:
+                    logging.error(f"流水线阶段 '{stage_name}' 处理任务失败: {e}", exc_info=True)
+                    cs_console.print(f"    [bold red]Error:[/bold red] 流水线阶段 '{stage_name}' 处理任务失败 (详情见日志)。")
+                    try:
+                        outputs = self.on_error(stage_name, item, e) if self.on_error else []
+                    except Exception as handler_error:
+                        logging.error(f"流水线阶段 '{stage_name}' 失败处理出错: {handler_error}", exc_info=True)
+                        outputs = []
+                if next_queue is not None:
+                    for output in outputs:
+                        next_queue.put(output)
+        finally:
+            close_thread_db_conn()
+
+    def run(self, items):
+        stage_threads = []
+        for stage_index, (stage_name, _, workers) in enumerate(self.stages):
+            threads = [threading.Thread(target=self._worker, args=(stage_index,), name=f"{stage_name}-{n}", daemon=True)
+                       for n in range(max(1, workers))]
+            for thread in threads:
+                thread.start()
+            stage_threads.append(threads)
+
+        for item in items:
+            self.queues[0].put(item)
+        # 按阶段顺序依次关闭：上游全部退出后，下游队列中不会再有新任务
+        for stage_index, threads in enumerate(stage_threads):
+            for _ in threads:
+                self.queues[stage_index].put(self._STOP)
+            for thread in threads:
+                thread.join()
+
+
+def group_assets_by_company(parsed_quake_data, unknown_company_label):
+    """按主体单位聚合Quake记录；parsed_quake_data 可以是列表，也可以是流式迭代器。"""
+    assets_from_quake = defaultdict(lambda: {"ips": set(), "urls": set(), "allPort": set(), "raw_data": []})
+    for item in parsed_quake_data:
+        company_key = item.get("主体单位") or unknown_company_label
+        assets_from_quake[company_key]["raw_data"].append(item)
+        if item.get("IP"): assets_from_quake[company_key]["ips"].add(item.get("IP"))
+        # 从 scan_urls 字段聚合所有待扫描URL
+        if item.get("scan_urls"):
+            assets_from_quake[company_key]["urls"].update(item.get("scan_urls"))
+        if item.get("Port"): assets_from_quake[company_key]["allPort"].add(str(item.get("Port")))
+    return assets_from_quake
+
+
+def run_fofa_reverse_lookup(target_ctx, db_conn, skip_fofa_fingerprint=False):
+    target_name, target_id, target_dir = target_ctx["name"], target_ctx["target_id"], target_ctx["dir"]
+    assets_from_quake = target_ctx["assets"]
+    cs_console.print(f"\n[bold blue]>>>>>> 开始对目标 '{target_name}' 进行Fofa IP反查 <<<<<<[/bold blue]")
+    all_ips = {ip for assets in assets_from_quake.values() for ip in assets["ips"] if ip}
+    if not all_ips:
+        cs_console.print(f"    [yellow]INFO:[/yellow] 目标 '{target_name}' 未发现任何IP，跳过Fofa反查。")
+        return
+    raw_quake_for_filter = [item for assets in assets_from_quake.values() for item in assets["raw_data"]]
+    fofa_target_ips, filtered_out_ips = identify_shared_service_ips(raw_quake_for_filter)
+    fofa_output_dir = os.path.join(target_dir, "fofa_results")
+    os.makedirs(fofa_output_dir, exist_ok=True)
+    if filtered_out_ips:
+        filtered_ip_file = write_ips_to_file(fofa_output_dir, target_name, filtered_out_ips, "filtered_ips_for_fofa")
+        if filtered_ip_file:
+            cs_console.print(f"      - [dim]被过滤的共享IP已保存到 '{os.path.basename(filtered_ip_file)}'[/dim]")
+    if not fofa_target_ips:
+        cs_console.print("      [yellow]INFO:[/yellow] 过滤后无独立IP可用于Fofa反查。")
+        return
+    cs_console.print(f"    [blue]执行:[/blue] 将对过滤后的 {len(fofa_target_ips)} 个独立IP进行Fofa反查。")
+    fofa_raw_data, _ = query_fofa_by_ips(fofa_target_ips, target_id, db_conn)
+    fofa_parsed_data = parse_fofa_results(fofa_raw_data) if fofa_raw_data else []
+    if fofa_parsed_data:
+        write_fofa_results_to_excel(fofa_output_dir, target_name, fofa_parsed_data)
+        if not skip_fofa_fingerprint:
+            fofa_urls = [item["URL"] for item in fofa_parsed_data if
+                         item.get("URL", "").lower().startswith(('http://', 'https://'))]
+            if fofa_urls: run_observer_ward(target_name, fofa_output_dir, fofa_urls, stage="fingerprint_from_fofa")
+
+
+def pipeline_stage_quake(run_state, target_entry):
+    """阶段1: 获取 (缓存/API) 并解析Quake数据，按主体单位拆分为公司任务。"""
+    index, target_name = target_entry
+    db_conn = get_thread_db_conn()
+    cs_console.print(
+        f"\n[bold magenta]>>>>>> 开始处理目标 ({index}/{run_state['total_targets']}): '{target_name}' <<<<<<[/bold magenta]")
+
+    # 边拉取 (或读取缓存) 边解析边按主体单位分组，不在内存中保留完整的原始JSON列表
+    target_id = get_target_id_from_db(target_name, db_conn)
+    previous_snapshot = get_latest_quake_snapshot(target_id, db_conn) if target_id else None
+    try:
+        assets_from_quake = group_assets_by_company(open_quake_record_stream(target_name, db_conn),
+                                                    run_state["unknown_company_label"])
+    except Exception as e:
+        if not isinstance(e, QuakeQueryError):
+            logging.error(f"Quake数据处理中发生未知异常 ({target_name}): {e}", exc_info=True)
+        with run_state["lock"]:
+            run_state["failed_targets"].append({'name': target_name, 'reason': 'API查询过程失败或出错'})
+        return []
+    record_count = sum(len(assets["raw_data"]) for assets in assets_from_quake.values())
+    if not record_count:
+        with run_state["lock"]:
+            run_state["failed_targets"].append({'name': target_name, 'reason': '查询成功但无结果'})
+        cs_console.print(f"    [yellow]INFO:[/yellow] 目标 '{target_name}' 无Quake资产，跳过后续处理。")
+        return []
+
+    target_dir = os.path.join(OUTPUT_BASE_DIR, sanitize_sheet_name(target_name))
+    os.makedirs(target_dir, exist_ok=True)
+    total_companies = len(assets_from_quake)
+    cs_console.print(f"  [green]Quake数据处理完成:[/green] '{target_name}' 共 {record_count} 条记录，"
+                     f"发现 {total_companies} 个主体单位。")
+
+    # 本次运行产生了新快照时，与上一快照对比并输出资产变化报告
+    new_snapshot = get_latest_quake_snapshot(target_id, db_conn) if target_id else None
+    diff = compute_target_asset_diff(target_id, db_conn) \
+        if new_snapshot is not None and new_snapshot != previous_snapshot else None
+    if diff is not None:
+        write_asset_diff_report(target_dir, target_name, diff)
+    # 增量模式只缩小 gogo 扫描与指纹识别的输入；Quake报告、Fofa反查与APP/小程序查询仍使用完整资产
+    delta_assets = None
+    if ASSET_DIFF_DELTA_ONLY and previous_snapshot is not None:
+        # 缓存命中说明自上次运行以来没有新数据，增量为空
+        delta_records = filter_delta_records(
+            [item for assets in assets_from_quake.values() for item in assets["raw_data"]], diff) if diff else []
+        delta_assets = group_assets_by_company(delta_records, run_state["unknown_company_label"])
+        if not delta_records:
+            reason = "Quake缓存命中，自上次运行以来无新数据" if diff is None else "与上一快照相比无新增/变更资产"
+            logging.info(f"增量模式: 目标 '{target_name}' {reason}，跳过主动扫描与指纹识别。")
+            cs_console.print(f"    [yellow]INFO:[/yellow] 增量模式: 目标 '{target_name}' {reason}，"
+                             f"跳过主动扫描与指纹识别。")
+        else:
+            cs_console.print(f"    [blue]增量模式:[/blue] '{target_name}' 自上次运行以来新增/变更资产 {len(delta_records)} 条，"
+                             f"仅对这些资产进行主动扫描与指纹识别。")
+
+    if run_state["types_to_check"]:
+        # Quake分组一确定即在后台预取各主体单位的APP/小程序信息，扫描阶段直接取结果
+        prefetch_company_apps([name for name in assets_from_quake if "未知主体" not in name],
+                              run_state["types_to_check"])
+
+    target_ctx = {"name": target_name, "target_id": target_id, "dir": target_dir,
+                  "assets": assets_from_quake, "pending_companies": total_companies, "lock": threading.Lock()}
+    return [{"target": target_ctx, "name": company_name, "assets": assets, "index": company_index,
+             "total": total_companies, "fingerprint_urls": {},
+             "scan_assets": assets if delta_assets is None else delta_assets[company_name]}
+            for company_index, (company_name, assets) in enumerate(assets_from_quake.items(), 1)]
+
+
+def pipeline_stage_scan(run_state, job):
+    """
+    阶段2: 输出Quake报告，(高级模式) gogo主动扫描，查询APP/小程序。
+    扫描与指纹识别使用 scan_assets (增量模式下只含新增/变更资产)，报告使用完整资产。
+    """
+    company_name, assets, scan_assets = job["name"], job["assets"], job.get("scan_assets", job["assets"])
+    cs_console.print(
+        f"\n  ({job['index']}/{job['total']}) 处理主体单位: [cyan]{company_name}[/cyan] (目标: {job['target']['name']})")
+    company_dir = os.path.join(job["target"]["dir"], sanitize_sheet_name(company_name))
+    os.makedirs(company_dir, exist_ok=True)
+    job["dir"] = company_dir
+
+    write_quake_results_to_excel(company_dir, company_name, assets["raw_data"], stage="quake")
+    job["fingerprint_urls"]["fingerprint_from_quake"] = [url for url in scan_assets["urls"] if
+                                                         url and url.lower().startswith(('http://', 'https://'))]
+
+    company_ips_list = list(scan_assets["ips"])
+    if run_state["active_scan"] and company_ips_list:
+        ip_list_file = write_ips_to_file(company_dir, company_name, company_ips_list, "gogo_input")
+        if ip_list_file:
+            ports_to_scan = scan_assets["allPort"] | DEFAULT_PORTS
+            cs_console.print(f"\n    [blue]Gogo主动扫描准备:[/blue] {company_name}")
+            cs_console.print(f"      - [dim]将对 {len(company_ips_list)} 个IP的 {len(ports_to_scan)} 个端口进行扫描。[/dim]")
+            if FINGERPRINT_BATCH_MODE:
+                # 批量模式: gogo URL随其他阶段一起在目标级统一识别
+                gogo_output_path = run_gogo_scan(company_name, ip_list_file, list(ports_to_scan), company_dir)
+                if gogo_output_path:
+                    job["fingerprint_urls"]["fingerprint_from_gogo"] = process_gogo_output_and_generate_excel(
+                        gogo_output_path, company_name, company_dir)
+            else:
+                # gogo 发现的URL在扫描过程中即分批交给后台 observer_ward，与扫描重叠进行
+                fingerprinter = StreamingFingerprinter(company_name, company_dir, "fingerprint_from_gogo")
+                gogo_output_path = run_gogo_scan(company_name, ip_list_file, list(ports_to_scan), company_dir,
+                                                 url_consumer=fingerprinter.add)
+                if gogo_output_path:
+                    process_gogo_output_and_generate_excel(gogo_output_path, company_name, company_dir)
+                fingerprinter.close()
+
+    types_to_check = run_state["types_to_check"]
+    if types_to_check and "未知主体" not in company_name:
+        cs_console.print(f"\n    [blue]执行:[/blue] 开始查询 '{company_name}' 相关的APP/小程序信息...")
+        raw_app_data = query_apps_and_miniprograms(company_name, types_to_check)
+        if raw_app_data:
+            parsed_app_data = parse_app_results(raw_app_data)
+            write_app_results_to_excel(company_dir, company_name, parsed_app_data)
+            with run_state["lock"]:
+                run_state["apps"].extend(parsed_app_data)
+        else:
+            cs_console.print(f"      [yellow]INFO:[/yellow] 未找到 '{company_name}' 相关的APP或小程序信息。")
+    return [job]
+
+
+def pipeline_stage_fingerprint(run_state, job):
+    """
+    阶段3: 对Quake发现的URL进行指纹识别 (gogo URL已在扫描阶段流式识别)；目标下所有公司完成后交给Fofa阶段。
+    - 批量模式下只登记URL归属，由最后完成的公司对整个目标统一运行一次 observer_ward。
+    """
+    target_ctx = job["target"]
+    if not job.get("failed"):
+        if FINGERPRINT_BATCH_MODE:
+            with target_ctx["lock"]:
+                target_ctx.setdefault("fingerprint_assignments", []).extend(
+                    (job["name"], job["dir"], stage, urls) for stage, urls in job["fingerprint_urls"].items() if urls)
+        else:
+            for stage, urls in job["fingerprint_urls"].items():
+                if urls:
+                    run_observer_ward(job["name"], job["dir"], urls, stage=stage)
+        archive_intermediate_files(job["dir"], job["name"])
+    return complete_company_job(run_state, job)
+
+
+def complete_company_job(run_state, job):
+    """
+    公司任务收尾 (成功或失败都只执行一次)：目标计数减一，最后一个完成的公司负责批量指纹识别，
+    并把目标交给Fofa阶段。
+    """
+    target_ctx = job["target"]
+    with target_ctx["lock"]:
+        if job.get("completed"):
+            return []
+        job["completed"] = True
+        target_ctx["pending_companies"] -= 1
+        target_finished = target_ctx["pending_companies"] == 0
+    if target_finished and target_ctx.get("fingerprint_assignments"):
+        try:
+            run_batched_observer_ward(target_ctx["name"], target_ctx["dir"], target_ctx.pop("fingerprint_assignments"))
+            archive_intermediate_files(target_ctx["dir"], target_ctx["name"])
+        except Exception as e:
+            logging.error(f"目标 '{target_ctx['name']}' 批量指纹识别失败: {e}", exc_info=True)
+            with run_state["lock"]:
+                run_state["failed_targets"].append({'name': target_ctx["name"], 'reason': f'批量指纹识别失败: {e}'})
+    return [target_ctx] if target_finished else []
+
+
+def handle_pipeline_failure(run_state, stage_name, item, error):
+    """
+    流水线任务失败时记入自查报告。公司任务标记为失败后继续交给下游完成收尾，
+    保证目标下所有公司计数归零、Fofa反查与批量指纹识别照常执行。
+    """
+    if stage_name == "quake":
+        failed_name, outputs = item[1], []
+    elif stage_name == "fofa":
+        failed_name, outputs = item["name"], []
+    else:
+        failed_name = f"{item['target']['name']} / {item['name']}"
+        item["failed"] = True
+        cancel_company_app_prefetch(item["name"])
+        outputs = [item] if stage_name == "scan" else complete_company_job(run_state, item)
+    with run_state["lock"]:
+        run_state["failed_targets"].append({'name': failed_name, 'reason': f'{stage_name} 阶段处理异常: {error}'})
+    return outputs
+
+
+def pipeline_stage_fofa(run_state, target_ctx):
+    """阶段4: 目标级Fofa IP反查。"""
+    if not run_state["no_fofa"] and target_ctx["target_id"]:
+        run_fofa_reverse_lookup(target_ctx, get_thread_db_conn(), run_state["skip_fofa_fingerprint"])
+    return []
+
+
+def run_target_pipeline(target_names, active_scan, unknown_company_label, skip_fofa_fingerprint, no_fofa,
+                        types_to_check):
+    """以流水线方式处理全部目标，返回 (失败目标列表, APP/小程序汇总列表)。"""
+    run_state = {"total_targets": len(target_names), "active_scan": active_scan,
+                 "unknown_company_label": unknown_company_label, "skip_fofa_fingerprint": skip_fofa_fingerprint,
+                 "no_fofa": no_fofa, "types_to_check": types_to_check, "failed_targets": [], "apps": [],
+                 "lock": threading.Lock()}
+    stages = [
+        ("quake", partial(pipeline_stage_quake, run_state), PIPELINE_WORKERS.get("quake", 1)),
+        ("scan", partial(pipeline_stage_scan, run_state), PIPELINE_WORKERS.get("scan", 1)),
+        ("fingerprint", partial(pipeline_stage_fingerprint, run_state), PIPELINE_WORKERS.get("fingerprint", 1)),
+        ("fofa", partial(pipeline_stage_fofa, run_state), PIPELINE_WORKERS.get("fofa", 1)),
+    ]
+    cs_console.print(
+        "[green]INFO:[/green] 流水线并发配置: " + ", ".join(f"{name}={workers}" for name, _, workers in stages))
+    try:
+        StagedPipeline(stages, on_error=partial(handle_pipeline_failure, run_state)).run(enumerate(target_names, 1))
+    finally:
+        shutdown_app_prefetch()
+    return run_state["failed_targets"], run_state["apps"]
 
 
 # ======================= 主逻辑 =======================
@@ -1032,13 +3558,12 @@ def run_only_quake_mode(db_conn, skip_fofa_fingerprint=False, no_fofa=False, typ
         cs_console.print(
             f"\n[bold magenta]>>>>>> 开始处理目标 ({index}/{len(target_names)}): '{target_name}' <<<<<<[/bold magenta]")
 
-        # 1. 数据获取 (Quake only)
-        parsed_quake_data = check_and_get_quake_cache(target_name, db_conn)
-        if parsed_quake_data is None:
-            cs_console.print(f"    [blue]INFO:[/blue] 无有效缓存，执行实时API查询...")
-            parsed_quake_data = query_all_pages(target_name, db_conn)
-
-        if parsed_quake_data is None:
+        # 1. 数据获取 (Quake only)，与流水线共用缓存状态判断 (含错误缓存有效期)
+        try:
+            parsed_quake_data = list(open_quake_record_stream(target_name, db_conn))
+        except Exception as e:
+            if not isinstance(e, QuakeQueryError):
+                logging.error(f"Quake数据处理中发生未知异常 ({target_name}): {e}", exc_info=True)
             failed_targets.append({'name': target_name, 'reason': 'API查询过程失败或出错'})
             continue
         if not parsed_quake_data:
@@ -1058,6 +3583,7 @@ def run_only_quake_mode(db_conn, skip_fofa_fingerprint=False, no_fofa=False, typ
             # --- 核心修改部分 ---
             # 1. 创建初始DataFrame并移除指定列 (满足上一个需求)
             df = pd.DataFrame(all_quake_assets)
+            write_result_store("quake", OUTPUT_BASE_DIR, None, df, "only_quake")
             columns_to_remove = ['Host', 'scan_urls']
             df.drop(columns=columns_to_remove, inplace=True, errors='ignore')
 
@@ -1065,56 +3591,8 @@ def run_only_quake_mode(db_conn, skip_fofa_fingerprint=False, no_fofa=False, typ
             with pd.ExcelWriter(output_path, engine='xlsxwriter') as writer:
                 df.to_excel(writer, sheet_name="Quake_Data_Summary", index=False)
 
-                # 获取工作簿和工作表对象
-                workbook = writer.book
-                worksheet = writer.sheets["Quake_Data_Summary"]
-
-                # --- 定义格式 ---
-                # 自动换行 + 顶部对齐 的格式
-                wrap_format = workbook.add_format({'text_wrap': True, 'valign': 'top'})
-                # 纯文本格式 (用于URL列，防止自动生成超链接) + 顶部对齐
-                text_format = workbook.add_format({'num_format': '@', 'valign': 'top'})
-                # 默认的顶部对齐格式
-                top_align_format = workbook.add_format({'valign': 'top'})
-
-                # 定义需要自动换行的列，除了"产品指纹"，"网站标题"也可能需要
-                wrap_columns = ['产品指纹', '网站标题']
-
-                # --- 应用格式 ---
-                # (A) 设置列宽和单元格格式
-                for col_num, col_name in enumerate(df.columns):
-                    # 根据内容计算一个合适的列宽
-                    try:
-                        max_len = max(df[col_name].astype(str).map(len).max(), len(col_name))
-                    except (ValueError, TypeError):
-                        max_len = len(col_name)
-                    width = min(max_len + 5, 60)  # 宽度上限设为60，防止过宽
-
-                    # 根据列名应用不同的格式
-                    if col_name == 'URL':
-                        worksheet.set_column(col_num, col_num, width, text_format)
-                    elif col_name in wrap_columns:
-                        worksheet.set_column(col_num, col_num, width, wrap_format)
-                    else:
-                        worksheet.set_column(col_num, col_num, width, top_align_format)
-
-                # (B) 设置行高
-                for row_num in range(len(df)):
-                    max_lines = 1
-                    # 检查需要换行的列，计算哪一列的行数最多
-                    for col_name in wrap_columns:
-                        if col_name in df.columns:
-                            cell_value = str(df.iloc[row_num][col_name])
-                            # 通过计算换行符'\n'的数量来估算行数
-                            num_lines = cell_value.count('\n') + 1
-                            max_lines = max(max_lines, num_lines)
-
-                    # 如果内容超过一行，则根据最大行数设置一个合适的行高
-                    if max_lines > 1:
-                        # 15是经验值，大致为一行的磅值高度
-                        worksheet.set_row(row_num + 1, max_lines * 15)
-                    else:
-                        worksheet.set_row(row_num + 1, None, top_align_format)
+                format_excel_sheet(writer.sheets["Quake_Data_Summary"], df, create_sheet_formats(writer.book),
+                                   wrap_columns=['产品指纹', '网站标题'])
 
             cs_console.print(
                 f"  [green]Success:[/green] Quake资产总报告已保存到: '{output_path}' (共 {len(df)} 条)")
@@ -1131,103 +3609,44 @@ def run_only_quake_mode(db_conn, skip_fofa_fingerprint=False, no_fofa=False, typ
         f"\n[bold green]Quake-Only 模式结束.[/bold green] 总耗时: {round(time.time() - start_time_quake_only, 2)} 秒.")
 
 
-def run_basic_mode(db_conn, skip_fofa_fingerprint=False, no_fofa=False, types_to_check=None):
-    start_time_basic = time.time()
-    cs_console.print(f"[bold blue]基础模式启动...[/bold blue]")
+def run_diff_mode(db_conn, skip_fofa_fingerprint=False, no_fofa=False, types_to_check=None):
+    """仅根据缓存中的历史快照，输出各目标最近两次Quake查询之间的资产变化报告 (不发起任何API请求)。"""
+    start_time_diff = time.time()
+    cs_console.print(f"[bold blue]资产变化对比模式启动...[/bold blue]")
     target_names = load_queries(INPUT_FILE)
     if not target_names: return
 
-    failed_targets, grand_total_apps_list = [], []
-
+    failed_targets = []
+    totals = defaultdict(int)
     for index, target_name in enumerate(target_names, 1):
-        cs_console.print(
-            f"\n[bold magenta]>>>>>> 开始处理目标 ({index}/{len(target_names)}): '{target_name}' <<<<<<[/bold magenta]")
-
-        parsed_quake_data = check_and_get_quake_cache(target_name, db_conn)
-        if parsed_quake_data is None:
-            cs_console.print(f"    [blue]INFO:[/blue] 无有效缓存，执行实时API查询...")
-            parsed_quake_data = query_all_pages(target_name, db_conn)
-
-        if parsed_quake_data is None:
-            failed_targets.append({'name': target_name, 'reason': 'API查询过程失败或出错'});
-            continue
-        if not parsed_quake_data:
-            failed_targets.append({'name': target_name, 'reason': '查询成功但无结果'})
-            cs_console.print(f"    [yellow]INFO:[/yellow] 目标 '{target_name}' 无Quake资产，跳过后续处理。");
-            continue
-
+        cs_console.print(f"\n[bold magenta]>>>>>> 对比目标 ({index}/{len(target_names)}): '{target_name}' <<<<<<[/bold magenta]")
         target_id = get_target_id_from_db(target_name, db_conn)
+        diff = compute_target_asset_diff(target_id, db_conn) if target_id else None
+        if diff is None:
+            failed_targets.append({'name': target_name, 'reason': '历史快照不足两个，无法对比'})
+            cs_console.print(f"    [yellow]INFO:[/yellow] 目标 '{target_name}' 历史快照不足两个，跳过。")
+            continue
         target_dir = os.path.join(OUTPUT_BASE_DIR, sanitize_sheet_name(target_name))
         os.makedirs(target_dir, exist_ok=True)
+        write_asset_diff_report(target_dir, target_name, diff)
+        for change_type, records in diff.items():
+            totals[change_type] += len(records)
 
-        assets_from_quake = defaultdict(lambda: {"ips": set(), "urls": set(), "raw_data": []})
-        for item in parsed_quake_data:
-            company_key = item.get("主体单位") or "未知主体单位_Basic"
-            assets_from_quake[company_key]["raw_data"].append(item)
-            if item.get("IP"): assets_from_quake[company_key]["ips"].add(item.get("IP"))
-
-            # --- 核心修改：与高级模式同步，从新的 scan_urls 字段聚合URL ---
-            if item.get("scan_urls"):
-                assets_from_quake[company_key]["urls"].update(item.get("scan_urls"))
-
-        total_companies = len(assets_from_quake)
-        cs_console.print(f"  [green]Quake数据处理完成:[/green] 发现 {total_companies} 个主体单位。")
-
-        for company_index, (company_name, assets) in enumerate(assets_from_quake.items(), 1):
-            cs_console.print(f"\n  ({company_index}/{total_companies}) 处理主体单位: [cyan]{company_name}[/cyan]")
-            company_dir = os.path.join(target_dir, sanitize_sheet_name(company_name))
-            os.makedirs(company_dir, exist_ok=True)
-
-            write_quake_results_to_excel(company_dir, company_name, assets["raw_data"], stage="quake")
-
-            http_urls_from_quake = [url for url in assets["urls"] if
-                                    url and url.lower().startswith(('http://', 'https://'))]
-            if http_urls_from_quake:
-                run_observer_ward(company_name, company_dir, http_urls_from_quake, stage="fingerprint_from_quake")
-
-            if types_to_check and "未知主体" not in company_name:
-                cs_console.print(f"\n    [blue]执行:[/blue] 开始查询 '{company_name}' 相关的APP/小程序信息...")
-                raw_app_data = query_apps_and_miniprograms(company_name, db_conn, types_to_check)
-                if raw_app_data:
-                    parsed_app_data = parse_app_results(raw_app_data)
-                    write_app_results_to_excel(company_dir, company_name, parsed_app_data)
-                    grand_total_apps_list.extend(parsed_app_data)
-                else:
-                    cs_console.print(f"      [yellow]INFO:[/yellow] 未找到 '{company_name}' 相关的APP或小程序信息。")
-
-            archive_intermediate_files(company_dir, company_name)
-
-        if not no_fofa and target_id:
-            cs_console.print(f"\n[bold blue]>>>>>> 开始对目标 '{target_name}' 进行Fofa IP反查 <<<<<<[/bold blue]")
-            all_ips = {ip for assets in assets_from_quake.values() for ip in assets["ips"] if ip}
-            if all_ips:
-                fofa_target_ips, filtered_out_ips = identify_shared_service_ips(parsed_quake_data)
-                fofa_output_dir = os.path.join(target_dir, "fofa_results")
-                os.makedirs(fofa_output_dir, exist_ok=True)
-                if filtered_out_ips:
-                    filtered_ip_file = write_ips_to_file(fofa_output_dir, target_name, filtered_out_ips,
-                                                         "filtered_ips_for_fofa")
-                    if filtered_ip_file:
-                        cs_console.print(
-                            f"      - [dim]被过滤的共享IP已保存到 '{os.path.basename(filtered_ip_file)}'[/dim]")
-                if fofa_target_ips:
-                    cs_console.print(
-                        f"    [blue]执行:[/blue] 将对过滤后的 {len(fofa_target_ips)} 个独立IP进行Fofa反查。")
-                    fofa_parsed_data = check_and_get_fofa_cache(target_id, db_conn)
-                    if fofa_parsed_data is None:
-                        fofa_raw_data, _ = query_fofa_by_ips(fofa_target_ips, target_id, db_conn)
-                        fofa_parsed_data = parse_fofa_results(fofa_raw_data) if fofa_raw_data else []
-                    if fofa_parsed_data:
-                        write_fofa_results_to_excel(fofa_output_dir, target_name, fofa_parsed_data)
-                        if not skip_fofa_fingerprint:
-                            fofa_urls = [item["URL"] for item in fofa_parsed_data if
-                                         item.get("URL", "").lower().startswith(('http://', 'https://'))]
-                            if fofa_urls: run_observer_ward(target_name, fofa_output_dir, fofa_urls,
-                                                            stage="fingerprint_from_fofa")
-                else:
-                    cs_console.print("      [yellow]INFO:[/yellow] 过滤后无独立IP可用于Fofa反查。")
-            else:
-                cs_console.print(f"    [yellow]INFO:[/yellow] 目标 '{target_name}' 未发现任何IP，跳过Fofa反查。")
+    create_self_check_report(failed_targets, db_conn, "diff")
+    cs_console.print(
+        f"\n[bold green]资产变化对比模式结束.[/bold green] 新增 {totals['added']}，消失 {totals['removed']}，"
+        f"变更 {totals['changed']}。总耗时: {round(time.time() - start_time_diff, 2)} 秒.")
+
+
+def run_basic_mode(db_conn, skip_fofa_fingerprint=False, no_fofa=False, types_to_check=None):
+    start_time_basic = time.time()
+    cs_console.print(f"[bold blue]基础模式启动...[/bold blue]")
+    target_names = load_queries(INPUT_FILE)
+    if not target_names: return
+
+    failed_targets, grand_total_apps_list = run_target_pipeline(
+        target_names, active_scan=False, unknown_company_label="未知主体单位_Basic",
+        skip_fofa_fingerprint=skip_fofa_fingerprint, no_fofa=no_fofa, types_to_check=types_to_check)
 
     if grand_total_apps_list:
         write_final_summary_report(OUTPUT_BASE_DIR, grand_total_apps_list)
@@ -1243,116 +3662,10 @@ def run_advanced_mode(db_conn, skip_fofa_fingerprint=False, no_fofa=False, types
     cs_console.print(f"[bold blue]高级模式启动 (Gogo集成)...[/bold blue]")
     target_names = load_queries(INPUT_FILE)
     if not target_names: return
-    failed_targets, grand_total_apps_list = [], []
 
-    for index, target_name in enumerate(target_names, 1):
-        cs_console.print(
-            f"\n[bold magenta]>>>>>> 开始处理目标 ({index}/{len(target_names)}): '{target_name}' <<<<<<[/bold magenta]")
-
-        parsed_quake_data = check_and_get_quake_cache(target_name, db_conn)
-        if parsed_quake_data is None:
-            cs_console.print(f"    [blue]INFO:[/blue] 无有效缓存，执行实时API查询...")
-            parsed_quake_data = query_all_pages(target_name, db_conn)
-
-        if parsed_quake_data is None:
-            failed_targets.append({'name': target_name, 'reason': 'API查询过程失败或出错'});
-            continue
-        if not parsed_quake_data:
-            failed_targets.append({'name': target_name, 'reason': '查询成功但无结果'})
-            cs_console.print(f"    [yellow]INFO:[/yellow] 目标 '{target_name}' 无Quake资产，跳过后续处理。");
-            continue
-
-        target_id = get_target_id_from_db(target_name, db_conn)
-        target_dir = os.path.join(OUTPUT_BASE_DIR, sanitize_sheet_name(target_name))
-        os.makedirs(target_dir, exist_ok=True)
-
-        assets_from_quake = defaultdict(lambda: {"ips": set(), "urls": set(), "allPort": set(), "raw_data": []})
-        for item in parsed_quake_data:
-            company_key = item.get("主体单位") or "未知主体单位_Advanced"
-            assets_from_quake[company_key]["raw_data"].append(item)
-            if item.get("IP"): assets_from_quake[company_key]["ips"].add(item.get("IP"))
-
-            # --- 核心修改：从新的 scan_urls 字段聚合所有待扫描URL ---
-            if item.get("scan_urls"):
-                assets_from_quake[company_key]["urls"].update(item.get("scan_urls"))
-
-            if item.get("Port"): assets_from_quake[company_key]["allPort"].add(str(item.get("Port")))
-
-        total_companies = len(assets_from_quake)
-        cs_console.print(f"  [green]Quake数据处理完成:[/green] 发现 {total_companies} 个主体单位。")
-
-        for company_index, (company_name, assets) in enumerate(assets_from_quake.items(), 1):
-            cs_console.print(f"\n  ({company_index}/{total_companies}) 处理主体单位: [cyan]{company_name}[/cyan]")
-            company_dir = os.path.join(target_dir, sanitize_sheet_name(company_name))
-            os.makedirs(company_dir, exist_ok=True)
-
-            write_quake_results_to_excel(company_dir, company_name, assets["raw_data"], stage="quake")
-
-            http_urls_from_quake = [url for url in assets["urls"] if
-                                    url and url.lower().startswith(('http://', 'https://'))]
-            if http_urls_from_quake:
-                run_observer_ward(company_name, company_dir, http_urls_from_quake, stage="fingerprint_from_quake")
-
-            # ... 后续 Gogo, Fofa, APP 查询逻辑保持不变 ...
-            company_ips_list = list(assets["ips"])
-            if company_ips_list:
-                ip_list_file = write_ips_to_file(company_dir, company_name, company_ips_list, "gogo_input")
-                if ip_list_file:
-                    ports_to_scan = assets["allPort"] | DEFAULT_PORTS
-                    cs_console.print(f"\n    [blue]Gogo主动扫描准备:[/blue]")
-                    cs_console.print(
-                        f"      - [dim]将对 {len(company_ips_list)} 个IP的 {len(ports_to_scan)} 个端口进行扫描。[/dim]")
-                    gogo_output_path = run_gogo_scan(company_name, ip_list_file, list(ports_to_scan), company_dir)
-                    if gogo_output_path:
-                        new_urls_from_gogo = process_gogo_output_and_generate_excel(gogo_output_path, company_name,
-                                                                                    company_dir)
-                        if new_urls_from_gogo:
-                            run_observer_ward(company_name, company_dir, new_urls_from_gogo, "fingerprint_from_gogo")
-
-            if types_to_check and "未知主体" not in company_name:
-                cs_console.print(f"\n    [blue]执行:[/blue] 开始查询 '{company_name}' 相关的APP/小程序信息...")
-                raw_app_data = query_apps_and_miniprograms(company_name, db_conn, types_to_check)
-                if raw_app_data:
-                    parsed_app_data = parse_app_results(raw_app_data)
-                    write_app_results_to_excel(company_dir, company_name, parsed_app_data)
-                    grand_total_apps_list.extend(parsed_app_data)
-                else:
-                    cs_console.print(f"      [yellow]INFO:[/yellow] 未找到 '{company_name}' 相关的APP或小程序信息。")
-
-            archive_intermediate_files(company_dir, company_name)
-
-        if not no_fofa and target_id:
-            cs_console.print(f"\n[bold blue]>>>>>> 开始对目标 '{target_name}' 进行Fofa IP反查 <<<<<<[/bold blue]")
-            all_ips = {ip for assets in assets_from_quake.values() for ip in assets["ips"] if ip}
-            raw_quake_for_filter = [item for assets in assets_from_quake.values() for item in assets["raw_data"]]
-            if all_ips:
-                fofa_target_ips, filtered_out_ips = identify_shared_service_ips(raw_quake_for_filter)
-                fofa_output_dir = os.path.join(target_dir, "fofa_results")
-                os.makedirs(fofa_output_dir, exist_ok=True)
-                if filtered_out_ips:
-                    filtered_ip_file = write_ips_to_file(fofa_output_dir, target_name, filtered_out_ips,
-                                                         "filtered_ips_for_fofa")
-                    if filtered_ip_file:
-                        cs_console.print(
-                            f"      - [dim]被过滤的共享IP已保存到 '{os.path.basename(filtered_ip_file)}'[/dim]")
-                if fofa_target_ips:
-                    cs_console.print(
-                        f"    [blue]执行:[/blue] 将对过滤后的 {len(fofa_target_ips)} 个独立IP进行Fofa反查。")
-                    fofa_parsed_data = check_and_get_fofa_cache(target_id, db_conn)
-                    if fofa_parsed_data is None:
-                        fofa_raw_data, _ = query_fofa_by_ips(fofa_target_ips, target_id, db_conn)
-                        fofa_parsed_data = parse_fofa_results(fofa_raw_data) if fofa_raw_data else []
-                    if fofa_parsed_data:
-                        write_fofa_results_to_excel(fofa_output_dir, target_name, fofa_parsed_data)
-                        if not skip_fofa_fingerprint:
-                            fofa_urls = [item["URL"] for item in fofa_parsed_data if
-                                         item.get("URL", "").lower().startswith(('http://', 'https://'))]
-                            if fofa_urls: run_observer_ward(target_name, fofa_output_dir, fofa_urls,
-                                                            stage="fingerprint_from_fofa")
-                else:
-                    cs_console.print("      [yellow]INFO:[/yellow] 过滤后无独立IP可用于Fofa反查。")
-            else:
-                cs_console.print(f"    [yellow]INFO:[/yellow] 目标 '{target_name}' 未发现任何IP，跳过Fofa反查。")
+    failed_targets, grand_total_apps_list = run_target_pipeline(
+        target_names, active_scan=True, unknown_company_label="未知主体单位_Advanced",
+        skip_fofa_fingerprint=skip_fofa_fingerprint, no_fofa=no_fofa, types_to_check=types_to_check)
 
     if grand_total_apps_list:
         write_final_summary_report(OUTPUT_BASE_DIR, grand_total_apps_list)
@@ -1363,7 +3676,13 @@ def run_advanced_mode(db_conn, skip_fofa_fingerprint=False, no_fofa=False, types
 
 
 def main():
-    global SHOW_SCAN_INFO, INPUT_FILE, API_KEY, OUTPUT_BASE_DIR, FOFA_EMAIL, FOFA_KEY, WERPLUS_API_KEY
+    global SHOW_SCAN_INFO, INPUT_FILE, API_KEY, OUTPUT_BASE_DIR, FOFA_EMAIL, FOFA_KEY, WERPLUS_API_KEY, \
+        PIPELINE_QUEUE_SIZE, HTTP_MAX_RETRIES, QUAKE_RESUME, STORE_QUAKE_RAW_JSON, GOGO_MAX_PROCESSES, \
+        GOGO_THREAD_BUDGET, GOGO_CHUNK_SIZE, FINGERPRINT_CACHE_TTL_HOURS, \
+        FINGERPRINT_BATCH_MODE, FOFA_CONCURRENCY, FOFA_CIDR_MIN_IPS, EMPTY_CACHE_EXPIRY_HOURS, ERROR_CACHE_EXPIRY_HOURS, \
+        RAW_JSON_COMPRESSION, CACHE_KEEP_SNAPSHOTS, CACHE_AUTO_GC, ASSET_DIFF_DELTA_ONLY, \
+        GOGO_INCREMENTAL, SCAN_HISTORY_TTL_HOURS, ASSET_DEDUPE, CSV_CONVERT_WORKERS, \
+        RESULT_STORE_FORMAT, RESULT_STORE_DIR, DEFER_REPORTS
 
     parser = argparse.ArgumentParser(
         description="ICP Asset Express - Gogo 集成版: 自动化ICP备案资产梳理与安全评估工具。",
@@ -1373,12 +3692,22 @@ def main():
       python {os.path.basename(__file__)} --onlyquake -i my_targets.txt
       python {os.path.basename(__file__)} -a -i my_targets.txt -o ./my_scan_results
       python {os.path.basename(__file__)} -b --apikey YOUR_KEY -checkother app,mapp
+      python {os.path.basename(__file__)} -a --defer-reports -o ./my_scan_results
+      python {os.path.basename(__file__)} --render -o ./my_scan_results --render-companies 公司A,公司B
     """
     )
     # --- 核心修改 1: 将新参数加入互斥组 ---
     mode_group = parser.add_mutually_exclusive_group()
     mode_group.add_argument('--onlyquake', action='store_true', help="仅查询Quake资产并输出表格，不进行任何主动扫描")
     mode_group.add_argument('-b', '--basic', action='store_true', help="运行基础模式")
+    mode_group.add_argument('--cache-stats', action='store_true', help="输出缓存数据库大小与原始JSON压缩率后退出")
+    mode_group.add_argument('--diff', action='store_true',
+                            help="仅根据缓存的历史快照输出各目标最近两次查询之间的资产变化报告 (新增/消失/变更)")
+    mode_group.add_argument('--cache-gc', action='store_true',
+                            help="清理过期/被取代的缓存数据，按保留策略淘汰历史快照并回收数据库空间后退出 "
+                                 "(使用 zstd 且尚无压缩字典时同时训练字典)")
+    mode_group.add_argument('--render', action='store_true',
+                            help="从结果数据集按需并行生成Excel报告后退出 (配合 --defer-reports，需 -o 指定扫描输出目录)")
     mode_group.add_argument('-a', '--advanced', action='store_true', help="运行高级模式 (使用gogo进行扫描, 默认)")
 
     parser.add_argument('-i', '--input', type=str, help=f"指定输入文件名。默认为: '{INPUT_FILE}'。")
@@ -1388,27 +3717,150 @@ def main():
     parser.add_argument('--fofa-key', type=str, help="Fofa API Key")
     parser.add_argument('--werplus-key', type=str, help="wer.plus API Key")
     parser.add_argument('--showScanInfo', action='store_true', help="显示外部扫描工具的实时运行输出。")
+    parser.add_argument('--resume', action='store_true', help="从上次中断的Quake翻页检查点继续查询 (断点续传)。")
+    parser.add_argument('--no-raw-json', action='store_true',
+                        help="缓存中仅保存规范化的Quake资产字段，不再保存原始JSON (减小数据库体积)。")
     parser.add_argument('--skip-fofa-fingerprint', action='store_true', help="跳过对Fofa反查结果的URL进行指纹识别。")
     parser.add_argument('--no-fofa', action='store_true', help="完全跳过Fofa IP反查流程。")
     parser.add_argument('-checkother', type=str, help="查询额外信息，多个用逗号分隔 (app,mapp)。")
+    parser.add_argument('--workers', type=str,
+                        help="流水线各阶段并发线程数，格式 阶段=数量，多个用逗号分隔。\n"
+                             f"阶段: quake,scan,fingerprint,fofa。默认: "
+                             f"{','.join(f'{k}={v}' for k, v in PIPELINE_WORKERS.items())}")
+    parser.add_argument('--queue-size', type=int, help=f"流水线阶段间队列长度。默认为: {PIPELINE_QUEUE_SIZE}。")
+    parser.add_argument('--gogo-procs', type=int, help=f"同时运行的gogo进程数上限。默认为: {GOGO_MAX_PROCESSES}。")
+    parser.add_argument('--gogo-threads', type=int,
+                        help=f"gogo线程总预算，平均分配给各进程。默认为: {GOGO_THREAD_BUDGET}。")
+    parser.add_argument('--gogo-chunk', type=int, help=f"gogo每个扫描分片的IP数量。默认为: {GOGO_CHUNK_SIZE}。")
+    parser.add_argument('--no-dedupe', action='store_true',
+                        help="关闭跨目标去重 (默认同一次运行中每个 IP:端口 与URL只扫描/识别一次，结果归属到所有主体)。")
+    parser.add_argument('--incremental-scan', action='store_true',
+                        help="增量gogo扫描: 只扫描新出现或超过复扫有效期的 IP:端口，历史开放服务直接并入报告。")
+    parser.add_argument('--rescan-ttl', type=float,
+                        help=f"IP:端口 扫描记录的复扫有效期 (小时)。默认为: {SCAN_HISTORY_TTL_HOURS}。")
+    parser.add_argument('--batch-fingerprint', action='store_true',
+                        help="批量指纹识别: 每个目标只运行一次 observer_ward，再按URL归属拆分回各公司报告。")
+    parser.add_argument('--convert-workers', type=int,
+                        help=f"指纹结果 CSV→Excel 转换及 --render 报告渲染的并行进程数。默认为: {CSV_CONVERT_WORKERS}。")
+    parser.add_argument('--fofa-concurrency', type=int,
+                        help=f"同时进行的Fofa查询批次数。默认为: {FOFA_CONCURRENCY}。")
+    parser.add_argument('--fofa-cidr-min-ips', type=int,
+                        help=f"同一 /24 网段内待查IP达到该数量时改用网段查询 (会消耗网段内其他IP的结果配额)，"
+                             f"0 表示不使用。默认为: {FOFA_CIDR_MIN_IPS}。")
+    parser.add_argument('--empty-ttl', type=float,
+                        help=f"空结果缓存有效期 (小时)，0 表示总是重新查询。默认为: {EMPTY_CACHE_EXPIRY_HOURS}。")
+    parser.add_argument('--error-ttl', type=float,
+                        help=f"查询失败缓存有效期 (小时)，0 表示总是重试。默认为: {ERROR_CACHE_EXPIRY_HOURS}。")
+    parser.add_argument('--delta-only', action='store_true',
+                        help="增量模式: 只对自上次运行以来新增/变更的资产进行主动扫描与指纹识别。")
+    parser.add_argument('--keep-snapshots', type=int,
+                        help=f"缓存清理时每个目标保留的历史快照数 (资产对比至少需要2个)。默认为: {CACHE_KEEP_SNAPSHOTS}。")
+    parser.add_argument('--auto-gc', action='store_true', help="每次运行结束后自动执行缓存清理。")
+    parser.add_argument('--result-store', choices=['auto', 'parquet', 'jsonl', 'none'],
+                        help=f"结果数据集格式 (按 source/target/company 分区，与Excel同时输出；parquet 需安装可选依赖 pyarrow；auto 在未安装时回退为 jsonl)。"
+                             f"默认为: {RESULT_STORE_FORMAT}。")
+    parser.add_argument('--store-dir', type=str, help="结果数据集目录。默认为: <输出目录>/_dataset。")
+    parser.add_argument('--defer-reports', action='store_true',
+                        help="延迟渲染: 扫描期间只写结果数据集，不生成各公司的Excel报告 (之后使用 --render 生成)。")
+    parser.add_argument('--render-targets', type=str, help="--render 时只生成这些目标的报告，多个用逗号分隔。")
+    parser.add_argument('--render-companies', type=str, help="--render 时只生成这些公司的报告，多个用逗号分隔。")
+    parser.add_argument('--raw-compression', choices=['auto', 'zstd', 'zlib', 'none'],
+                        help=f"原始JSON压缩存储方式 (zstd 需安装可选依赖 zstandard；auto 在未安装时回退为 zlib)。"
+                             f"默认为: {RAW_JSON_COMPRESSION}。")
+    parser.add_argument('--fingerprint-ttl', type=float,
+                        help=f"URL指纹缓存有效期 (小时)，0 表示不使用缓存。默认为: {FINGERPRINT_CACHE_TTL_HOURS}。")
+    parser.add_argument('--http-retries', type=int,
+                        help=f"API请求遇到网络错误/5xx时的最大重试次数。默认为: {HTTP_MAX_RETRIES}。")
+    parser.add_argument('--rate-limit', type=str,
+                        help="各API平台限速，格式 平台=每秒请求数[:突发数]，多个用逗号分隔 (quake,fofa,werplus)。\n"
+                             "例如: quake=0.5:2,fofa=1")
     args = parser.parse_args()
 
     # --- 核心修改 2: 调整模式选择逻辑 ---
-    if not args.onlyquake and not args.basic and not args.advanced:
+    if not args.onlyquake and not args.basic and not args.advanced and not args.cache_stats \
+            and not args.cache_gc and not args.diff and not args.render:
         args.advanced = True  # 如果不指定任何模式，默认为高级模式
 
     SHOW_SCAN_INFO = args.showScanInfo
+    QUAKE_RESUME = args.resume
+    STORE_QUAKE_RAW_JSON = not args.no_raw_json
     if args.input: INPUT_FILE = args.input
     if args.apikey: API_KEY = args.apikey
     if args.fofa_email: FOFA_EMAIL = args.fofa_email
     if args.fofa_key: FOFA_KEY = args.fofa_key
     if args.werplus_key: WERPLUS_API_KEY = args.werplus_key
     types_to_check = [t.strip().lower() for t in args.checkother.split(',')] if args.checkother else []
+    if args.workers:
+        for item in args.workers.split(','):
+            stage, _, count = item.partition('=')
+            if stage.strip() not in PIPELINE_WORKERS or not count.strip().isdigit():
+                parser.error(f"无效的 --workers 配置项: '{item}'")
+            PIPELINE_WORKERS[stage.strip()] = max(1, int(count))
+    if args.queue_size: PIPELINE_QUEUE_SIZE = args.queue_size
+    if args.gogo_procs: GOGO_MAX_PROCESSES = args.gogo_procs
+    if args.gogo_threads: GOGO_THREAD_BUDGET = args.gogo_threads
+    if args.gogo_chunk: GOGO_CHUNK_SIZE = args.gogo_chunk
+    FINGERPRINT_BATCH_MODE = args.batch_fingerprint
+    GOGO_INCREMENTAL = args.incremental_scan
+    ASSET_DEDUPE = not args.no_dedupe
+    if args.rescan_ttl is not None: SCAN_HISTORY_TTL_HOURS = max(0, args.rescan_ttl)
+    if args.convert_workers: CSV_CONVERT_WORKERS = max(1, args.convert_workers)
+    if args.fofa_concurrency: FOFA_CONCURRENCY = max(1, args.fofa_concurrency)
+    if args.fofa_cidr_min_ips is not None: FOFA_CIDR_MIN_IPS = max(0, args.fofa_cidr_min_ips)
+    if args.empty_ttl is not None: EMPTY_CACHE_EXPIRY_HOURS = max(0, args.empty_ttl)
+    if args.error_ttl is not None: ERROR_CACHE_EXPIRY_HOURS = max(0, args.error_ttl)
+    if args.fingerprint_ttl is not None: FINGERPRINT_CACHE_TTL_HOURS = max(0, args.fingerprint_ttl)
+    if args.raw_compression: RAW_JSON_COMPRESSION = args.raw_compression
+    if args.result_store: RESULT_STORE_FORMAT = args.result_store
+    if args.store_dir: RESULT_STORE_DIR = args.store_dir
+    DEFER_REPORTS = args.defer_reports
+    if DEFER_REPORTS and get_result_store_format() == "none":
+        parser.error("--defer-reports 需要启用结果数据集，不能与 --result-store none 同时使用")
+    if args.render and not args.output:
+        parser.error("--render 需要通过 -o 指定扫描时使用的输出目录")
+    if args.keep_snapshots: CACHE_KEEP_SNAPSHOTS = max(1, args.keep_snapshots)
+    CACHE_AUTO_GC = args.auto_gc
+    ASSET_DIFF_DELTA_ONLY = args.delta_only
+    if args.http_retries is not None: HTTP_MAX_RETRIES = max(0, args.http_retries)
+    if args.rate_limit:
+        for item in args.rate_limit.split(','):
+            provider, _, spec = item.partition('=')
+            rate, _, burst = spec.partition(':')
+            try:
+                RATE_LIMITS[provider.strip()] = {"rate": float(rate), "burst": float(burst) if burst else 1}
+            except ValueError:
+                parser.error(f"无效的 --rate-limit 配置项: '{item}'")
+
+    if args.cache_stats or args.cache_gc:
+        configure_logging("log_icp_cache_maintenance.txt")
+        db_conn = initialize_database()
+        if db_conn:
+            if args.cache_gc:
+                if _current_zstd_dict_id is None:
+                    train_zstd_dict(db_conn)
+                report_cache_gc(run_cache_gc(db_conn))
+            report_cache_stats(db_conn)
+            db_conn.close()
+            close_db_pool()
+        return
+
+    if args.render:
+        configure_logging("log_icp_render.txt")
+        OUTPUT_BASE_DIR = args.output
+        render_start_time = time.time()
+        render_result_store(
+            {sanitize_sheet_name(name.strip()) for name in (args.render_targets or "").split(',') if name.strip()},
+            {sanitize_sheet_name(name.strip()) for name in (args.render_companies or "").split(',') if name.strip()})
+        cs_console.print(f"报告渲染耗时: {time.time() - render_start_time:.2f} 秒.")
+        return
 
     # 根据模式设置函数、日志和输出目录
     if args.onlyquake:
         mode_name = "only_quake"
         chosen_mode_function = run_only_quake_mode
+    elif args.diff:
+        mode_name = "diff"
+        chosen_mode_function = run_diff_mode
     elif args.basic:
         mode_name = "basic"
         chosen_mode_function = run_basic_mode
@@ -1432,8 +3884,13 @@ def main():
         f"[bold underline green]启动 {mode_name.replace('_', '-').capitalize()} 模式[/bold underline green]")
     # 调用选定的主函数
     chosen_mode_function(db_conn, args.skip_fofa_fingerprint, args.no_fofa, types_to_check)
+    if db_conn and CACHE_AUTO_GC:
+        report_cache_gc(run_cache_gc(db_conn))
 
     if db_conn: db_conn.close()
+    close_db_pool()
+    report_rate_limiter_stats()
+    report_asset_dedupe_stats()
 
     overall_duration = time.time() - script_start_time
     cs_console.print(
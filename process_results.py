@@ -1,7 +1,13 @@
+import concurrent.futures
+import datetime
 import os
+import pickle
 import shutil
+import tempfile
 import pandas as pd
 import argparse
+import openpyxl
+import xlsxwriter
 from rich.console import Console
 from rich.theme import Theme
 
@@ -14,59 +20,71 @@ custom_theme = Theme({
 })
 console = Console(theme=custom_theme)
 
-def convert_csvs_in_tree(root_path: str):
+VALID_STATUS_CODES = (200, 301, 302)
+
+
+def convert_csv_file(csv_path: str):
     """
-    递归遍历指定路径，将所有.csv文件转换为格式化的.xlsx文件。
-    转换成功后删除原始的.csv文件。
+    将单个.csv文件转换为格式化的.xlsx文件 (在子进程中执行)，转换成功后删除原始的.csv文件。
+    CSV只读取一次，有效/无效表通过状态码布尔掩码切片写出；返回 (文件名, 状态, 附加信息)。
     """
-    console.print("\n--- [bold info]阶段一: 开始转换 .csv 文件为 .xlsx[/bold info] ---")
-    converted_count = 0
-    for dirpath, _, filenames in os.walk(root_path):
-        for filename in filenames:
-            if not filename.lower().endswith(".csv"):
-                continue
+    filename = os.path.basename(csv_path)
+    excel_path = os.path.splitext(csv_path)[0] + ".xlsx"
+    try:
+        # 尝试用不同编码读取CSV，增加兼容性
+        try:
+            df = pd.read_csv(csv_path, encoding='utf-8-sig')
+        except UnicodeDecodeError:
+            df = pd.read_csv(csv_path, encoding='gbk')
 
-            csv_path = os.path.join(dirpath, filename)
-            excel_path = os.path.splitext(csv_path)[0] + ".xlsx"
-            
-            console.print(f"  [info]发现CSV文件:[/info] [cyan]{filename}[/cyan]")
-            try:
-                # 尝试用不同编码读取CSV，增加兼容性
-                try:
-                    df = pd.read_csv(csv_path, encoding='utf-8-sig')
-                except UnicodeDecodeError:
-                    df = pd.read_csv(csv_path, encoding='gbk')
+        if df.empty:
+            os.remove(csv_path)
+            return filename, "empty", ""
 
-                if df.empty:
-                    console.print(f"  [warning]警告: CSV文件为空，将直接删除: {filename}[/warning]")
-                    os.remove(csv_path)
-                    continue
+        # 使用 xlsxwriter 引擎写入多工作表的Excel
+        with pd.ExcelWriter(excel_path, engine='xlsxwriter',
+                            engine_kwargs={'options': {'strings_to_urls': False}}) as writer:
+            df.to_excel(writer, sheet_name="原始数据", index=False)
+            # 如果是指纹识别结果，则额外创建有效/无效表
+            if 'status_code' in df.columns:
+                df['status_code'] = pd.to_numeric(df['status_code'], errors='coerce').fillna(0).astype(int)
+                valid_mask = df['status_code'].isin(VALID_STATUS_CODES)
+                if valid_mask.any():
+                    df[valid_mask].to_excel(writer, sheet_name="有效表", index=False)
+                if not valid_mask.all():
+                    df[~valid_mask].to_excel(writer, sheet_name="无效表", index=False)
 
-                # 使用 openpyxl 引擎写入多工作表的Excel
-                with pd.ExcelWriter(excel_path, engine='openpyxl') as writer:
-                    df.to_excel(writer, sheet_name="原始数据", index=False)
-                    # 如果是指纹识别结果，则额外创建有效/无效表
-                    if 'status_code' in df.columns:
-                        df_copy = df.copy()
-                        df_copy['status_code'] = pd.to_numeric(df_copy['status_code'], errors='coerce').fillna(0).astype(int)
-                        valid_codes = [200, 301, 302]
-                        df_valid = df_copy[df_copy['status_code'].isin(valid_codes)]
-                        df_invalid = df_copy[~df_copy['status_code'].isin(valid_codes)]
-                        
-                        if not df_valid.empty:
-                            df_valid.to_excel(writer, sheet_name="有效表", index=False)
-                        if not df_invalid.empty:
-                            df_invalid.to_excel(writer, sheet_name="无效表", index=False)
-
-                os.remove(csv_path)
-                console.print(f"  [success]转换成功:[/success] [green]{filename}[/green] -> [green]{os.path.basename(excel_path)}[/green]")
-                converted_count += 1
+        os.remove(csv_path)
+        return filename, "converted", os.path.basename(excel_path)
+    except Exception as e:
+        return filename, "error", str(e)
 
-            except Exception as e:
-                console.print(f"  [error]错误: 处理文件 {filename} 失败: {e}[/error]")
 
-    if converted_count == 0:
+def convert_csvs_in_tree(root_path: str, workers: int = None):
+    """
+    递归遍历指定路径，将所有.csv文件转换为格式化的.xlsx文件。
+    多个文件通过进程池并行转换，转换成功后删除原始的.csv文件。
+    """
+    console.print("\n--- [bold info]阶段一: 开始转换 .csv 文件为 .xlsx[/bold info] ---")
+    csv_paths = [os.path.join(dirpath, filename) for dirpath, _, filenames in os.walk(root_path)
+                 for filename in filenames if filename.lower().endswith(".csv")]
+    if not csv_paths:
         console.print("[info]未发现需要转换的 .csv 文件。[/info]")
+        return
+
+    console.print(f"  [info]发现 {len(csv_paths)} 个CSV文件，开始并行转换...[/info]")
+    converted_count = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        for filename, status, detail in pool.map(convert_csv_file, csv_paths):
+            if status == "converted":
+                console.print(f"  [success]转换成功:[/success] [green]{filename}[/green] -> [green]{detail}[/green]")
+                converted_count += 1
+            elif status == "empty":
+                console.print(f"  [warning]警告: CSV文件为空，已直接删除: {filename}[/warning]")
+            else:
+                console.print(f"  [error]错误: 处理文件 {filename} 失败: {detail}[/error]")
+    console.print(f"[info]CSV转换完成: {converted_count}/{len(csv_paths)} 个文件。[/info]")
+
 
 def archive_files_in_tree(root_path: str):
     """
@@ -104,93 +122,208 @@ def archive_files_in_tree(root_path: str):
         console.print("[info]未发现需要归档的 .txt 或 .json 文件。[/info]")
 
 
+# --- 合并规则: 文件名前缀 -> 合并输出文件、需要合并的Sheet (源Sheet名, 输出Sheet名; None 表示第一个Sheet)、自动换行列 ---
+MERGE_SPECS = [
+    {"prefix": "Gogo_Full_Report_", "output": "Gogo_Report_Merged.xlsx",
+     "sheets": [("原始表", "原始表"), ("有效表", "有效表"), ("无效表", "无效表")],
+     "wrap": ['title / banner', 'finger_name', 'Vulnerabilities']},
+    {"prefix": "url_fingerprint_", "output": "Fingerprint_Merged.xlsx",
+     "sheets": [("原始数据", "原始数据"), ("有效表", "有效表"), ("无效表", "无效表")],
+     "wrap": ['title', 'finger']},
+    {"prefix": "quake_result_", "output": "Quake_Result_Merged.xlsx", "sheets": [(None, "Quake_Data")],
+     "wrap": ['产品指纹', '网站标题']},
+    {"prefix": "fofa_results_", "output": "Fofa_Result_Merged.xlsx", "sheets": [(None, "Fofa_Data")],
+     "wrap": ['网站标题']},
+]
+SOURCE_COLUMN = "来源文件名"
+MAX_COLUMN_WIDTH = 70
+SPOOL_BATCH_ROWS = 1000  # 合并时每批暂存到临时文件的行数
+# openpyxl 只读模式返回的日期时间值按类型写出的数字格式 (datetime 需排在 date 之前，它是 date 的子类)
+DATE_NUM_FORMATS = [(datetime.datetime, 'yyyy-mm-dd hh:mm:ss'), (datetime.date, 'yyyy-mm-dd'),
+                    (datetime.time, 'hh:mm:ss')]
+
+
+def normalize_header(header):
+    """表头空单元格命名为 "Unnamed: N" (与 pandas 一致，列不会被丢弃)，重复列名依次追加 .1、.2 后缀。"""
+    names, counts = [], {}
+    for position, name in enumerate(header):
+        name = f"Unnamed: {position}" if name is None or str(name) == "" else str(name)
+        if name in counts:
+            counts[name] += 1
+            name = f"{name}.{counts[name]}"
+        else:
+            counts[name] = 0
+        names.append(name)
+    return names
+
+
+def spool_workbook_sheets(file_path: str, spools):
+    """
+    以 openpyxl 只读模式只打开一次文件，逐行读取需要合并的各Sheet，表头与数据分批写入对应的临时文件。
+    - spools: {源Sheet名 (None 表示第一个Sheet): 暂存信息}，同时在其中累计列的并集；Sheet 不存在时跳过。
+    - 无表头的列只有在出现过数据时才计入并集，避免空白区域产生多余的列。
+    """
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        source_name = os.path.basename(file_path)
+        for sheet_name, spool in spools.items():
+            if sheet_name is None:
+                worksheet = workbook.worksheets[0] if workbook.worksheets else None
+            else:
+                worksheet = workbook[sheet_name] if sheet_name in workbook.sheetnames else None
+            if worksheet is None:
+                continue
+            rows = worksheet.iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None:
+                continue
+            header = normalize_header(header)
+            spool["columns"].update((name, None) for name in header if name != SOURCE_COLUMN)
+            spool["files"] += 1
+            unnamed_positions = [position for position, name in enumerate(header) if name.startswith("Unnamed: ")]
+            pickle.dump(("header", source_name, header), spool["file"])
+            batch = []
+            for row in rows:
+                if not any(value is not None for value in row):
+                    continue
+                for position in unnamed_positions:
+                    if position < len(row) and row[position] is not None:
+                        spool["filled"].add(header[position])
+                batch.append(row)
+                if len(batch) >= SPOOL_BATCH_ROWS:
+                    pickle.dump(("rows", batch), spool["file"])
+                    batch = []
+            if batch:
+                pickle.dump(("rows", batch), spool["file"])
+    finally:
+        workbook.close()
+
+
+def iter_spooled_rows(spool):
+    """按写入顺序回放暂存文件，产出 (来源文件名, 表头, 数据行)。"""
+    spool_file = spool["file"]
+    spool_file.seek(0)
+    source_name, header = None, []
+    while True:
+        try:
+            record = pickle.load(spool_file)
+        except EOFError:
+            return
+        if record[0] == "header":
+            _, source_name, header = record
+            continue
+        for row in record[1]:
+            yield source_name, header, row
+
+
+def stream_merge_sheet(workbook, output_sheet: str, spool, wrap_columns, formats):
+    """
+    把暂存的数据逐行追加到 constant_memory 模式的 xlsxwriter 工作表。
+    - 各文件按表头名称映射到合并后的列，缺失列留空，末尾追加来源文件名。
+    - 日期时间值使用带日期数字格式的列格式写出，避免显示为序列号。
+    - 列宽取运行过程中的最大值，内存占用只与单批数据有关。
+    """
+    if not spool["files"]:
+        return 0
+    columns = [name for name in spool["columns"]
+               if not name.startswith("Unnamed: ") or name in spool["filled"]] + [SOURCE_COLUMN]
+    worksheet = workbook.add_worksheet(output_sheet)
+    text_columns = {col_num for col_num, name in enumerate(columns) if name.lower() == 'url'}
+    column_styles = ["text" if col_num in text_columns else "wrap" if name in wrap_columns else "top"
+                     for col_num, name in enumerate(columns)]
+    column_formats = [formats[style] for style in column_styles]
+    widths = [len(name) for name in columns]
+    worksheet.write_row(0, 0, columns, formats["header"])
+
+    row_index, mapped_header, mapping = 0, None, []
+    for source_name, header, row in iter_spooled_rows(spool):
+        if header is not mapped_header:
+            positions = {name: position for position, name in enumerate(header)}
+            mapping = [positions.get(name) for name in columns[:-1]]
+            mapped_header = header
+        row_index += 1
+        values = [row[position] if position is not None and position < len(row) else None
+                  for position in mapping] + [source_name]
+        for col_num, value in enumerate(values):
+            if value is None:
+                continue
+            if col_num in text_columns:
+                worksheet.write_string(row_index, col_num, str(value), column_formats[col_num])
+            elif isinstance(value, (datetime.date, datetime.time)):
+                value_type = next(value_type for value_type, _ in DATE_NUM_FORMATS
+                                  if isinstance(value, value_type))
+                style = "wrap" if column_styles[col_num] == "wrap" else "top"
+                worksheet.write_datetime(row_index, col_num, value, formats[(style, value_type)])
+            else:
+                worksheet.write(row_index, col_num, value, column_formats[col_num])
+            widths[col_num] = max(widths[col_num], len(str(value)))
+
+    for col_num, width in enumerate(widths):
+        worksheet.set_column(col_num, col_num, min(width + 2, MAX_COLUMN_WIDTH), column_formats[col_num])
+    return row_index
+
+
 def merge_processed_excels(target_folder, output_folder):
     """
-    合并所有已整理好的.xlsx文件。此函数逻辑与您提供的 merge 3.0.py 基本一致。
+    (流式合并版) 合并所有已整理好的.xlsx文件。
+    - 读取端使用 openpyxl 只读模式逐行迭代，每个文件只解析一次，数据分批暂存到临时文件后求得列的并集。
+    - 写入端使用 xlsxwriter constant_memory 模式逐行追加。
+    - 不再把所有表格读入 DataFrame 后 pd.concat，内存占用与文件数量和总行数无关。
     """
     console.print("\n--- [bold info]阶段三: 开始合并所有 .xlsx 报告文件[/bold info] ---")
-    
-    # 这部分代码直接复用和优化您已有的 merge 3.0.py 逻辑
-    report_data = {
-        "gogo": {"原始表": [], "有效表": [], "无效表": []},
-        "fingerprint": {"原始数据": [], "有效表": [], "无效表": []},
-        "quake": [],
-        "fofa": []
-    }
 
+    files_by_spec = {index: [] for index in range(len(MERGE_SPECS))}
     for root, _, files in os.walk(target_folder):
-        for file in files:
-            if not file.endswith(".xlsx"):
+        for file in sorted(files):
+            if not file.endswith(".xlsx") or file.startswith("~$"):
                 continue
-
-            file_path = os.path.join(root, file)
-            
-            try:
-                if file.startswith("Gogo_Full_Report_"):
-                    xls = pd.ExcelFile(file_path, engine="openpyxl")
-                    for sheet_name in xls.sheet_names:
-                        if sheet_name in report_data["gogo"]:
-                            df = pd.read_excel(xls, sheet_name=sheet_name)
-                            df["来源文件名"] = file  # 添加来源信息
-                            report_data["gogo"][sheet_name].append(df)
-
-                elif file.startswith("url_fingerprint_"):
-                    xls = pd.ExcelFile(file_path, engine="openpyxl")
-                    for sheet_name in xls.sheet_names:
-                        if sheet_name in report_data["fingerprint"]:
-                            df = pd.read_excel(xls, sheet_name=sheet_name)
-                            df["来源文件名"] = file
-                            report_data["fingerprint"][sheet_name].append(df)
-
-                elif file.startswith("quake_result_"):
-                    df = pd.read_excel(file_path, engine="openpyxl")
-                    df["来源文件名"] = file
-                    report_data["quake"].append(df)
-                    
-                elif file.startswith("fofa_results_"):
-                    df = pd.read_excel(file_path, engine="openpyxl")
-                    df["来源文件名"] = file
-                    report_data["fofa"].append(df)
-
-            except Exception as e:
-                console.print(f"[warning]警告: 读取Excel文件失败: {file_path}, 错误: {e}[/warning]")
+            for index, spec in enumerate(MERGE_SPECS):
+                if file.startswith(spec["prefix"]):
+                    files_by_spec[index].append(os.path.join(root, file))
+                    break
 
     os.makedirs(output_folder, exist_ok=True)
     console.print(f"\n[info]准备写入合并后的总表到目录:[/info] [cyan]{output_folder}[/cyan]")
 
-    def write_and_format_excel(output_path, data_frames, wrap_columns=[]):
+    for index, spec in enumerate(MERGE_SPECS):
+        file_paths = files_by_spec[index]
+        if not file_paths:
+            continue
+        output_path = os.path.join(output_folder, spec["output"])
+        console.print(f"  [info]合并中:[/info] {spec['prefix']}* 共 {len(file_paths)} 个文件 -> [cyan]{spec['output']}[/cyan]")
+        spools = {sheet_name: {"file": tempfile.TemporaryFile(), "columns": {}, "filled": set(), "files": 0}
+                  for sheet_name, _ in spec["sheets"]}
         try:
-            with pd.ExcelWriter(output_path, engine='xlsxwriter') as writer:
-                for sheet_name, frames in data_frames.items():
-                    if not frames: continue
-                    combined_df = pd.concat(frames, ignore_index=True)
-                    combined_df.to_excel(writer, sheet_name=sheet_name, index=False)
-                    
-                    workbook, worksheet = writer.book, writer.sheets[sheet_name]
-                    wrap_format = workbook.add_format({'text_wrap': True, 'valign': 'top'})
-                    top_align_format = workbook.add_format({'valign': 'top'})
-                    text_format = workbook.add_format({'num_format': '@', 'valign': 'top'})
-
-                    for col_num, name in enumerate(combined_df.columns):
-                        width = max(combined_df[name].astype(str).map(len).max(), len(name)) + 2
-                        cell_format = top_align_format
-                        if name.lower() == 'url': cell_format = text_format
-                        elif name in wrap_columns: cell_format = wrap_format
-                        worksheet.set_column(col_num, col_num, min(width, 70), cell_format)
-            
-            console.print(f"[success]合并成功:[/success] [green]{os.path.basename(output_path)}[/green] 已保存。")
+            for file_path in file_paths:
+                try:
+                    spool_workbook_sheets(file_path, spools)
+                except Exception as e:
+                    console.print(f"[warning]警告: 读取Excel文件失败: {file_path}, 错误: {e}[/warning]")
+            workbook = xlsxwriter.Workbook(output_path, {'constant_memory': True, 'strings_to_urls': False})
+            formats = {
+                "header": workbook.add_format({'bold': True, 'border': 1, 'valign': 'top'}),
+                "wrap": workbook.add_format({'text_wrap': True, 'valign': 'top'}),
+                "top": workbook.add_format({'valign': 'top'}),
+                "text": workbook.add_format({'num_format': '@', 'valign': 'top'}),
+            }
+            for value_type, num_format in DATE_NUM_FORMATS:
+                formats[("top", value_type)] = workbook.add_format({'num_format': num_format, 'valign': 'top'})
+                formats[("wrap", value_type)] = workbook.add_format(
+                    {'num_format': num_format, 'text_wrap': True, 'valign': 'top'})
+            sheet_counts = []
+            for sheet_name, output_sheet in spec["sheets"]:
+                row_count = stream_merge_sheet(workbook, output_sheet, spools[sheet_name], spec["wrap"], formats)
+                if row_count or output_sheet in workbook.sheetnames:
+                    sheet_counts.append(f"{output_sheet} {row_count} 条")
+            if not workbook.worksheets():
+                workbook.add_worksheet(spec["sheets"][0][1])
+            workbook.close()
+            console.print(f"[success]合并成功:[/success] [green]{spec['output']}[/green] 已保存 ({'，'.join(sheet_counts)})。")
         except Exception as e:
-            console.print(f"[error]错误: 写入合并文件 {os.path.basename(output_path)} 失败: {e}[/error]")
-
-    # --- 调用写入函数 ---
-    if any(report_data["gogo"].values()):
-        write_and_format_excel(os.path.join(output_folder, "Gogo_Report_Merged.xlsx"), report_data["gogo"], ['title / banner', 'finger_name', 'Vulnerabilities'])
-    if any(report_data["fingerprint"].values()):
-        write_and_format_excel(os.path.join(output_folder, "Fingerprint_Merged.xlsx"), report_data["fingerprint"], ['title', 'finger'])
-    if report_data["quake"]:
-        write_and_format_excel(os.path.join(output_folder, "Quake_Result_Merged.xlsx"), {"Quake_Data": report_data["quake"]}, ['产品指纹', '网站标题'])
-    if report_data["fofa"]:
-        write_and_format_excel(os.path.join(output_folder, "Fofa_Result_Merged.xlsx"), {"Fofa_Data": report_data["fofa"]}, ['网站标题'])
+            console.print(f"[error]错误: 写入合并文件 {spec['output']} 失败: {e}[/error]")
+        finally:
+            for spool in spools.values():
+                spool["file"].close()
 
 
 def main():
@@ -210,6 +343,11 @@ def main():
         required=True, 
         help="用于存放最终合并报告的输出文件夹路径"
     )
+    parser.add_argument(
+        "-j", "--workers",
+        type=int,
+        help="CSV并行转换的进程数 (默认为CPU核心数)"
+    )
     args = parser.parse_args()
 
     if not os.path.isdir(args.target):
@@ -217,7 +355,7 @@ def main():
         return
 
     # 阶段一：转换CSV
-    convert_csvs_in_tree(args.target)
+    convert_csvs_in_tree(args.target, args.workers)
     
     # 阶段二：归档文件
     archive_files_in_tree(args.target)
@@ -0,0 +1,41 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ICPAssetExpress as icp  # noqa: E402
+
+
+@pytest.fixture
+def db_conn(tmp_path, monkeypatch):
+    """在临时目录中初始化一个全新的缓存数据库 (连接池同样指向该数据库)。"""
+    monkeypatch.setattr(icp, "DB_FILE", str(tmp_path / "icp_asset_cache.db"))
+    monkeypatch.setattr(icp, "_db_pool", None)
+    conn = icp.initialize_database()
+    yield conn
+    conn.close()
+    icp.close_db_pool()
+
+
+@pytest.fixture
+def quake_record():
+    """构造最小 Quake 服务记录的工厂: quake_record(ip, port=80, host="", title="", status_code=200, unit=...)。"""
+    def build(ip, port=80, host="", title="", status_code=200, unit="测试公司"):
+        return {"ip": ip, "port": port, "domain": host, "time": "2025-01-01",
+                "service": {"http": {"host": host, "title": title, "status_code": status_code,
+                                     "icp": {"licence": "京ICP备00000000号", "main_licence": {"unit": unit, "nature": "企业"}}}},
+                "location": {"province_cn": "北京"}, "components": []}
+    return build
+
+
+@pytest.fixture
+def take_snapshot(db_conn):
+    """写入一次已完成的 Quake 翻页 (即一个历史快照): take_snapshot(target_id, records)，返回 scroll_id。"""
+    def take(target_id, records):
+        scroll_id = icp.start_quake_scroll(target_id, "dsl", db_conn)
+        icp.save_quake_page(scroll_id, target_id, records, None, db_conn)
+        icp.finish_quake_scroll(scroll_id, target_id, db_conn, len(records))
+        return scroll_id
+    return take
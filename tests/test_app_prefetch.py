@@ -0,0 +1,18 @@
+import threading
+
+import ICPAssetExpress as icp
+
+
+def test_failed_company_jobs_release_their_prefetch_futures(monkeypatch):
+    release = threading.Event()
+    monkeypatch.setattr(icp, "WERPLUS_CONCURRENCY", 1)
+    monkeypatch.setattr(icp, "fetch_company_app_type", lambda company_name, app_type: release.wait(5) and [])
+    try:
+        futures = icp.prefetch_company_apps(["公司A", "公司B"], ["app"])
+        icp.cancel_company_app_prefetch("公司B")
+        assert set(icp._app_prefetch_futures) == {("公司A", "app")}
+        assert futures[("公司B", "app")].cancelled()
+    finally:
+        release.set()
+        icp.shutdown_app_prefetch()
+    assert icp._app_prefetch_executor is None and icp._app_prefetch_futures == {}
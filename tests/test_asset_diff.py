@@ -0,0 +1,87 @@
+import ICPAssetExpress as icp
+
+
+def keys(records):
+    return sorted((record["IP"], record["Port"], record["Host"]) for record in records)
+
+
+def test_single_snapshot_has_nothing_to_compare(db_conn, quake_record, take_snapshot):
+    target_id = icp.get_target_id_from_db("集团A", db_conn)
+    take_snapshot(target_id, [quake_record("10.0.0.1")])
+    assert icp.compute_target_asset_diff(target_id, db_conn) is None
+
+
+def test_added_removed_and_changed_assets(db_conn, quake_record, take_snapshot):
+    target_id = icp.get_target_id_from_db("集团A", db_conn)
+    take_snapshot(target_id, [
+        quake_record("10.0.0.1", host="a.com", title="首页"),
+        quake_record("10.0.0.2", host="b.com", title="旧标题"),
+        quake_record("10.0.0.3", host="c.com"),
+        quake_record("10.0.0.5", host="old.com"),
+        quake_record("10.0.0.6", port=443, status_code=200),
+    ])
+    take_snapshot(target_id, [
+        quake_record("10.0.0.1", host="a.com", title="首页"),
+        quake_record("10.0.0.2", host="b.com", title="新标题"),
+        quake_record("10.0.0.4", host="d.com"),
+        # 同一 IP:端口 换了 Host 视为一条新增 + 一条消失，而不是变更
+        quake_record("10.0.0.5", host="new.com"),
+        quake_record("10.0.0.6", port=443, status_code=302),
+    ])
+    diff = icp.compute_target_asset_diff(target_id, db_conn)
+
+    assert keys(diff["added"]) == [("10.0.0.4", "80", "d.com"), ("10.0.0.5", "80", "new.com")]
+    assert keys(diff["removed"]) == [("10.0.0.3", "80", "c.com"), ("10.0.0.5", "80", "old.com")]
+    changed = {record["IP"]: record["变更内容"] for record in diff["changed"]}
+    assert changed == {"10.0.0.2": "网站标题: 旧标题 -> 新标题", "10.0.0.6": "HTTP状态码: 200 -> 302"}
+
+
+def test_diff_uses_the_two_latest_snapshots(db_conn, quake_record, take_snapshot):
+    target_id = icp.get_target_id_from_db("集团A", db_conn)
+    take_snapshot(target_id, [quake_record("10.0.0.1")])
+    take_snapshot(target_id, [quake_record("10.0.0.1"), quake_record("10.0.0.2")])
+    take_snapshot(target_id, [quake_record("10.0.0.1"), quake_record("10.0.0.2"), quake_record("10.0.0.3")])
+    diff = icp.compute_target_asset_diff(target_id, db_conn)
+    assert keys(diff["added"]) == [("10.0.0.3", "80", "")]
+    assert diff["removed"] == [] and diff["changed"] == []
+
+
+def test_delta_filter_keeps_added_and_changed_records(db_conn, quake_record, take_snapshot):
+    target_id = icp.get_target_id_from_db("集团A", db_conn)
+    take_snapshot(target_id, [quake_record("10.0.0.1", title="a"), quake_record("10.0.0.2")])
+    take_snapshot(target_id, [quake_record("10.0.0.1", title="b"), quake_record("10.0.0.2"),
+                                       quake_record("10.0.0.3")])
+    diff = icp.compute_target_asset_diff(target_id, db_conn)
+    current = list(icp.iter_quake_snapshot_records(target_id, db_conn))
+    assert sorted(record["IP"] for record in icp.filter_delta_records(current, diff)) == ["10.0.0.1", "10.0.0.3"]
+
+
+def test_delta_only_cache_hit_keeps_reports_but_skips_scanning(db_conn, quake_record, take_snapshot, monkeypatch,
+                                                               tmp_path):
+    target_id = icp.get_target_id_from_db("集团A", db_conn)
+    take_snapshot(target_id, [quake_record("10.0.0.1")])
+    # 缓存命中: 直接读取最新快照，不产生新快照
+    monkeypatch.setattr(icp, "open_quake_record_stream",
+                        lambda target_name, conn: icp.iter_quake_snapshot_records(target_id, conn))
+    monkeypatch.setattr(icp, "get_thread_db_conn", lambda: db_conn)
+    monkeypatch.setattr(icp, "ASSET_DIFF_DELTA_ONLY", True)
+    monkeypatch.setattr(icp, "OUTPUT_BASE_DIR", str(tmp_path))
+    run_state = {"total_targets": 1, "unknown_company_label": "未知主体", "lock": icp.threading.Lock(),
+                 "failed_targets": [], "types_to_check": []}
+    [job] = icp.pipeline_stage_quake(run_state, (1, "集团A"))
+    assert run_state["failed_targets"] == []
+    # Quake报告、Fofa与APP查询仍使用完整资产，只有扫描/指纹识别输入为空
+    assert [record["IP"] for record in job["assets"]["raw_data"]] == ["10.0.0.1"]
+    assert [record["IP"] for record in job["target"]["assets"]["测试公司"]["raw_data"]] == ["10.0.0.1"]
+    assert not job["scan_assets"]["ips"] and not job["scan_assets"]["urls"]
+
+
+def test_self_check_lists_units_of_the_latest_snapshot_only(db_conn, quake_record, take_snapshot, monkeypatch,
+                                                            tmp_path):
+    monkeypatch.setattr(icp, "OUTPUT_BASE_DIR", str(tmp_path))
+    target_id = icp.get_target_id_from_db("集团A", db_conn)
+    take_snapshot(target_id, [quake_record("10.0.0.1", unit="旧公司")])
+    take_snapshot(target_id, [quake_record("10.0.0.1", unit="新公司")])
+    icp.create_self_check_report([], db_conn, "basic")
+    sheet = icp.pd.read_excel(tmp_path / "自查报告.xlsx", sheet_name="有效期内的缓存目标")
+    assert sheet["包含的备案主体"].tolist() == ["新公司"]
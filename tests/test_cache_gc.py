@@ -0,0 +1,29 @@
+import ICPAssetExpress as icp
+
+
+def test_gc_keeps_only_the_newest_snapshots(db_conn, quake_record, take_snapshot, monkeypatch):
+    monkeypatch.setattr(icp, "CACHE_KEEP_SNAPSHOTS", 2)
+    target_id = icp.get_target_id_from_db("集团A", db_conn)
+    scroll_ids = [take_snapshot(target_id, [quake_record(f"10.0.0.{i}")]) for i in range(4)]
+
+    stats = icp.run_cache_gc(db_conn)
+    assert stats["QuakeScrolls"] == 2
+    remaining = [row[0] for row in db_conn.execute(
+        "SELECT scroll_id FROM QuakeScrolls WHERE target_id = ? ORDER BY scroll_id", (target_id,))]
+    assert remaining == scroll_ids[-2:]
+    assert {row[0] for row in db_conn.execute("SELECT DISTINCT scroll_id FROM QuakeAsset")} == set(scroll_ids[-2:])
+
+    assert icp.get_quake_cache_state("集团A", db_conn) == (icp.CACHE_STATE_HIT, target_id)
+    assert [record["IP"] for record in icp.iter_quake_snapshot_records(target_id, db_conn)] == ["10.0.0.3"]
+
+
+def test_gc_drops_fofa_runs_left_running_past_the_stale_cutoff(db_conn, monkeypatch):
+    monkeypatch.setattr(icp, "CACHE_STALE_RUN_HOURS", 1)
+    target_id = icp.get_target_id_from_db("集团A", db_conn)
+    now = icp.datetime.datetime.now()
+    db_conn.executemany("INSERT INTO FofaRuns (target_id, run_timestamp, status) VALUES (?, ?, 'running')",
+                        [(target_id, now - icp.datetime.timedelta(hours=2)), (target_id, now)])
+    db_conn.commit()
+
+    assert icp.run_cache_gc(db_conn)["FofaRuns"] == 1
+    assert db_conn.execute("SELECT COUNT(*) FROM FofaRuns WHERE run_timestamp < ?", (now,)).fetchone()[0] == 0
@@ -0,0 +1,35 @@
+import ICPAssetExpress as icp
+
+
+def read_self_check(tmp_path, sheet_name):
+    return icp.pd.read_excel(tmp_path / "自查报告.xlsx", sheet_name=sheet_name)
+
+
+def test_self_check_lists_error_and_empty_targets_with_their_own_ttl(db_conn, take_snapshot, monkeypatch, tmp_path):
+    monkeypatch.setattr(icp, "OUTPUT_BASE_DIR", str(tmp_path))
+    failed_id = icp.get_target_id_from_db("集团A", db_conn)
+    empty_id = icp.get_target_id_from_db("集团B", db_conn)
+    icp.record_quake_error(failed_id, "API 错误", db_conn)
+    take_snapshot(empty_id, [])
+
+    icp.create_self_check_report([], db_conn, "basic")
+    assert read_self_check(tmp_path, "有效期内的缓存目标").columns.tolist() == ["状态"]
+    others = read_self_check(tmp_path, "无结果或失败的缓存目标").set_index("查询目标")
+    assert others.loc["集团A", "缓存状态"] == "查询失败" and others.loc["集团A", "错误信息"] == "API 错误"
+    assert others.loc["集团A", "剩余有效期(小时)"] <= icp.ERROR_CACHE_EXPIRY_HOURS
+    assert others.loc["集团B", "缓存状态"] == "查询无结果"
+    assert others.loc["集团B", "剩余有效期(小时)"] <= icp.EMPTY_CACHE_EXPIRY_HOURS
+
+
+def test_only_quake_mode_skips_targets_in_error_state(db_conn, monkeypatch, tmp_path):
+    monkeypatch.setattr(icp, "OUTPUT_BASE_DIR", str(tmp_path))
+    monkeypatch.setattr(icp, "QUAKE_RESUME", False)
+    monkeypatch.setattr(icp, "load_queries", lambda input_file: ["集团A"])
+    api_calls = []
+    monkeypatch.setattr(icp, "iter_quake_api_records", lambda target_name, conn: api_calls.append(target_name) or iter(()))
+    icp.record_quake_error(icp.get_target_id_from_db("集团A", db_conn), "API 错误", db_conn)
+
+    icp.run_only_quake_mode(db_conn)
+    assert api_calls == []
+    failed = read_self_check(tmp_path, "未正确查询的目标")
+    assert failed["查询目标"].tolist() == ["集团A"]
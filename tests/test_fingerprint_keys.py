@@ -0,0 +1,64 @@
+import pytest
+
+import ICPAssetExpress as icp
+
+
+@pytest.mark.parametrize("url, expected", [
+    ("http://Example.COM", "http://example.com"),
+    ("http://example.com:80/", "http://example.com"),
+    ("https://example.com:443/login/", "https://example.com/login"),
+    ("https://example.com:8443", "https://example.com:8443"),
+    ("http://example.com:443", "http://example.com:443"),
+    ("example.com:8080", "http://example.com:8080"),
+    ("http://example.com/a?x=1#frag", "http://example.com/a?x=1"),
+    ("  http://example.com/  ", "http://example.com"),
+    ("http://[::1]:80/", "http://[::1]"),
+])
+def test_normalize_fingerprint_url(url, expected):
+    assert icp.normalize_fingerprint_url(url) == expected
+
+
+def test_invalid_port_falls_back_to_lowercase():
+    assert icp.normalize_fingerprint_url("http://Example.com:99999") == "http://example.com:99999"
+
+
+def test_index_urls_dedupes_equivalent_urls():
+    urls_by_key = icp.index_urls_by_fingerprint_key(["http://a.com", "http://A.com:80/", "", None, "https://a.com"])
+    assert urls_by_key == {"http://a.com": "http://a.com", "https://a.com": "https://a.com"}
+
+
+def test_observer_ward_rows_map_back_to_input_urls():
+    urls_by_key = icp.index_urls_by_fingerprint_key(["http://a.com", "http://b.com", "https://c.org/x"])
+    rows = [{"url": "http://a.com/", "name": "exact"},
+            {"url": "https://www.b.com/login", "name": "redirect"},
+            {"url": "https://c.org/x/", "name": "exact"}]
+    mapped = icp.map_observer_ward_rows(rows, urls_by_key, urls_by_key)
+    assert set(mapped) == set(urls_by_key)
+    assert mapped["http://b.com"] == [{"url": "http://b.com", "name": "redirect",
+                                       "reported_url": "https://www.b.com/login"}]
+
+
+def test_output_url_on_another_host_is_not_guessed():
+    urls_by_key = icp.index_urls_by_fingerprint_key(["http://a.com", "http://d.net"])
+    rows = [{"url": "http://a.com"}, {"url": "http://elsewhere.io/"}]
+    mapped = icp.map_observer_ward_rows(rows, urls_by_key, urls_by_key)
+    assert set(mapped) == {"http://a.com"}
+
+
+def test_ambiguous_output_rows_are_dropped():
+    urls_by_key = icp.index_urls_by_fingerprint_key(["http://a.com", "http://d.net", "http://e.net"])
+    mapped = icp.map_observer_ward_rows([{"url": "http://elsewhere.io/"}], urls_by_key, urls_by_key)
+    assert mapped == {}
+
+
+def test_streaming_batches_produce_a_single_report(tmp_path, monkeypatch):
+    monkeypatch.setattr(icp, "fingerprint_urls", lambda name, work_dir, urls_by_key, stage: {
+        key: [{"url": url, "name": stage}] for key, url in urls_by_key.items()})
+    reports = []
+    monkeypatch.setattr(icp, "write_fingerprint_report", lambda company, company_dir, stage, urls_by_key, rows_by_key:
+                        reports.append((stage, sorted(urls_by_key))))
+    fingerprinter = icp.StreamingFingerprinter("公司A", str(tmp_path), "fingerprint_from_gogo", batch_size=2)
+    for i in range(5):
+        fingerprinter.add(f"http://{i}.com")
+    fingerprinter.close()
+    assert reports == [("fingerprint_from_gogo", [f"http://{i}.com" for i in range(5)])]
@@ -0,0 +1,116 @@
+import ICPAssetExpress as icp
+
+
+def clause_count(query):
+    return len(query.split(" || "))
+
+
+def test_sparse_ips_are_packed_up_to_the_length_limit():
+    ips = [f"10.{i}.0.1" for i in range(50)]
+    packed = icp.pack_fofa_queries(ips, max_query_length=100, cidr_min_ips=16)
+    assert all(len(query) <= 100 for query, _ in packed)
+    assert [ip for _, chunk_ips in packed for ip in chunk_ips] == ips
+    # 每条语句都尽量装满：再加一个子句就会超出长度限制
+    for query, _ in packed[:-1]:
+        assert len(query) + len(' || ip="10.10.0.1"') > 100
+
+
+def test_single_oversized_clause_still_gets_its_own_query():
+    packed = icp.pack_fofa_queries(["10.0.0.1", "10.0.0.2"], max_query_length=5, cidr_min_ips=16)
+    assert packed == [('ip="10.0.0.1"', ["10.0.0.1"]), ('ip="10.0.0.2"', ["10.0.0.2"])]
+
+
+def test_cidr_threshold_is_inclusive():
+    dense = [f"192.168.1.{i}" for i in range(1, 17)]
+    packed = icp.pack_fofa_queries(dense, cidr_min_ips=16)
+    assert packed == [('ip="192.168.1.0/24"', dense)]
+
+    packed = icp.pack_fofa_queries(dense[:15], cidr_min_ips=16)
+    assert clause_count(packed[0][0]) == 15
+    assert "/24" not in packed[0][0]
+
+
+def test_cidr_packing_can_be_disabled():
+    dense = [f"192.168.1.{i}" for i in range(1, 17)]
+    packed = icp.pack_fofa_queries(dense, cidr_min_ips=0)
+    assert clause_count(packed[0][0]) == 16
+    assert "/24" not in packed[0][0]
+
+
+def test_mixed_dense_sparse_and_non_ipv4_inputs():
+    dense = [f"172.16.5.{i}" for i in range(20)]
+    packed = icp.pack_fofa_queries(dense + ["8.8.8.8", "2001:db8::1", "not-an-ip"], cidr_min_ips=16)
+    query, chunk_ips = packed[0]
+    assert len(packed) == 1
+    assert query.split(" || ") == ['ip="172.16.5.0/24"', 'ip="8.8.8.8"', 'ip="2001:db8::1"', 'ip="not-an-ip"']
+    assert sorted(chunk_ips) == sorted(dense + ["8.8.8.8", "2001:db8::1", "not-an-ip"])
+
+
+def test_cidr_results_are_filtered_to_requested_ips(db_conn, monkeypatch):
+    wanted = [f"192.168.1.{i}" for i in range(1, 17)]
+    queries = []
+
+    def fake_fetch(query_str):
+        queries.append(query_str)
+        # CIDR 查询会带回网段内其他IP的结果
+        return [["h", f"192.168.1.{i}", "80", "http", "t", "s", "", "", ""] for i in range(1, 40)], None
+
+    monkeypatch.setattr(icp, "fetch_fofa_chunk", fake_fetch)
+    target_id = icp.get_target_id_from_db("集团A", db_conn)
+    results, fofa_run_id = icp.query_fofa_by_ips(wanted, target_id, db_conn)
+    assert queries == ['ip="192.168.1.0/24"']
+    assert fofa_run_id is not None
+    assert sorted(item[1] for item in results) == sorted(wanted)
+    # 网段内的非待查IP不写入缓存
+    cached_ips = {row[0] for row in db_conn.execute("SELECT ip FROM FofaIPCache")}
+    assert cached_ips == set(wanted)
+
+    # 第二次运行全部命中按IP写入的缓存，不再请求Fofa
+    results, fofa_run_id = icp.query_fofa_by_ips(wanted, target_id, db_conn)
+    assert len(queries) == 1 and fofa_run_id is None
+    assert sorted(item[1] for item in results) == sorted(wanted)
+
+
+def test_failed_chunk_ips_are_skipped_within_error_ttl(db_conn, monkeypatch, capsys):
+    queries = []
+
+    def failing_fetch(query_str):
+        queries.append(query_str)
+        return [], "API 错误"
+
+    monkeypatch.setattr(icp, "fetch_fofa_chunk", failing_fetch)
+    monkeypatch.setattr(icp, "FOFA_CHUNK_RETRIES", 0)
+    target_id = icp.get_target_id_from_db("集团A", db_conn)
+    icp.query_fofa_by_ips(["8.8.8.8"], target_id, db_conn)
+    assert f"错误缓存有效期 ({icp.ERROR_CACHE_EXPIRY_HOURS} 小时)" in capsys.readouterr().out
+
+    # 错误缓存有效期内不再重复查询
+    results, fofa_run_id = icp.query_fofa_by_ips(["8.8.8.8"], target_id, db_conn)
+    assert queries == ['ip="8.8.8.8"'] and results == [] and fofa_run_id is None
+
+
+def test_last_queried_fofa_is_not_stamped_while_ips_are_in_error(db_conn, monkeypatch):
+    monkeypatch.setattr(icp, "fetch_fofa_chunk", lambda query_str: ([], "API 错误"))
+    monkeypatch.setattr(icp, "FOFA_CHUNK_RETRIES", 0)
+    target_id = icp.get_target_id_from_db("集团A", db_conn)
+    last_queried = "SELECT last_queried_fofa FROM Targets WHERE target_id = ?"
+    icp.query_fofa_by_ips(["8.8.8.8"], target_id, db_conn)
+    icp.query_fofa_by_ips(["8.8.8.8"], target_id, db_conn)
+    assert db_conn.execute(last_queried, (target_id,)).fetchone()[0] is None
+
+    monkeypatch.setattr(icp, "fetch_fofa_chunk", lambda query_str: ([], None))
+    icp.query_fofa_by_ips(["1.1.1.1"], target_id, db_conn)
+    assert db_conn.execute(last_queried, (target_id,)).fetchone()[0] is not None
+
+
+def test_self_check_reports_complete_fofa_lookups(db_conn, quake_record, take_snapshot, monkeypatch, tmp_path):
+    monkeypatch.setattr(icp, "OUTPUT_BASE_DIR", str(tmp_path))
+    monkeypatch.setattr(icp, "fetch_fofa_chunk", lambda query_str: ([], None))
+    for target_name in ("集团A", "集团B"):
+        take_snapshot(icp.get_target_id_from_db(target_name, db_conn), [quake_record("1.1.1.1")])
+    icp.query_fofa_by_ips(["1.1.1.1"], icp.get_target_id_from_db("集团A", db_conn), db_conn)
+
+    icp.create_self_check_report([], db_conn, "basic")
+    sheet = icp.pd.read_excel(tmp_path / "自查报告.xlsx", sheet_name="有效期内的缓存目标").set_index("查询目标")
+    assert sheet.loc["集团A", "Fofa反查完成时间"] != "无完整的有效Fofa缓存"
+    assert sheet.loc["集团B", "Fofa反查完成时间"] == "无完整的有效Fofa缓存"
@@ -0,0 +1,83 @@
+import datetime
+import json
+import types
+
+import ICPAssetExpress as icp
+
+PORTS = ["80", "443", "8080", "8443"]
+
+
+def record_scan(db_conn, scanned_groups, open_pairs=(), scan_id="scan-1"):
+    """模拟一次 gogo 扫描：open_pairs 写入 GogoFindings，再更新 ScanHistory。"""
+    db_conn.executemany(
+        "INSERT INTO GogoFindings (scan_id, ip, port, status, row_json, found_at) VALUES (?, ?, ?, 'open', ?, ?)",
+        [(scan_id, ip, port, json.dumps({"ip": ip, "port": port}), datetime.datetime.now()) for ip, port in open_pairs])
+    icp.record_scan_history(db_conn, scan_id, scanned_groups)
+
+
+def as_dict(scan_groups):
+    return {ip: ports for ports, ips in scan_groups for ip in ips}
+
+
+def test_group_ips_by_ports_merges_identical_port_sets():
+    groups = icp.group_ips_by_ports({"1.1.1.1": ["80"], "2.2.2.2": ["80"], "3.3.3.3": ["443"], "4.4.4.4": []})
+    assert sorted((ports, sorted(ips)) for ports, ips in groups) == [(["443"], ["3.3.3.3"]),
+                                                                     (["80"], ["1.1.1.1", "2.2.2.2"])]
+
+
+def test_record_scan_history_marks_closed_then_open(db_conn):
+    record_scan(db_conn, [(["80", "443"], ["1.1.1.1"])], open_pairs=[("1.1.1.1", "443")])
+    states = dict(db_conn.execute("SELECT port, state FROM ScanHistory WHERE ip = '1.1.1.1'").fetchall())
+    assert states == {"80": "closed", "443": "open"}
+
+
+def test_without_history_everything_is_scanned(db_conn):
+    scan_groups, history_rows, skipped = icp.plan_incremental_gogo_scan({"1.1.1.1": PORTS, "2.2.2.2": PORTS}, db_conn)
+    assert as_dict(scan_groups) == {"1.1.1.1": PORTS, "2.2.2.2": PORTS}
+    assert history_rows == [] and skipped == 0
+
+
+def test_fresh_pairs_are_skipped_and_open_history_is_merged(db_conn):
+    record_scan(db_conn, [(["80", "443", "8080"], ["1.1.1.1"])], open_pairs=[("1.1.1.1", "443")])
+    scan_groups, history_rows, skipped = icp.plan_incremental_gogo_scan({"1.1.1.1": PORTS}, db_conn)
+    assert as_dict(scan_groups) == {"1.1.1.1": ["8443"]}
+    assert skipped == 3
+    assert history_rows == [{"ip": "1.1.1.1", "port": "443"}]
+
+
+def test_half_or_more_new_ports_rescans_all_ports(db_conn):
+    record_scan(db_conn, [(["80", "443"], ["1.1.1.1"])], open_pairs=[("1.1.1.1", "443")])
+    scan_groups, history_rows, skipped = icp.plan_incremental_gogo_scan({"1.1.1.1": PORTS}, db_conn)
+    # 4 个端口中有 2 个需要扫描，达到一半时直接扫描全部端口，历史记录不再重复并入
+    assert as_dict(scan_groups) == {"1.1.1.1": PORTS}
+    assert history_rows == [] and skipped == 0
+
+
+def test_fully_covered_ip_is_not_scanned(db_conn):
+    record_scan(db_conn, [(PORTS, ["1.1.1.1"])])
+    scan_groups, history_rows, skipped = icp.plan_incremental_gogo_scan({"1.1.1.1": PORTS}, db_conn)
+    assert scan_groups == [] and skipped == 4
+
+
+def test_expired_history_is_rescanned(db_conn, monkeypatch):
+    record_scan(db_conn, [(PORTS, ["1.1.1.1"])])
+    db_conn.execute("UPDATE ScanHistory SET last_scanned = ?",
+                    (datetime.datetime.now() - datetime.timedelta(hours=2),))
+    db_conn.commit()
+    monkeypatch.setattr(icp, "SCAN_HISTORY_TTL_HOURS", 1)
+    scan_groups, _, skipped = icp.plan_incremental_gogo_scan({"1.1.1.1": PORTS}, db_conn)
+    assert as_dict(scan_groups) == {"1.1.1.1": PORTS} and skipped == 0
+
+
+def test_only_pairs_of_this_scan_are_marked_open(db_conn, monkeypatch):
+    class FrozenDatetime(datetime.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return datetime.datetime(2025, 1, 1, 12, 0, 0)
+
+    # 两次扫描写入完全相同的时间戳，仍只按本次扫描的 IP:端口 标记开放
+    monkeypatch.setattr(icp, "datetime", types.SimpleNamespace(datetime=FrozenDatetime, timedelta=datetime.timedelta))
+    record_scan(db_conn, [(["80"], ["2.2.2.2"])], scan_id="scan-0")
+    record_scan(db_conn, [(["80"], ["1.1.1.1"])], open_pairs=[("1.1.1.1", "80"), ("2.2.2.2", "80")])
+    states = dict(db_conn.execute("SELECT ip, state FROM ScanHistory").fetchall())
+    assert states == {"1.1.1.1": "open", "2.2.2.2": "closed"}
@@ -0,0 +1,39 @@
+import datetime
+
+import openpyxl
+
+import process_results
+
+
+def write_workbook(path, rows):
+    workbook = openpyxl.Workbook()
+    for row in rows:
+        workbook.active.append(row)
+    workbook.save(path)
+
+
+def test_merge_keeps_unnamed_columns_and_dates(tmp_path, monkeypatch):
+    source_dir, output_dir = tmp_path / "src", tmp_path / "out"
+    source_dir.mkdir()
+    loads = []
+    original_load = process_results.openpyxl.load_workbook
+    monkeypatch.setattr(process_results.openpyxl, "load_workbook",
+                        lambda path, **kwargs: loads.append(path) or original_load(path, **kwargs))
+    write_workbook(source_dir / "fofa_results_a.xlsx", [["IP", None, "时间"],
+                                                        ["1.1.1.1", "备注", datetime.datetime(2025, 1, 2, 3, 4, 5)]])
+    write_workbook(source_dir / "fofa_results_b.xlsx", [["IP", "网站标题"], ["2.2.2.2", "首页"]])
+
+    process_results.merge_processed_excels(str(source_dir), str(output_dir))
+
+    # 每个源文件只解析一次
+    assert sorted(loads) == sorted(str(path) for path in source_dir.iterdir())
+    worksheet = openpyxl.load_workbook(output_dir / "Fofa_Result_Merged.xlsx")["Fofa_Data"]
+    rows = [[cell.value for cell in row] for row in worksheet.iter_rows()]
+    assert rows == [["IP", "Unnamed: 1", "时间", "网站标题", process_results.SOURCE_COLUMN],
+                    ["1.1.1.1", "备注", datetime.datetime(2025, 1, 2, 3, 4, 5), None, "fofa_results_a.xlsx"],
+                    ["2.2.2.2", None, None, "首页", "fofa_results_b.xlsx"]]
+    assert worksheet["C2"].number_format == "yyyy-mm-dd hh:mm:ss"
+
+
+def test_normalize_header_names_blank_and_duplicate_columns():
+    assert process_results.normalize_header(["a", None, "a", "", "a"]) == ["a", "Unnamed: 1", "a.1", "Unnamed: 3", "a.2"]
@@ -0,0 +1,93 @@
+import pytest
+import requests
+
+import ICPAssetExpress as icp
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self._data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self._data
+
+
+class FakeQuakeClient:
+    """按 pagination_id 返回固定分页；fail_on_page 指定的页请求一次网络异常。"""
+
+    def __init__(self, pages, fail_on_page=None):
+        self.pages = pages
+        self.fail_on_page = fail_on_page
+        self.requested_pages = []
+
+    def post(self, url, headers=None, json=None):
+        page = int(json.get("pagination_id") or 0)
+        self.requested_pages.append(page)
+        if page == self.fail_on_page:
+            self.fail_on_page = None
+            raise requests.exceptions.ConnectionError("connection reset")
+        data = self.pages[page] if page < len(self.pages) else []
+        return FakeResponse({"code": 0, "data": data, "meta": {"pagination_id": str(page + 1)}})
+
+
+@pytest.fixture
+def pages(quake_record):
+    return [[quake_record(f"10.0.{page}.{i}") for i in range(3)] for page in range(3)]
+
+
+@pytest.fixture
+def quake_client(monkeypatch, pages):
+    def install(**kwargs):
+        client = FakeQuakeClient(pages, **kwargs)
+        monkeypatch.setattr(icp, "get_provider_client", lambda provider: client)
+        return client
+    return install
+
+
+def test_checkpoint_advances_with_each_page(db_conn, pages):
+    target_id = icp.get_target_id_from_db("集团A", db_conn)
+    scroll_id = icp.start_quake_scroll(target_id, "dsl", db_conn)
+    icp.save_quake_page(scroll_id, target_id, pages[0], "1", db_conn)
+    icp.save_quake_page(scroll_id, target_id, pages[1], "2", db_conn)
+    assert icp.find_resumable_quake_scroll(target_id, "dsl", db_conn) == (scroll_id, "2", 2, 6)
+    assert icp.find_resumable_quake_scroll(target_id, "other dsl", db_conn) is None
+
+    icp.finish_quake_scroll(scroll_id, target_id, db_conn, 6)
+    assert icp.find_resumable_quake_scroll(target_id, "dsl", db_conn) is None
+
+
+def test_interrupted_scroll_resumes_from_checkpoint(db_conn, pages, quake_client, monkeypatch, capsys):
+    monkeypatch.setattr(icp, "QUAKE_RESUME", True)
+    client = quake_client(fail_on_page=2)
+    with pytest.raises(icp.QuakeQueryError):
+        list(icp.iter_quake_api_records("集团A", db_conn))
+    assert client.requested_pages == [0, 1, 2]
+
+    client = quake_client()
+    records = list(icp.iter_quake_api_records("集团A", db_conn))
+    # 只从检查点继续请求，之前入库的两页照常产出，且不重复
+    assert client.requested_pages == [2, 3]
+    assert sorted(record["IP"] for record in records) == sorted(item["ip"] for page in pages for item in page)
+
+    target_id = icp.get_target_id_from_db("集团A", db_conn)
+    assert icp.get_quake_cache_state("集团A", db_conn) == (icp.CACHE_STATE_HIT, target_id)
+    assert len(list(icp.iter_quake_snapshot_records(target_id, db_conn))) == 9
+    assert db_conn.execute("SELECT records_fetched FROM QuakeScrolls WHERE status = 'completed'").fetchone()[0] == 9
+    assert "共获取 9 条原始记录" in capsys.readouterr().out
+
+
+def test_without_resume_a_fresh_scroll_discards_partial_pages(db_conn, quake_client, monkeypatch):
+    monkeypatch.setattr(icp, "QUAKE_RESUME", False)
+    quake_client(fail_on_page=1)
+    with pytest.raises(icp.QuakeQueryError):
+        list(icp.iter_quake_api_records("集团A", db_conn))
+
+    client = quake_client()
+    records = list(icp.iter_quake_api_records("集团A", db_conn))
+    assert client.requested_pages == [0, 1, 2, 3]
+    assert len(records) == 9
+    target_id = icp.get_target_id_from_db("集团A", db_conn)
+    assert db_conn.execute("SELECT COUNT(*) FROM QuakeAsset WHERE target_id = ?", (target_id,)).fetchone()[0] == 9
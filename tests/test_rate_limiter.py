@@ -0,0 +1,69 @@
+import types
+
+import pytest
+
+import ICPAssetExpress as icp
+
+
+class FakeClock:
+    """可控的时钟：sleep 只推进时间，不真正等待。"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(icp, "time", types.SimpleNamespace(monotonic=fake.monotonic, sleep=fake.sleep))
+    return fake
+
+
+def test_burst_is_served_without_waiting(clock):
+    limiter = icp.TokenBucketRateLimiter("quake", rate=1, burst=3)
+    assert [limiter.acquire() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert limiter.acquire() == pytest.approx(1.0)
+    assert limiter.request_count == 4
+
+
+def test_tokens_refill_at_rate(clock):
+    limiter = icp.TokenBucketRateLimiter("fofa", rate=2, burst=2)
+    limiter.acquire()
+    limiter.acquire()
+    clock.now += 0.5  # 补充 1 个令牌
+    assert limiter.acquire() == 0.0
+    assert limiter.acquire() == pytest.approx(0.5)
+
+
+def test_refill_is_capped_at_burst(clock):
+    limiter = icp.TokenBucketRateLimiter("fofa", rate=1, burst=2)
+    limiter.acquire()
+    clock.now += 100
+    assert [limiter.acquire() for _ in range(2)] == [0.0, 0.0]
+    assert limiter.acquire() == pytest.approx(1.0)
+
+
+def test_zero_rate_means_unlimited(clock):
+    limiter = icp.TokenBucketRateLimiter("werplus", rate=0)
+    assert sum(limiter.acquire() for _ in range(100)) == 0.0
+
+
+def test_penalize_blocks_until_retry_after(clock):
+    limiter = icp.TokenBucketRateLimiter("quake", rate=10, burst=5)
+    limiter.penalize(5)
+    assert limiter.acquire() >= 5
+    assert limiter.throttled_count == 1
+
+
+def test_wait_is_accounted_per_caller(clock):
+    limiter = icp.TokenBucketRateLimiter("quake", rate=1, burst=1)
+    limiter.acquire()
+    limiter.acquire()
+    assert limiter.total_wait == pytest.approx(1.0)
+    assert sum(limiter.wait_by_caller.values()) == pytest.approx(1.0)
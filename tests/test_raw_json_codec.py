@@ -0,0 +1,106 @@
+import json
+
+import pytest
+
+import ICPAssetExpress as icp
+
+
+@pytest.fixture
+def payload(quake_record):
+    return {"records": [quake_record(f"10.0.0.{i}", title="登录页面") for i in range(5)]}
+
+
+@pytest.fixture
+def payload_text(payload):
+    return json.dumps(payload, ensure_ascii=False)
+
+
+@pytest.fixture(autouse=True)
+def no_trained_dict(monkeypatch):
+    monkeypatch.setattr(icp, "_zstd_dicts", {})
+    monkeypatch.setattr(icp, "_current_zstd_dict_id", None)
+
+
+def test_legacy_text_rows_decode_unchanged(payload, payload_text):
+    assert icp.decode_raw_json(payload_text) == payload_text
+    assert icp.load_raw_json(payload_text) == payload
+    assert icp.decode_raw_json(None) is None
+    assert icp.load_raw_json(None, default=[]) == []
+
+
+@pytest.mark.parametrize("codec, marker", [("zlib", b"Z"), ("zstd", b"S")])
+def test_compressed_blob_round_trip(monkeypatch, codec, marker, payload, payload_text):
+    if codec == "zstd":
+        pytest.importorskip("zstandard")
+    monkeypatch.setattr(icp, "RAW_JSON_COMPRESSION", codec)
+    blob = icp.encode_raw_json(payload)
+    assert isinstance(blob, bytes) and blob[:1] == marker
+    assert len(blob) < len(payload_text.encode("utf-8"))
+    assert icp.load_raw_json(blob) == payload
+    # sqlite 读出的 BLOB 可能是 memoryview
+    assert icp.load_raw_json(memoryview(blob)) == payload
+
+
+def test_short_payloads_and_none_codec_stay_text(monkeypatch, payload, payload_text):
+    monkeypatch.setattr(icp, "RAW_JSON_COMPRESSION", "zlib")
+    assert icp.encode_raw_json([]) == "[]"
+    monkeypatch.setattr(icp, "RAW_JSON_COMPRESSION", "none")
+    assert icp.encode_raw_json(payload) == payload_text
+
+
+def test_migration_compresses_legacy_rows_in_place(db_conn, monkeypatch, payload, payload_text):
+    monkeypatch.setattr(icp, "RAW_JSON_COMPRESSION", "zlib")
+    target_id = icp.get_target_id_from_db("集团A", db_conn)
+    db_conn.executemany("INSERT INTO QuakeRawData (target_id, query_timestamp, raw_json) VALUES (?, ?, ?)",
+                        [(target_id, "2025-01-01 00:00:00", payload_text), (target_id, "2025-01-01 00:00:00", "[]")])
+    db_conn.commit()
+
+    icp.migrate_raw_json_compression(db_conn, batch_size=1)
+    rows = db_conn.execute("SELECT typeof(raw_json), raw_json FROM QuakeRawData ORDER BY data_id").fetchall()
+    assert [row[0] for row in rows] == ["blob", "text"]
+    assert [icp.load_raw_json(row[1]) for row in rows] == [payload, []]
+
+    # 再次迁移不会重复处理已压缩的行
+    icp.migrate_raw_json_compression(db_conn)
+    assert db_conn.execute("SELECT raw_json FROM QuakeRawData ORDER BY data_id").fetchone()[0] == rows[0][1]
+
+
+def test_cache_stats_reads_mixed_rows(db_conn, monkeypatch, capsys, payload, payload_text):
+    monkeypatch.setattr(icp, "RAW_JSON_COMPRESSION", "zlib")
+    monkeypatch.setattr(icp, "CACHE_STATS_SAMPLE_ROWS", 1)
+    target_id = icp.get_target_id_from_db("集团A", db_conn)
+    db_conn.executemany("INSERT INTO QuakeRawData (target_id, query_timestamp, raw_json) VALUES (?, ?, ?)",
+                        [(target_id, "2025-01-01 00:00:00", icp.encode_raw_json(payload)),
+                         (target_id, "2025-01-01 00:00:00", payload_text)])
+    db_conn.commit()
+    icp.report_cache_stats(db_conn)
+    assert "QuakeRawData: 2 条 (已压缩 1 条)" in capsys.readouterr().out
+
+
+def test_startup_migration_runs_only_once(db_conn, monkeypatch):
+    monkeypatch.setattr(icp, "RAW_JSON_COMPRESSION", "zlib")
+    assert db_conn.execute("PRAGMA user_version").fetchone()[0] == icp.RAW_JSON_SCHEMA_VERSION
+    calls = []
+    monkeypatch.setattr(icp, "migrate_raw_json_compression", lambda conn, batch_size=1000: calls.append(conn))
+    monkeypatch.setattr(icp, "train_zstd_dict", lambda conn: calls.append(conn))
+    icp.initialize_database().close()
+    assert calls == []
+
+
+@pytest.mark.parametrize("blob", [b"D" + (99).to_bytes(4, "big") + b"\x28\xb5\x2f\xfd", b"S" + b"not zstd data"])
+def test_unreadable_zstd_blob_raises_value_error(blob):
+    pytest.importorskip("zstandard")
+    with pytest.raises(ValueError):
+        icp.decode_raw_json(blob)
+
+
+def test_corrupt_fofa_cache_row_is_a_miss(db_conn):
+    pytest.importorskip("zstandard")
+    now = icp.datetime.datetime.now()
+    db_conn.executemany("INSERT INTO FofaIPCache (ip, query_timestamp, result_count, cache_state, raw_json) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        [("10.0.0.1", now, 1, icp.CACHE_STATE_HIT, b"S" + b"not zstd data"),
+                         ("10.0.0.2", now, 0, icp.CACHE_STATE_EMPTY, "[]")])
+    db_conn.commit()
+    cached, recent_error_ips = icp.load_fofa_ip_cache(["10.0.0.1", "10.0.0.2"], db_conn)
+    assert cached == {"10.0.0.2": []} and recent_error_ips == set()
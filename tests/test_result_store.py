@@ -0,0 +1,32 @@
+import ICPAssetExpress as icp
+
+
+def write_parts(monkeypatch, company_dir, run_id, part_count):
+    monkeypatch.setattr(icp, "RESULT_STORE_RUN_ID", run_id)
+    for part in range(1, part_count + 1):
+        icp.write_result_store("fingerprint", company_dir, "公司A", [{"url": f"http://{run_id}.com/{part}"}],
+                               f"fingerprint_stage{part}")
+
+
+def test_render_reads_only_the_latest_run_of_a_partition(tmp_path, monkeypatch):
+    monkeypatch.setattr(icp, "OUTPUT_BASE_DIR", str(tmp_path))
+    monkeypatch.setattr(icp, "RESULT_STORE_FORMAT", "jsonl")
+    company_dir = tmp_path / "集团A" / "公司A"
+    write_parts(monkeypatch, company_dir, "00000000000000000001", 3)
+    write_parts(monkeypatch, company_dir, "00000000000000000002", 2)
+
+    [(_, _, _, partition_dir)] = icp.find_result_partitions(icp.get_result_store_dir())
+    latest = icp.select_latest_results(icp.read_result_store_partition(partition_dir))
+    assert sorted(latest["stage"]) == ["fingerprint_stage1", "fingerprint_stage2"]
+    assert set(latest["run_id"]) == {"00000000000000000002"}
+
+
+def test_latest_write_wins_within_a_run(tmp_path, monkeypatch):
+    monkeypatch.setattr(icp, "OUTPUT_BASE_DIR", str(tmp_path))
+    monkeypatch.setattr(icp, "RESULT_STORE_FORMAT", "jsonl")
+    company_dir = tmp_path / "集团A" / "公司A"
+    write_parts(monkeypatch, company_dir, "00000000000000000001", 1)
+    write_parts(monkeypatch, company_dir, "00000000000000000001", 1)
+
+    [(_, _, _, partition_dir)] = icp.find_result_partitions(icp.get_result_store_dir())
+    assert len(icp.select_latest_results(icp.read_result_store_partition(partition_dir))) == 1